@@ -0,0 +1,97 @@
+"""
+Per ship type summary of co2emission_reduced, kept up to date on every write
+so that the aggregation and visual pages do not need to GROUP BY the whole
+table on each request.
+"""
+from collections import defaultdict
+
+SUMMARY_TABLE = 'type_summary'
+
+# Same columns and order as the live GROUP BY it replaces:
+# type, count(imo), min, avg and max of technical_efficiency_number
+SUMMARY_COLUMNS = '''
+    type,
+    ship_count AS count,
+    value_min AS min,
+    value_sum / NULLIF(value_count, 0) AS avg,
+    value_max AS max
+'''
+
+
+def apply_changes(cursor, removed=(), added=()):
+    """
+    Updates the summary for rows removed from and added to co2emission_reduced.
+    Both are iterables of (type, technical_efficiency_number) tuples, an update
+    being the removal of the old row and the addition of the new one. Must be
+    called in the same transaction, after the change to co2emission_reduced.
+    Returns the types that no longer have any ship.
+    """
+    # type -> [ship_count, value_count, value_sum, value_sum_sq, min, max]
+    deltas = defaultdict(lambda: [0, 0, 0.0, 0.0, None, None])
+    for sign, rows in ((-1, removed), (1, added)):
+        for ship_type, value in rows:
+            delta = deltas[ship_type]
+            delta[0] += sign
+            if value is None:
+                continue
+            value = float(value)
+            delta[1] += sign
+            delta[2] += sign * value
+            delta[3] += sign * value * value
+            if sign > 0:
+                delta[4] = value if delta[4] is None else min(delta[4], value)
+                delta[5] = value if delta[5] is None else max(delta[5], value)
+
+    if not deltas:
+        return []
+
+    cursor.execute(f'''
+        INSERT INTO {SUMMARY_TABLE}
+            (type, ship_count, value_count, value_sum, value_sum_sq, value_min, value_max)
+        VALUES {", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(deltas))}
+        ON CONFLICT (type) DO UPDATE SET
+            ship_count = {SUMMARY_TABLE}.ship_count + EXCLUDED.ship_count,
+            value_count = {SUMMARY_TABLE}.value_count + EXCLUDED.value_count,
+            value_sum = {SUMMARY_TABLE}.value_sum + EXCLUDED.value_sum,
+            value_sum_sq = {SUMMARY_TABLE}.value_sum_sq + EXCLUDED.value_sum_sq,
+            value_min = LEAST({SUMMARY_TABLE}.value_min, EXCLUDED.value_min),
+            value_max = GREATEST({SUMMARY_TABLE}.value_max, EXCLUDED.value_max);
+    ''', [val for ship_type, delta in deltas.items() for val in (ship_type, *delta)])
+
+    # Min and max can not be subtracted, so they are looked up again (from
+    # the (type, technical_efficiency_number) index) if a removed value was
+    # on the boundary. The bounds are compared as REAL, the type of the
+    # column, as a double like 2.3 is not equal to the REAL 2.3 widened.
+    bounds = defaultdict(list)
+    for ship_type, value in removed:
+        if value is not None:
+            bounds[ship_type].append(float(value))
+    if bounds:
+        cursor.execute(f'''
+            UPDATE {SUMMARY_TABLE} s
+            SET value_min = (SELECT MIN(technical_efficiency_number) FROM co2emission_reduced c WHERE c.type = s.type),
+                value_max = (SELECT MAX(technical_efficiency_number) FROM co2emission_reduced c WHERE c.type = s.type)
+            FROM (VALUES {", ".join(["(%s, %s::REAL, %s::REAL)"] * len(bounds))}) r (type, lo, hi)
+            WHERE s.type = r.type AND (r.lo <= s.value_min OR r.hi >= s.value_max);
+        ''', [val for ship_type, values in bounds.items() for val in (ship_type, min(values), max(values))])
+
+    cursor.execute(f'DELETE FROM {SUMMARY_TABLE} WHERE ship_count <= 0 RETURNING type;')
+    return [row[0] for row in cursor.fetchall()]
+
+
+def rebuild(cursor):
+    """Rebuilds the whole summary from co2emission_reduced, repairing any drift"""
+    cursor.execute(f'DELETE FROM {SUMMARY_TABLE};')
+    cursor.execute(f'''
+        INSERT INTO {SUMMARY_TABLE}
+            (type, ship_count, value_count, value_sum, value_sum_sq, value_min, value_max)
+        SELECT type,
+            COUNT(*),
+            COUNT(technical_efficiency_number),
+            COALESCE(SUM(technical_efficiency_number::DOUBLE PRECISION), 0),
+            COALESCE(SUM(technical_efficiency_number::DOUBLE PRECISION ^ 2), 0),
+            MIN(technical_efficiency_number),
+            MAX(technical_efficiency_number)
+        FROM co2emission_reduced
+        GROUP BY type;
+    ''')
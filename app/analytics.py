@@ -0,0 +1,336 @@
+"""
+Queries of the star-schema analytics pages, and the materialized views that
+precompute them for every metric choice of the pages' dropdowns.
+"""
+import textwrap
+
+from django.conf import settings
+
+from app import sketches
+
+STAR_SCHEMA_TABLES = ['fact_table', 'ship_dimension', 'verifiers', 'd_date']
+
+# Dropdown values of the fuel performance page and their titles
+FUEL_PERFORMANCE_METRICS = {
+    'f.eedi': 'EEDI',
+    's.tonnage': 'Ship Tonnage Capacity',
+    's.width': 'Ship Width',
+    's.length': 'Ship Length',
+    's.speed': 'Ship Speed',
+    'f.sea_time': 'Sea Time',
+    'f.co2_distance': 'CO2 Distance',
+    'f.co2_transport': 'CO2 Transport',
+}
+
+# Dropdown values of the built year efficiency page and their titles
+PERCENTILE_METRICS = {
+    'eedi': 'EEDI',
+    'co2_distance': 'CO2 Distance',
+    'co2_transport': 'CO2 Transport',
+    'fuel_consumption': 'Fuel Consumption',
+}
+
+FUEL_PERFORMANCE_COLUMNS = 'ship_type, engine_type, metric, fuelconsumption, scaled_count, label'
+VERIFIER_RANKING_COLUMNS = 'verifier_name, month_actual, avg_eedi, rank'
+PERCENTILE_COLUMNS = 'year_built, percentile_25, percentile_75'
+
+
+def fuel_performance_sql(y_axis, facts='fact_table'):
+    """ROLLUP of a metric and fuel consumption per ship type and engine"""
+    return f'''
+        SELECT s.ship_type, s.engine_type,
+            ROUND(AVG({y_axis})::NUMERIC,2) as metric,
+            ROUND(AVG(f.fuel_consumption)::NUMERIC,2) as fuelconsumption,
+            LN(COUNT(*)) as scaled_count,
+            (CASE
+            WHEN s.ship_type ISNULL AND s.engine_type ISNULL THEN 'Grand Total'
+            WHEN s.engine_type ISNULL THEN 'Subtotal'||' '||s.ship_type
+            ELSE s.ship_type|| ' ' || s.engine_type
+            END) as label,
+            GROUPING(s.ship_type, s.engine_type) as grouping_level
+        FROM {facts} f, ship_dimension s
+        WHERE f.ship_key = s.ship_key
+        GROUP BY ROLLUP(s.ship_type, s.engine_type)
+    '''
+
+
+def verifier_ranking_sql(facts='fact_table'):
+    """Average EEDI per verifier and issue month, ranked within the month"""
+    return f'''
+        SELECT v.verifier_name, d.month_actual,
+            ROUND(AVG(f.EEDI)::NUMERIC,2) as avg_eedi,
+            RANK() OVER(PARTITION BY d.month_actual ORDER BY ROUND(AVG(f.EEDI)::NUMERIC,2) ASC) rank
+        FROM {facts} f, verifiers v, d_date d
+        WHERE f.issue_date_key = d.date_dim_id
+            AND f.verifier_key = v.verifier_key
+        GROUP BY v.verifier_name, d.month_actual
+    '''
+
+
+VERIFIER_RANKING_SQL = verifier_ranking_sql()
+
+
+def percentile_sql(y_axis, facts='fact_table'):
+    """25th and 75th percentiles of a metric per year built"""
+    return f'''
+        SELECT s.year_built,
+            ROUND(PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY f.{y_axis} ASC)::NUMERIC,2) AS percentile_25,
+            ROUND(PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY f.{y_axis} ASC)::NUMERIC,2) AS percentile_75
+        FROM {facts} f, ship_dimension s
+        WHERE f.ship_key = s.ship_key
+        GROUP BY s.year_built
+    '''
+
+
+# Columns the facts of the quantile sketches can be filtered by
+SKETCH_FILTERS = ['ship_type', 'verifier_name', 'month_actual']
+
+
+def quantile_sketch_sql(metric):
+    """
+    Sketches (see app.sketches) of a metric per year built, ship type,
+    verifier and issue month, as arrays of bucket keys and counts
+    """
+    return f'''
+        SELECT year_built, ship_type, verifier_name, month_actual,
+            array_agg(bucket ORDER BY bucket) AS buckets,
+            array_agg(n ORDER BY bucket) AS counts
+        FROM (
+            SELECT s.year_built, s.ship_type, v.verifier_name, d.month_actual,
+                {sketches.bucket_sql(f'f.{metric}')} AS bucket,
+                COUNT(*) AS n
+            FROM fact_table f
+            JOIN ship_dimension s ON s.ship_key = f.ship_key
+            LEFT JOIN verifiers v ON v.verifier_key = f.verifier_key
+            LEFT JOIN d_date d ON d.date_dim_id = f.issue_date_key
+            WHERE f.{metric} IS NOT NULL
+            GROUP BY 1, 2, 3, 4, 5
+        ) AS buckets
+        GROUP BY year_built, ship_type, verifier_name, month_actual
+    '''
+
+
+# Values of the checkbox filters of the fact chart pages
+FACT_FILTERS_SQL = '''
+    SELECT 'year' AS filter, d.year_actual::TEXT AS value
+    FROM (SELECT DISTINCT issue_date_key FROM fact_table) AS f
+    JOIN d_date d ON d.date_dim_id = f.issue_date_key
+    GROUP BY d.year_actual
+    UNION ALL
+    SELECT DISTINCT 'ship_type', ship_type FROM ship_dimension WHERE ship_type IS NOT NULL
+    UNION ALL
+    SELECT DISTINCT 'engine_type', engine_type FROM ship_dimension
+    UNION ALL
+    SELECT DISTINCT 'verifier', verifier_name FROM verifiers
+'''
+
+# Those of the visual page, read live as co2emission_reduced changes
+# between loads
+EMISSION_FILTERS_QUERY = '''
+    SELECT 'year' AS filter, EXTRACT(YEAR FROM issue)::INT::TEXT AS value
+    FROM co2emission_reduced
+    GROUP BY 2
+    UNION ALL
+    SELECT 'ship_type', type FROM type_summary WHERE ship_count > 0
+    ORDER BY filter, value
+'''
+
+
+def matview_name(view, metric=None):
+    """Name of the materialized view of an analytics page and metric"""
+    if metric is None:
+        return f'mv_{view}'
+    return f'mv_{view}_{metric.split(".")[-1]}'
+
+
+# Materialized view name -> (defining query, columns of its unique index).
+# The unique index is what allows REFRESH MATERIALIZED VIEW CONCURRENTLY.
+MATERIALIZED_VIEWS = {
+    **{
+        matview_name('fuel_performance', metric): (
+            fuel_performance_sql(metric), 'grouping_level, ship_type, engine_type'
+        )
+        for metric in FUEL_PERFORMANCE_METRICS
+    },
+    matview_name('verifier_ranking'): (VERIFIER_RANKING_SQL, 'verifier_name, month_actual'),
+    **{
+        matview_name('percentile', metric): (percentile_sql(metric), 'year_built')
+        for metric in PERCENTILE_METRICS
+    },
+    # The groups of facts without a verifier or issue date have NULL keys,
+    # which the unique index does not compare, but GROUP BY makes them unique
+    **{
+        matview_name('quantile_sketch', metric): (
+            quantile_sketch_sql(metric), 'year_built, ship_type, verifier_name, month_actual'
+        )
+        for metric in PERCENTILE_METRICS
+    },
+    matview_name('fact_filters'): (FACT_FILTERS_SQL, 'filter, value'),
+}
+
+
+def _source(view, metric, sql, live):
+    # Reads from the materialized view, unless turned off in the settings or live
+    if settings.ANALYTICS_USE_MATVIEWS and not live:
+        return matview_name(view, metric)
+    return f'({sql}) AS {view}'
+
+
+def fuel_performance_query(y_axis, live=False):
+    return f'''
+        SELECT {FUEL_PERFORMANCE_COLUMNS}
+        FROM {_source('fuel_performance', y_axis, fuel_performance_sql(y_axis), live)}
+        ORDER BY ship_type DESC, engine_type DESC
+    '''
+
+
+def verifier_ranking_query(live=False):
+    return f'''
+        SELECT {VERIFIER_RANKING_COLUMNS}
+        FROM {_source('verifier_ranking', None, VERIFIER_RANKING_SQL, live)}
+        ORDER BY verifier_name, month_actual
+    '''
+
+
+def percentile_query(y_axis, live=False):
+    return f'''
+        SELECT {PERCENTILE_COLUMNS}
+        FROM {_source('percentile', y_axis, percentile_sql(y_axis), live)}
+        ORDER BY year_built
+    '''
+
+
+# Checkbox filter -> condition on the facts f with the ticked values, which
+# the chart queries then read in place of fact_table
+FACT_FILTER_CONDITIONS = {
+    'year': 'f.issue_date_key IN (SELECT date_dim_id FROM d_date WHERE year_actual::TEXT = ANY(%s))',
+    'ship_type': 'f.ship_key IN (SELECT ship_key FROM ship_dimension WHERE ship_type = ANY(%s))',
+    'engine_type': 'f.ship_key IN (SELECT ship_key FROM ship_dimension WHERE engine_type = ANY(%s))',
+    'verifier': 'f.verifier_key IN (SELECT verifier_key FROM verifiers WHERE verifier_name = ANY(%s))',
+}
+# Those of the visual page on co2emission_reduced, whose per type summary
+# is then computed live like the type_summary table it replaces
+EMISSION_FILTER_CONDITIONS = {
+    'year': 'EXTRACT(YEAR FROM issue)::INT::TEXT = ANY(%s)',
+    'ship_type': 'type = ANY(%s)',
+}
+
+
+def emission_summary_sql(where):
+    return f'''
+        SELECT type, COUNT(*) AS count,
+            MIN(technical_efficiency_number) AS min,
+            AVG(technical_efficiency_number::DOUBLE PRECISION) AS avg,
+            MAX(technical_efficiency_number) AS max
+        FROM co2emission_reduced
+        WHERE {where}
+        GROUP BY type
+        ORDER BY type
+    '''
+
+
+def filtered_chart_query(view, filters, y_axis=None):
+    """
+    The query of a chart page over the rows with the values of filters, a
+    dict of checkbox filter -> ticked values, and the query parameters. It
+    reads the tables, as the materialized views hold every row.
+    """
+    conditions = EMISSION_FILTER_CONDITIONS if view == 'visual' else FACT_FILTER_CONDITIONS
+    where = ' AND '.join(conditions[name] for name in filters) or 'TRUE'
+    params = [list(values) for values in filters.values()]
+    if view == 'visual':
+        return emission_summary_sql(where), params
+    facts = f'(SELECT * FROM fact_table f WHERE {where})'
+    if view == 'fuel_performance':
+        return f'''
+            SELECT {FUEL_PERFORMANCE_COLUMNS}
+            FROM ({fuel_performance_sql(y_axis, facts)}) AS fuel_performance
+            ORDER BY ship_type DESC, engine_type DESC
+        ''', params
+    if view == 'verifiers_ranking':
+        return f'''
+            SELECT {VERIFIER_RANKING_COLUMNS}
+            FROM ({verifier_ranking_sql(facts)}) AS verifier_ranking
+            ORDER BY verifier_name, month_actual
+        ''', params
+    if view == 'built_year_efficiency':
+        return f'''
+            SELECT {PERCENTILE_COLUMNS}
+            FROM ({percentile_sql(y_axis, facts)}) AS percentile
+            ORDER BY year_built
+        ''', params
+    raise ValueError(f'No chart {view}')
+
+
+def quantile_sketch_query(metric, filters):
+    """
+    The sketches of a metric merged per year built for the facts matching
+    filters, a dict of SKETCH_FILTERS column -> list of values, and the
+    query parameters
+    """
+    where = ' AND '.join(f'{column} = ANY(%s)' for column in filters) or 'TRUE'
+    source = _source('quantile_sketch', metric, quantile_sketch_sql(metric), False)
+    return f'''
+        SELECT year_built, b.bucket, SUM(b.n)::BIGINT AS count
+        FROM {source}, unnest(buckets, counts) AS b (bucket, n)
+        WHERE {where}
+        GROUP BY year_built, b.bucket
+        ORDER BY year_built, b.bucket
+    ''', list(filters.values())
+
+
+def fact_filters_query():
+    return f'''
+        SELECT filter, value
+        FROM {_source('fact_filters', None, FACT_FILTERS_SQL, False)}
+        ORDER BY filter, value
+    '''
+
+
+def star_schema_exists(cursor):
+    """Returns whether all star-schema tables have been created"""
+    cursor.execute(
+        f'SELECT {", ".join(["to_regclass(%s)"] * len(STAR_SCHEMA_TABLES))}',
+        STAR_SCHEMA_TABLES
+    )
+    return all(cursor.fetchone())
+
+
+def create_materialized_views(cursor):
+    """Creates the materialized views that do not exist yet"""
+    for name, (sql, key) in MATERIALIZED_VIEWS.items():
+        cursor.execute(f'CREATE MATERIALIZED VIEW IF NOT EXISTS {name} AS {sql};')
+        cursor.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {name}_key ON {name} ({key});')
+
+
+def create_materialized_views_script():
+    """
+    The SQL script creating the materialized views, for a database set up
+    from eda/ (see eda/create_materialized_views.sql)
+    """
+    statements = [
+        '-- materialized views of the analytics pages, generated from app/analytics.py with:',
+        '-- python manage.py refresh_analytics --sql > eda/create_materialized_views.sql',
+        '-- refresh after loading data with: python manage.py refresh_analytics',
+    ]
+    for name, (sql, key) in MATERIALIZED_VIEWS.items():
+        sql = textwrap.dedent(sql.strip('\n')).rstrip()
+        statements.append(f'\nCREATE MATERIALIZED VIEW IF NOT EXISTS {name} AS\n{sql};')
+        statements.append(f'CREATE UNIQUE INDEX IF NOT EXISTS {name}_key ON {name} ({key});')
+    return '\n'.join(statements) + '\n'
+
+
+def refresh_materialized_views(cursor, concurrently=True):
+    """
+    Refreshes every materialized view. A concurrent refresh does not lock out
+    readers of the view while it runs.
+    """
+    for name in MATERIALIZED_VIEWS:
+        cursor.execute(
+            f'REFRESH MATERIALIZED VIEW {"CONCURRENTLY" if concurrently else ""} {name};'
+        )
+
+
+def drop_materialized_views(cursor):
+    for name in MATERIALIZED_VIEWS:
+        cursor.execute(f'DROP MATERIALIZED VIEW IF EXISTS {name};')
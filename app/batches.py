@@ -0,0 +1,206 @@
+"""
+Batch writes to co2emission_reduced, from a JSON or CSV body of rows that
+are each upserted or deleted by IMO.
+
+The rows are validated with the rules of ImoForm on whole columns at once
+(see validate), and the valid ones are applied in one transaction with a
+set-based DELETE and multi-row INSERT ... ON CONFLICT (imo) DO UPDATE, after
+which type_summary is updated once for the whole batch.
+"""
+import io
+import json
+
+import numpy as np
+import pandas as pd
+from django.utils import formats
+
+from app import aggregates
+from app.forms import ImoForm
+
+UPSERT = 'upsert'
+DELETE = 'delete'
+UPSERT_CHUNK_SIZE = 1000
+COLUMNS = ['imo', 'ship_name', 'type', 'technical_efficiency_number', 'issue', 'expiry']
+CONTENT_TYPES = ['application/json', 'text/csv']
+
+
+class BatchError(ValueError):
+    """The body of a batch could not be read"""
+
+
+def parse(body, content_type):
+    """
+    Reads a batch of one of CONTENT_TYPES into a DataFrame of strings. JSON is
+    a list of objects, CSV has a header row; both with the emissions columns
+    and an optional action of 'upsert' (the default) or 'delete'.
+    """
+    if content_type not in CONTENT_TYPES:
+        raise BatchError(f'Unsupported content type {content_type}')
+    try:
+        if content_type == 'text/csv':
+            frame = pd.read_csv(io.BytesIO(body), dtype=str, keep_default_na=False)
+        else:
+            rows = json.loads(body)
+    except (ValueError, pd.errors.ParserError) as e:
+        raise BatchError(f'Could not read the batch: {e}') from e
+    if content_type != 'text/csv':
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise BatchError('Expected a JSON list of objects')
+        frame = pd.DataFrame(rows, dtype=object)
+
+    for col in ['action'] + COLUMNS:
+        if col not in frame:
+            frame[col] = ''
+    # Same as the form fields, which strip text and treat None as blank
+    return frame[['action'] + COLUMNS].fillna('').astype(str).apply(lambda col: col.str.strip())
+
+
+def _parse_dates(values):
+    """Parses strings with each of the form's date input formats in turn"""
+    dates = pd.Series(pd.NaT, index=values.index)
+    for date_format in formats.get_format('DATE_INPUT_FORMATS'):
+        missing = dates.isna()
+        dates[missing] = pd.to_datetime(values[missing], format=date_format, errors='coerce')
+    return dates
+
+
+def _digits(values):
+    """Number of digits of decimal strings, counted like Django's DecimalValidator"""
+    unsigned = values.str.lstrip('+-')
+    whole = unsigned.str.split('.').str[0].str.lstrip('0')
+    decimals = unsigned.str.split('.').str[1].fillna('')
+    return whole.str.len() + decimals.str.len()
+
+
+def validate(frame):
+    """
+    Validates every row of a parsed batch at once. Returns the valid rows to
+    upsert as a typed DataFrame, the valid IMOs to delete, and the errors as
+    a list of {'row', 'imo', 'errors': {field: [messages]}}, row being the
+    index of the row in the batch.
+    """
+    fields = ImoForm.base_fields
+    errors = {}
+
+    def error(mask, field, message):
+        for row in np.flatnonzero(mask):
+            errors.setdefault(row, {}).setdefault(field, []).append(
+                str(message(row) if callable(message) else message)
+            )
+
+    def required(field, mask):
+        blank = mask & (frame[field] == '')
+        error(blank, field, fields[field].error_messages['required'])
+        return blank
+
+    action = frame['action'].str.lower().replace('', UPSERT)
+    error(~action.isin([UPSERT, DELETE]), 'action', f'Must be {UPSERT} or {DELETE}.')
+    upsert = (action == UPSERT).to_numpy()
+    every = np.ones(len(frame), dtype=bool)
+
+    # imo
+    imo_field = fields['imo']
+    blank = required('imo', every)
+    imo = pd.to_numeric(frame['imo'], errors='coerce')
+    invalid = ~blank & (imo.isna() | (imo % 1 != 0))
+    error(invalid, 'imo', imo_field.error_messages['invalid'])
+    error(~blank & ~invalid & (imo < imo_field.min_value), 'imo',
+          f'Ensure this value is greater than or equal to {imo_field.min_value}.')
+    error(~blank & ~invalid & (imo > imo_field.max_value), 'imo',
+          f'Ensure this value is less than or equal to {imo_field.max_value}.')
+    error(~blank & ~invalid & imo.duplicated(keep=False), 'imo', 'Appears more than once in the batch.')
+
+    # ship_name and type, free text the ship types are only suggested for
+    for field in ['ship_name', 'type']:
+        required(field, upsert)
+        lengths = frame[field].str.len()
+        max_length = fields[field].max_length
+        error(upsert & (lengths > max_length), field,
+              lambda row: f'Ensure this value has at most {max_length} characters (it has {lengths[row]}).')
+        error(upsert & frame[field].str.contains('\x00', regex=False), field,
+              'Null characters are not allowed.')
+
+    # technical_efficiency_number, optional in the form but NOT NULL in the table
+    ten_field = fields['technical_efficiency_number']
+    blank = required('technical_efficiency_number', upsert)
+    ten = pd.to_numeric(frame['technical_efficiency_number'], errors='coerce')
+    invalid = upsert & ~blank & ~np.isfinite(ten)
+    error(invalid, 'technical_efficiency_number', ten_field.error_messages['invalid'])
+    valid = upsert & ~blank & ~invalid
+    error(valid & (ten < ten_field.min_value), 'technical_efficiency_number',
+          f'Ensure this value is greater than or equal to {ten_field.min_value}.')
+    error(valid & (_digits(frame['technical_efficiency_number']) > ten_field.max_digits),
+          'technical_efficiency_number',
+          f'Ensure that there are no more than {ten_field.max_digits} digits in total.')
+
+    # issue and expiry
+    dates = {}
+    for field in ('issue', 'expiry'):
+        blank = required(field, upsert)
+        dates[field] = _parse_dates(frame[field])
+        error(upsert & ~blank & dates[field].isna(), field, fields[field].error_messages['invalid'])
+
+    valid = ~frame.index.isin(list(errors))
+    upserts = pd.DataFrame({
+        'imo': imo[valid & upsert].astype(np.int64),
+        'ship_name': frame['ship_name'][valid & upsert],
+        'type': frame['type'][valid & upsert],
+        'technical_efficiency_number': ten[valid & upsert],
+        'issue': dates['issue'][valid & upsert].dt.date,
+        'expiry': dates['expiry'][valid & upsert].dt.date,
+    }, columns=COLUMNS)
+    deletes = imo[valid & ~upsert].astype(np.int64).tolist()
+    error_list = [
+        {'row': int(row), 'imo': frame['imo'].iloc[row], 'errors': row_errors}
+        for row, row_errors in sorted(errors.items())
+    ]
+    return upserts, deletes, error_list
+
+
+def apply(cursor, upserts, deletes):
+    """
+    Applies validated upserts and deletes, and updates type_summary once.
+    Must run in a transaction. Returns the counts of inserted, updated and
+    deleted rows, the (type, value) rows added, and the types left without
+    any ship.
+    """
+    imos = upserts['imo'].tolist() + deletes
+    cursor.execute('''
+        SELECT imo, type, technical_efficiency_number
+        FROM co2emission_reduced
+        WHERE imo = ANY(%s)
+        FOR UPDATE;
+    ''', [imos])
+    old = {imo: (ship_type, value) for imo, ship_type, value in cursor.fetchall()}
+
+    removed, added = [], []
+    counts = {'inserted': 0, 'updated': 0, 'deleted': 0}
+    if deletes:
+        cursor.execute('''
+            DELETE FROM co2emission_reduced
+            WHERE imo = ANY(%s)
+            RETURNING type, technical_efficiency_number;
+        ''', [deletes])
+        removed.extend(cursor.fetchall())
+        counts['deleted'] = len(removed)
+
+    rows = list(upserts.itertuples(index=False, name=None))
+    for start in range(0, len(rows), UPSERT_CHUNK_SIZE):
+        chunk = rows[start:start + UPSERT_CHUNK_SIZE]
+        cursor.execute(f'''
+            INSERT INTO co2emission_reduced ({", ".join(COLUMNS)})
+            VALUES {", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(chunk))}
+            ON CONFLICT (imo) DO UPDATE SET
+                {", ".join(f"{col} = EXCLUDED.{col}" for col in COLUMNS[1:])}
+            RETURNING imo, type, technical_efficiency_number;
+        ''', [val.item() if isinstance(val, np.generic) else val for row in chunk for val in row])
+        for imo, ship_type, value in cursor.fetchall():
+            added.append((ship_type, value))
+            if imo in old:
+                removed.append(old[imo])
+                counts['updated'] += 1
+            else:
+                counts['inserted'] += 1
+
+    emptied = aggregates.apply_changes(cursor, removed=removed, added=added)
+    return counts, added, emptied
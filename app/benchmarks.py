@@ -0,0 +1,501 @@
+"""
+Benchmark suites, run with `python manage.py benchmark <suite>`.
+
+A suite is a function registered with @suite that takes the command options
+and returns a list of result rows (dicts), which the command prints as a
+table or writes as JSON. Suites that declare their key and metric fields can
+be compared with the JSON of an earlier run (see regressions), which fails
+the command when a metric got worse by more than its tolerance.
+"""
+import gzip
+import io
+import os
+import random
+import time
+import tracemalloc
+from collections import namedtuple
+from datetime import date, timedelta
+
+import pandas as pd
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connections, transaction
+from django.test import Client, override_settings
+
+from app import caching, compliance, olap, perf, querycache, search
+from app.utils import fetch_columns, namedtuplefetchall, namedtupleiter, query_columns
+from app.figures import INLINE, STATIC, PLOTLY_JS_STATIC_PATH
+
+SUITES = {}
+
+CHART_PATHS = [
+    '/visual/',
+    '/fuel_performance/',
+    '/verifiers_ranking/',
+    '/built_year_efficiency/',
+]
+
+
+# Increases of timings below this are noise whatever the tolerance
+MIN_REGRESSION_MS = 1.0
+
+
+def suite(name, keys=(), metrics=None):
+    """
+    Registers a benchmark suite under a name. keys are the fields that tell
+    its result rows apart, and metrics maps the fields to compare against a
+    baseline, lower being better, to the relative increase they are allowed
+    or None for the tolerance of the command.
+    """
+    def register(func):
+        func.keys = list(keys)
+        func.metrics = metrics or {}
+        SUITES[name] = func
+        return func
+    return register
+
+
+def regressions(suite_func, baseline, results, tolerance):
+    """
+    Compares the result rows of a suite with those of a baseline run, and
+    returns a row per metric that increased by more than it is allowed.
+    Rows missing from either run are not compared.
+    """
+    def key(row):
+        return tuple(row.get(field) for field in suite_func.keys)
+
+    baseline_rows = {key(row): row for row in baseline}
+    found = []
+    for row in results:
+        before = baseline_rows.get(key(row))
+        if before is None:
+            continue
+        for metric, allowed in suite_func.metrics.items():
+            old, new = before.get(metric), row.get(metric)
+            if old is None or new is None:
+                continue
+            limit = old * (1 + (tolerance if allowed is None else allowed))
+            if metric.endswith('_ms'):
+                limit = max(limit, old + MIN_REGRESSION_MS)
+            if new > limit:
+                found.append({
+                    **{field: row.get(field) for field in suite_func.keys},
+                    'metric': metric,
+                    'baseline': old,
+                    'current': new,
+                    'change_pct': (new - old) / old * 100 if old else None,
+                })
+    return found
+
+
+def percentile(samples, q):
+    """Returns the q-th percentile (0-100) of a list of samples"""
+    samples = sorted(samples)
+    if not samples:
+        return None
+    index = (len(samples) - 1) * q / 100
+    lower = int(index)
+    upper = min(lower + 1, len(samples) - 1)
+    return samples[lower] + (samples[upper] - samples[lower]) * (index - lower)
+
+
+@suite('plotly_payload', keys=['mode', 'path'],
+       metrics={'bytes': None, 'gzip_bytes': None, 'ttfb_p50_ms': None})
+def plotly_payload(options):
+    """Response size and time to first byte of the chart pages per plotly.js mode"""
+    client = Client()
+    rows = []
+    for mode in (INLINE, STATIC):
+        with override_settings(PLOTLY_JS_MODE=mode):
+            for path in CHART_PATHS:
+                samples = []
+                for _ in range(options['repeat']):
+                    # Cold figure cache, so the figures are rendered each time
+                    caching.bump_data_version()
+                    start = time.perf_counter()
+                    response = client.get(path)
+                    samples.append(time.perf_counter() - start)
+                rows.append({
+                    'mode': mode,
+                    'path': path,
+                    'status': response.status_code,
+                    'bytes': len(response.content),
+                    'gzip_bytes': len(gzip.compress(response.content)),
+                    'ttfb_p50_ms': percentile(samples, 50) * 1000,
+                })
+
+    # Paid once per browser cache lifetime in static mode
+    with open(finders.find(PLOTLY_JS_STATIC_PATH), 'rb') as f:
+        plotly_js = f.read()
+    rows.append({
+        'mode': STATIC,
+        'path': PLOTLY_JS_STATIC_PATH,
+        'status': None,
+        'bytes': len(plotly_js),
+        'gzip_bytes': len(gzip.compress(plotly_js)),
+        'ttfb_p50_ms': None,
+    })
+    return rows
+
+
+@suite('compliance', keys=['scale'], metrics={'p50_ms': None})
+def compliance_evaluation(options):
+    """Time to evaluate the EEDI compliance of the eda fleet resampled to 1x, 10x and 100x"""
+    eda = os.path.join(settings.BASE_DIR, 'eda')
+    facts = pd.read_csv(os.path.join(eda, 'facttable.csv'))
+    ships = pd.read_csv(os.path.join(eda, 'ship_dimension.csv'))
+    fleet = facts.merge(ships, on='ship_key').rename(
+        columns={'EEDI': 'attained_eedi', 'tonnage': 'dwt'}
+    )[['ship_type', 'dwt', 'year_built', 'attained_eedi']]
+
+    reference_lines = compliance.load_reference_lines()
+    bands = compliance.load_reduction_bands()
+    rows = []
+    for scale in (1, 10, 100):
+        ships = fleet.sample(n=len(fleet) * scale, replace=True, random_state=0)
+        samples = []
+        for _ in range(options['repeat']):
+            start = time.perf_counter()
+            compliance.evaluate(ships, reference_lines, bands)
+            samples.append(time.perf_counter() - start)
+        rows.append({
+            'scale': scale,
+            'ships': len(ships),
+            'p50_ms': percentile(samples, 50) * 1000,
+            'ships_per_sec': len(ships) / percentile(samples, 50),
+        })
+    return rows
+
+
+class ListCursor:
+    """In-memory DB-API cursor, so that the row layer is measured without the database"""
+
+    def __init__(self, columns, rows):
+        self.description = [(col,) for col in columns]
+        self.rows = rows
+        self.position = 0
+
+    def fetchall(self):
+        rows = self.rows[self.position:]
+        self.position = len(self.rows)
+        return rows
+
+    def fetchmany(self, size):
+        rows = self.rows[self.position:self.position + size]
+        self.position += len(rows)
+        return rows
+
+
+def _namedtuplefetchall_uncached(cursor):
+    # namedtuplefetchall before the row type cache, for comparison
+    nt_result = namedtuple('Result', [col[0] for col in cursor.description])
+    return [nt_result(*row) for row in cursor.fetchall()]
+
+
+def _consume(rows):
+    # Touches every row like a template loop would, without keeping them
+    for row in rows:
+        row.technical_efficiency_number
+
+
+@suite('rows', keys=['method', 'queries'], metrics={'ms_per_100k': None, 'peak_kib': None})
+def row_fetching(options):
+    """Time and peak allocations per 100k rows of the ways to fetch rows from a cursor"""
+    columns = ['imo', 'ship_name', 'type', 'technical_efficiency_number', 'issue', 'expiry']
+    issue = date(2021, 1, 1)
+    rows = [
+        (9000000 + i, f'SHIP {i}', 'Bulk carrier', 3.5 + i % 100 / 10, issue, issue + timedelta(days=i % 365))
+        for i in range(100000)
+    ]
+    methods = {
+        'namedtuple per call': _namedtuplefetchall_uncached,
+        'namedtuplefetchall': namedtuplefetchall,
+        'namedtupleiter': lambda cursor: _consume(namedtupleiter(cursor)),
+        'fetch_columns': fetch_columns,
+    }
+    results = []
+    # One query of 100k rows, and 1000 queries of 100 rows as on the paginated pages
+    for calls, per_call in ((1, 100000), (1000, 100)):
+        for name, method in methods.items():
+            samples = []
+            peak = 0
+            for _ in range(options['repeat']):
+                cursors = [ListCursor(columns, rows[:per_call]) for _ in range(calls)]
+                tracemalloc.start()
+                start = time.perf_counter()
+                for cursor in cursors:
+                    method(cursor)
+                samples.append(time.perf_counter() - start)
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            results.append({
+                'method': name,
+                'queries': calls,
+                'rows': calls * per_call,
+                # tracemalloc slows everything down alike, compare relatively
+                'ms_per_100k': percentile(samples, 50) * 1000,
+                'peak_kib': peak / 1024,
+            })
+    return results
+
+
+SEARCH_SHIPS = 1000000
+SYLLABLES = [
+    'MA', 'RE', 'LLA', 'NO', 'RD', 'STAR', 'SEA', 'OCE', 'AN', 'BAL', 'TIC', 'PRI',
+    'DE', 'VI', 'KING', 'HAR', 'BOR', 'LU', 'NA', 'SOL', 'WIND', 'GA', 'TE', 'CO',
+]
+CALL_SIGN_CHARS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+
+
+def _create_synthetic_ships(cursor, count):
+    """
+    Creates temporary co2emission_reduced and ship_identifiers tables of count
+    ships with the search indexes. They shadow the real tables (pg_temp comes
+    first in the search path) until the transaction ends.
+    """
+    cursor.execute('SELECT setseed(0.5)')
+    cursor.execute('''
+        CREATE TEMP TABLE co2emission_reduced (
+            imo BIGINT PRIMARY KEY,
+            ship_name VARCHAR(64),
+            type VARCHAR(64),
+            technical_efficiency_number DECIMAL(6, 2),
+            issue DATE,
+            expiry DATE
+        ) ON COMMIT DROP;
+    ''')
+    # Names of one or two words of two or three syllables and an optional number
+    syllable = f's[1 + floor(random() * {len(SYLLABLES)})::int]'
+    cursor.execute(f'''
+        INSERT INTO co2emission_reduced
+        SELECT
+            1000000 + i * (8999999 / %(count)s),
+            {syllable} || {syllable}
+                || CASE WHEN random() < 0.5 THEN {syllable} ELSE '' END
+                || CASE WHEN random() < 0.7 THEN ' ' || {syllable} || {syllable} ELSE '' END
+                || CASE WHEN random() < 0.3 THEN ' ' || floor(random() * 20)::int ELSE '' END,
+            'Bulk carrier', 5, DATE '2021-01-01', DATE '2022-01-01'
+        FROM generate_series(1, %(count)s) AS i, (SELECT %(syllables)s::text[] AS s) AS syllables;
+    ''', {'count': count, 'syllables': SYLLABLES})
+    cursor.execute(f'''
+        CREATE TEMP TABLE {search.IDENTIFIERS_TABLE} (
+            imo BIGINT PRIMARY KEY,
+            ship_key BIGINT NOT NULL,
+            call_sign VARCHAR(10),
+            mmsi BIGINT
+        ) ON COMMIT DROP;
+    ''')
+    char = f'substr(%(chars)s, 1 + floor(random() * {len(CALL_SIGN_CHARS)})::int, 1)'
+    cursor.execute(f'''
+        INSERT INTO {search.IDENTIFIERS_TABLE} (imo, ship_key, call_sign, mmsi)
+        SELECT imo, row_number() OVER (), {" || ".join([char] * 4)}, 200000000 + row_number() OVER () * 577
+        FROM co2emission_reduced;
+    ''', {'chars': CALL_SIGN_CHARS})
+    for table, statements in search.INDEXES.items():
+        for statement in statements:
+            cursor.execute(statement)
+    cursor.execute('ANALYZE co2emission_reduced')
+    cursor.execute(f'ANALYZE {search.IDENTIFIERS_TABLE}')
+
+
+def _typo(text):
+    # Swaps two neighbouring characters
+    i = random.randrange(len(text) - 1)
+    return text[:i] + text[i + 1] + text[i] + text[i + 2:]
+
+
+@suite('search', keys=['query'], metrics={'p50_ms': None, 'p95_ms': None})
+def ship_search(options):
+    """Latency of the ship search on a synthetic fleet of a million ships, by kind of query"""
+    random.seed(0)
+    rows = []
+    with transaction.atomic(), connections['default'].cursor() as cursor:
+        _create_synthetic_ships(cursor, SEARCH_SHIPS)
+        cursor.execute(f'''
+            SELECT e.ship_name, e.imo, i.call_sign, i.mmsi
+            FROM co2emission_reduced e TABLESAMPLE BERNOULLI (0.1)
+            JOIN {search.IDENTIFIERS_TABLE} i ON i.imo = e.imo
+            LIMIT 200
+        ''')
+        sample = cursor.fetchall()
+        queries = {
+            'name prefix 2-3': [name[:random.randint(2, 3)] for name, *_ in sample],
+            'name prefix 4-8': [name[:random.randint(4, 8)] for name, *_ in sample],
+            'name typo': [_typo(name) for name, *_ in sample],
+            'imo prefix': [str(imo)[:random.randint(3, 7)] for _, imo, *_ in sample],
+            'call sign': [call_sign[:random.randint(2, 4)] for *_, call_sign, _ in sample],
+            'mmsi prefix': [str(mmsi)[:random.randint(5, 9)] for *_, mmsi in sample],
+        }
+        for kind, kind_queries in queries.items():
+            samples = []
+            for _ in range(options['repeat']):
+                for query in kind_queries:
+                    start = time.perf_counter()
+                    results = search.search(cursor, query)
+                    samples.append(time.perf_counter() - start)
+            rows.append({
+                'query': kind,
+                'ships': SEARCH_SHIPS,
+                'p50_ms': percentile(samples, 50) * 1000,
+                'p95_ms': percentile(samples, 95) * 1000,
+                'last_results': len(results),
+            })
+        all_queries = [query for kind_queries in queries.values() for query in kind_queries]
+        # Everything typed again within SEARCH_CACHE_SEC, as with hot prefixes
+        for query in all_queries:
+            search.cached_search(query)
+        samples = []
+        for query in all_queries:
+            start = time.perf_counter()
+            search.cached_search(query)
+            samples.append(time.perf_counter() - start)
+        rows.append({
+            'query': 'cached',
+            'ships': SEARCH_SHIPS,
+            'p50_ms': percentile(samples, 50) * 1000,
+            'p95_ms': percentile(samples, 95) * 1000,
+            'last_results': None,
+        })
+        transaction.set_rollback(True)
+    return rows
+
+
+# View -> path of the pages of the views suite, {imo} filled in per request
+VIEW_PATHS = {
+    'emissions': '/emissions/',
+    'aggregation': '/aggregation/',
+    'emission_detail': '/emissions/imo/{imo}',
+    'visual_view': '/visual/',
+    'dashboard': '/dashboard/',
+    'extended_view': '/fuel_performance/',
+    'extended_view_graph2': '/verifiers_ranking/',
+    'extended_view_graph3': '/built_year_efficiency/',
+}
+# Timings of app.perf reported per request, in ms
+TIMINGS = list(perf.TIMING_METRICS)
+# Ships whose detail pages are requested in turn
+DETAIL_IMOS = 100
+
+
+def _view_rows(client, scale, repeat):
+    with connections['default'].cursor() as cursor:
+        cursor.execute('SELECT imo FROM co2emission_reduced ORDER BY random() LIMIT %s', [DETAIL_IMOS])
+        imos = [imo for imo, in cursor.fetchall()] or [0]
+
+    rows = []
+    for view, path in VIEW_PATHS.items():
+        for cache in ('cold', 'warm'):
+            # Fills the caches, and opens the connection, before the warm requests
+            client.get(path.format(imo=imos[0]))
+            latencies, sizes, statuses = [], [], set()
+            totals = {name: [] for name in ['queries', *TIMINGS]}
+            for i in range(repeat):
+                if cache == 'cold':
+                    caching.bump_data_version()
+                    caches[querycache.QUERY_CACHE].clear()
+                    imo = imos[i % len(imos)]
+                else:
+                    imo = imos[0]
+                # Including the queries and renders on the pools of the async views
+                with perf.recording() as recorder:
+                    start = time.perf_counter()
+                    response = client.get(path.format(imo=imo))
+                    latencies.append(time.perf_counter() - start)
+                totals['queries'].append(recorder.queries)
+                for name in TIMINGS:
+                    totals[name].append(recorder.timings[name] * 1000)
+                sizes.append(len(response.content))
+                statuses.add(response.status_code)
+            rows.append({
+                'scale': scale,
+                'view': view,
+                'cache': cache,
+                'status': ','.join(str(status) for status in sorted(statuses)),
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p95_ms': percentile(latencies, 95) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'queries': max(totals['queries']),
+                # Medians per request
+                **{f'{name}_ms': percentile(totals[name], 50) for name in TIMINGS},
+                'bytes': max(sizes),
+            })
+    return rows
+
+
+@suite('views', keys=['scale', 'view', 'cache'], metrics={
+    'p50_ms': None, 'p95_ms': None, 'p99_ms': None, 'queries': 0, 'db_ms': None,
+    'figure_ms': None, 'serialize_ms': None, 'template_ms': None, 'bytes': None,
+})
+def views(options):
+    """
+    Latency percentiles, queries, database, figure, serialization and template
+    time per request and response size of the pages, with cold and warm
+    caches. With --scales, the database is seeded by generate_fleet at each
+    scale first, which replaces its data.
+    """
+    client = Client()
+    return _at_scales(options, lambda scale: _view_rows(client, scale, options['repeat']))
+
+
+def _at_scales(options, measure):
+    """
+    Returns the rows of measure(scale) for each of --scales, the database
+    being seeded by generate_fleet at that scale first, or of measure(None)
+    on the data as it is
+    """
+    if not options['scales']:
+        return measure(None)
+
+    rows = []
+    for scale in options['scales']:
+        call_command(
+            'generate_fleet', scale=scale, seed=options['seed'], years=options['years'],
+            interactive=False, stdout=io.StringIO()
+        )
+        rows.extend(measure(scale))
+    return rows
+
+
+def _olap_rows(scale, repeat):
+    with connections['default'].cursor() as cursor:
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            engine = olap.Engine.load(cursor)
+            samples.append(time.perf_counter() - start)
+        facts = len(engine.facts['ship_key'])
+        rows = [{
+            'scale': scale, 'facts': facts, 'chart': 'load', 'y_axis': None,
+            'sql_ms': None, 'memory_ms': percentile(samples, 50) * 1000, 'speedup': None, 'equal': None,
+        }]
+
+        for view, y_axis in olap.CHARTS:
+            sql = olap.chart_sql(view, y_axis)
+            sql_samples, memory_samples = [], []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                expected = query_columns(cursor, sql)
+                sql_samples.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                actual = engine.chart_columns(view, y_axis)
+                memory_samples.append(time.perf_counter() - start)
+            sql_ms, memory_ms = percentile(sql_samples, 50) * 1000, percentile(memory_samples, 50) * 1000
+            rows.append({
+                'scale': scale, 'facts': facts, 'chart': view, 'y_axis': y_axis,
+                'sql_ms': sql_ms, 'memory_ms': memory_ms, 'speedup': sql_ms / memory_ms,
+                'equal': not olap.mismatched_columns(expected, actual),
+            })
+    return rows
+
+
+@suite('olap', keys=['scale', 'chart', 'y_axis'], metrics={'memory_ms': None})
+def olap_engine(options):
+    """
+    Load time of the in-memory analytics engine, and median time of each
+    chart from the tables with SQL and from the engine, whose results must be
+    equal. With --scales, the database is seeded by generate_fleet at each
+    scale first, which replaces its data.
+    """
+    return _at_scales(options, lambda scale: _olap_rows(scale, options['repeat']))
@@ -0,0 +1,216 @@
+"""
+Data version and rendered figure cache.
+
+The data version is the sum of the versions of the tables the pages read
+and of the data_version tag in cache_tag_versions (see app.querycache),
+which PostgreSQL increments atomically on every write to the tables and on
+bump_data_version, for writes the triggers do not see such as a refresh of
+the materialized views. Each process learns of them through the query
+cache's listener, and reads them while it is not listening. Anything derived
+from the data is cached under a key containing the version, so a write
+makes every stale entry unreachable in every process and no explicit
+eviction is needed.
+
+Misses are coalesced (single-flight): the first caller to take a lock in
+the cache builds the value while the others poll the cache for it, so a
+burst of requests after a bump runs the queries and renders once. The
+settings refuse a cache that is not shared by the workers, as each process
+would then build every figure itself. With
+revalidated_value the others, and the builder itself, are served the value
+of the previous version while it is rebuilt in the background.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import time
+import uuid
+from datetime import datetime, timezone
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.db import close_old_connections
+
+from app import concurrency, querycache
+
+logger = logging.getLogger(__name__)
+
+VERSION_CACHE = 'versions'
+# Tag of the writes that no table trigger sees
+DATA_TAG = 'data_version'
+DATA_MODIFIED_KEY = 'DATA-MODIFIED'
+FIGURE_CACHE_SEC = 24 * 60 * 60
+# How long the value of an older data version may be served while rebuilt
+STALE_CACHE_SEC = 7 * 24 * 60 * 60
+# A build holding the lock longer than this is taken over by another caller
+LOCK_SEC = 60
+WAIT_POLL_SEC = 0.05
+REFRESH_THREADS = 2
+
+
+def get_data_version():
+    """Returns the current data version"""
+    return sum(querycache.current_versions(querycache.TAGGED_TABLES + [DATA_TAG]).values())
+
+
+def get_data_modified():
+    """Returns when the data version last changed, as an aware datetime"""
+    versions = caches[VERSION_CACHE]
+    modified = versions.get(DATA_MODIFIED_KEY)
+    if modified is None:
+        versions.add(DATA_MODIFIED_KEY, time.time(), timeout=None)
+        modified = versions.get(DATA_MODIFIED_KEY)
+    return datetime.fromtimestamp(modified, timezone.utc)
+
+
+def bump_data_version():
+    """
+    Marks all data derived caches as stale, call after every write. Writes to
+    the tables bump it themselves once they commit, but only this process
+    sees them at once.
+    """
+    caches[VERSION_CACHE].set(DATA_MODIFIED_KEY, time.time(), timeout=None)
+    querycache.bump(DATA_TAG)
+    querycache.sync()
+    return get_data_version()
+
+
+def _digest(params):
+    params = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.md5(params.encode()).hexdigest()
+
+
+def params_key(prefix, params):
+    """Builds a cache key from a prefix, the data version and query parameters"""
+    return f'{prefix}-{get_data_version()}-{_digest(params)}'
+
+
+def _lock(key):
+    """Takes the build lock of key, returning its owner token or None if it is held"""
+    token = uuid.uuid4().hex
+    return token if cache.add(f'{key}-LOCK', token, timeout=LOCK_SEC) else None
+
+
+def _unlock(key, token):
+    # Unless it expired and another caller took it over
+    if cache.get(f'{key}-LOCK') == token:
+        cache.delete(f'{key}-LOCK')
+
+
+def _build(key, latest_key, build, timeout, token):
+    # Builds and stores the value under the lock taken for key, and as the
+    # latest value if it may be served stale later
+    try:
+        value = build()
+        cache.set(key, value, timeout=timeout)
+        if latest_key is not None:
+            cache.set(latest_key, value, timeout=STALE_CACHE_SEC)
+    finally:
+        _unlock(key, token)
+    return value
+
+
+def _refresh(key, latest_key, build, timeout, token):
+    try:
+        _build(key, latest_key, build, timeout, token)
+    except Exception:
+        logger.exception('Background refresh of %s failed', key)
+    finally:
+        # The refresh thread's connection, as at the end of a request
+        close_old_connections()
+
+
+def _wait(key):
+    """Polls for the value of the build holding the lock of key, None if it is gone"""
+    deadline = time.monotonic() + LOCK_SEC
+    while time.monotonic() < deadline:
+        time.sleep(WAIT_POLL_SEC)
+        value = cache.get(key)
+        if value is not None or cache.get(f'{key}-LOCK') is None:
+            return value
+    return None
+
+
+def _coalesced_value(prefix, params, build, timeout, stale):
+    digest = _digest(params)
+    key = f'{prefix}-{get_data_version()}-{digest}'
+    latest_key = f'{prefix}-LATEST-{digest}' if stale else None
+    while True:
+        value = cache.get(key)
+        if value is not None:
+            return value, False
+        previous = cache.get(latest_key) if stale else None
+        token = _lock(key)
+        if token is not None:
+            if previous is None:
+                return _build(key, latest_key, build, timeout, token), False
+            concurrency.executor('refresh', REFRESH_THREADS).submit(_refresh, key, latest_key, build, timeout, token)
+            return previous, True
+        if previous is not None:
+            return previous, True
+        value = _wait(key)
+        if value is not None:
+            return value, False
+        # The build failed or outlived its lock, take it over
+
+
+def cached_value(prefix, params, build, timeout=FIGURE_CACHE_SEC):
+    """
+    Returns the value cached under a prefix and query parameters for the
+    current data version, calling build() to compute it only if it is not.
+    Concurrent misses wait for the first one's build.
+    """
+    value, _ = _coalesced_value(prefix, params, build, timeout, stale=False)
+    return value
+
+
+def revalidated_value(prefix, params, build, timeout=FIGURE_CACHE_SEC):
+    """
+    cached_value, but on a miss returns the value of an earlier data version
+    if there is one while a background thread builds the current one.
+    Returns a tuple of the value and whether it is stale.
+    """
+    return _coalesced_value(prefix, params, build, timeout, stale=True)
+
+
+def cached_render(view, params, build):
+    """
+    Returns the rendered figures of a view for the given query parameters,
+    calling build() to query and render them only if they are not cached
+    for the current data version.
+    """
+    return cached_value(f'FIGURE-{settings.PLOTLY_JS_MODE}-{view}', params, build)
+
+
+def revalidated_render(view, params, build):
+    """cached_render with revalidated_value, returning the figures and whether they are stale"""
+    return revalidated_value(f'FIGURE-{settings.PLOTLY_JS_MODE}-{view}', params, build)
+
+
+async def acached_value(prefix, params, build, timeout=FIGURE_CACHE_SEC):
+    """cached_value for async views, build being a coroutine function"""
+    key = await sync_to_async(params_key)(prefix, params)
+    lock_key = f'{key}-LOCK'
+    while True:
+        value = await sync_to_async(cache.get)(key)
+        if value is not None:
+            return value
+        token = await sync_to_async(_lock)(key)
+        if token is not None:
+            try:
+                value = await build()
+                await sync_to_async(cache.set)(key, value, timeout=timeout)
+            finally:
+                await sync_to_async(_unlock)(key, token)
+            return value
+        deadline = time.monotonic() + LOCK_SEC
+        while time.monotonic() < deadline:
+            await asyncio.sleep(WAIT_POLL_SEC)
+            if await sync_to_async(cache.get)(lock_key) is None:
+                break
+
+
+async def acached_render(view, params, build):
+    """cached_render for async views, build being a coroutine function"""
+    return await acached_value(f'FIGURE-{settings.PLOTLY_JS_MODE}-{view}', params, build)
@@ -0,0 +1,199 @@
+"""
+EEDI compliance of every ship against the IMO reference lines
+(eda/eedibaseline.csv) and the phase reduction factors (eda/reduction.csv).
+
+The required EEDI of a ship is (1 - X / 100) * a * DWT ^ -c, where a and c
+come from the reference line of its ship type and X is the reduction factor
+of its phase and size band. Everything is computed with NumPy over the whole
+fleet at once, one array per column.
+
+Assumptions, as the star schema does not hold everything the regulation uses:
+ship_dimension.tonnage is taken as DWT, the phase follows the year built, and
+vehicle carriers use the DWT/GT >= 0.3 reference line as GT is unknown.
+"""
+import os
+import re
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+from app.utils import IteratorFile, csv_line, fetch_columns
+
+BASELINE_CSV = os.path.join(settings.BASE_DIR, 'eda', 'eedibaseline.csv')
+REDUCTION_CSV = os.path.join(settings.BASE_DIR, 'eda', 'reduction.csv')
+COMPLIANCE_TABLE = 'eedi_compliance'
+
+# First year of phases 0 to 3, ships built before 2013 have no requirement
+PHASE_START_YEARS = [2013, 2015, 2020, 2025]
+
+# MRV ship type -> reference line ship type (lower case)
+SHIP_TYPE_CATEGORIES = {
+    'Bulk carrier': 'bulk carrier',
+    'Oil tanker': 'tanker',
+    'Chemical tanker': 'tanker',
+    'Container ship': 'container ship',
+    'Gas carrier': 'gas carrier',
+    'General cargo ship': 'general cargo ship',
+    'Vehicle carrier': 'ro-ro cargo ship (vehicle carrier)',
+    'LNG carrier': 'lng carrier',
+    'Passenger ship': 'cruise passenger ship having non-conventional propulsion',
+    'Ro-ro ship': 'ro-ro cargo ship',
+    'Container/ro-ro cargo ship': 'ro-ro cargo ship',
+    'Refrigerated cargo carrier': 'refrigerated cargo carrier',
+    'Ro-pax ship': 'ro-ro passenger ship',
+    'Combination carrier': 'combination carrier',
+}
+
+COMPLIANCE_COLUMNS = [
+    'imo', 'ship_key', 'ship_type', 'dwt', 'year_built', 'attained_eedi',
+    'reference_eedi', 'required_eedi', 'ratio', 'phase', 'highest_phase_met', 'compliant',
+]
+
+
+def _category(name):
+    name = re.sub(r'\*', '', name)
+    name = re.sub(r'\s+', ' ', name).strip().lower()
+    return 'general cargo ship' if name == 'general cargo ships' else name
+
+
+def _number(text):
+    return float(text.replace(',', ''))
+
+
+def load_reference_lines(path=BASELINE_CSV):
+    """Returns a DataFrame of a and c per category"""
+    lines = pd.read_csv(path, encoding='utf-8-sig', dtype=str)
+    lines.columns = ['ship_type', 'a', 'b', 'c']
+    # Formula rows that need GT (e.g. small vehicle carriers) have no plain a
+    lines['a'] = lines['a'].str.extract(r'^\s*([\d.]+)', expand=False).astype(float)
+    lines = lines.dropna(subset=['a'])
+    lines['category'] = lines['ship_type'].map(_category)
+    lines['c'] = lines['c'].astype(float)
+    return lines.drop_duplicates('category')[['category', 'a', 'c']].reset_index(drop=True)
+
+
+def load_reduction_bands(path=REDUCTION_CSV):
+    """
+    Returns a DataFrame of size bands per category: the lower and upper size
+    of the band, and per phase the reduction factor and whether it is
+    interpolated from 0 over the band ('0-10*'), or NaN if not applicable.
+    """
+    bands = pd.read_csv(path, encoding='utf-8-sig', dtype=str, keep_default_na=False)
+    bands.columns = ['ship_type', 'size', 'phase0', 'phase1', 'phase2', 'phase3']
+    rows = []
+    for band in bands.itertuples(index=False):
+        sizes = [_number(size) for size in re.findall(r'[\d,]+\d', band.size)]
+        row = {
+            'category': _category(band.ship_type),
+            'lower': sizes[0],
+            'upper': sizes[1] if len(sizes) > 1 else np.inf,
+        }
+        for phase in range(4):
+            value = getattr(band, f'phase{phase}')
+            factors = re.findall(r'\d+', value.split(',')[0])
+            row[f'x{phase}'] = float(factors[-1]) if factors else np.nan
+            row[f'interpolate{phase}'] = '-' in value
+        rows.append(row)
+
+    # 'x DWT and above' of a smaller band ends where the next band starts
+    bands = pd.DataFrame(rows).sort_values(['category', 'lower'])
+    next_lower = bands.groupby('category')['lower'].shift(-1).fillna(np.inf)
+    bands['upper'] = np.minimum(bands['upper'], next_lower)
+    return bands.reset_index(drop=True)
+
+
+def evaluate(ships, reference_lines=None, bands=None):
+    """
+    Evaluates the compliance of ships, a DataFrame with the columns ship_type,
+    dwt, year_built and attained_eedi. Returns a copy with the columns
+    reference_eedi, required_eedi, ratio, phase, highest_phase_met and
+    compliant added. Ships without a reference line or size band get NaN,
+    ships built before phase 0 get no phase and compliant None.
+    """
+    if reference_lines is None:
+        reference_lines = load_reference_lines()
+    if bands is None:
+        bands = load_reduction_bands()
+
+    ships = ships.copy()
+    n = len(ships)
+    categories = ships['ship_type'].map(SHIP_TYPE_CATEGORIES)
+    dwt = ships['dwt'].to_numpy(dtype=float)
+    attained = ships['attained_eedi'].to_numpy(dtype=float)
+
+    lines = reference_lines.set_index('category')
+    a = categories.map(lines['a']).to_numpy(dtype=float)
+    c = categories.map(lines['c']).to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        reference = a * np.power(dwt, -c)
+
+    # Reduction factor per ship and phase, from the band its size falls in
+    reduction = np.full((n, 4), np.nan)
+    category_values = categories.to_numpy()
+    for band in bands.itertuples(index=False):
+        in_band = (category_values == band.category) & (dwt >= band.lower) & (dwt < band.upper)
+        if not in_band.any():
+            continue
+        # Share of the band's size range, for the interpolated factors
+        if np.isfinite(band.upper):
+            share = (dwt[in_band] - band.lower) / (band.upper - band.lower)
+        else:
+            share = np.ones(in_band.sum())
+        for phase in range(4):
+            factor = getattr(band, f'x{phase}')
+            if getattr(band, f'interpolate{phase}'):
+                reduction[in_band, phase] = factor * share
+            else:
+                reduction[in_band, phase] = factor
+
+    required_by_phase = reference[:, None] * (1 - reduction / 100)
+    phase = np.searchsorted(PHASE_START_YEARS, ships['year_built'].to_numpy(), side='right') - 1
+    regulated = phase >= 0
+    required = np.where(
+        regulated, required_by_phase[np.arange(n), np.clip(phase, 0, 3)], np.nan
+    )
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        met = attained[:, None] <= required_by_phase
+        ratio = attained / required
+    # Highest phase whose requirement the ship meets, -1 for none
+    highest_met = np.where(met.any(axis=1), 3 - np.argmax(met[:, ::-1], axis=1), -1)
+
+    ships['reference_eedi'] = reference
+    ships['required_eedi'] = required
+    ships['ratio'] = ratio
+    ships['phase'] = np.where(regulated, phase, -1)
+    ships['highest_phase_met'] = highest_met
+    ships['compliant'] = np.where(
+        regulated & np.isfinite(ratio), ratio <= 1, None
+    )
+    return ships
+
+
+def fetch_ships(cursor):
+    """Returns the latest attained EEDI and particulars of every ship in the star schema"""
+    cursor.execute('''
+        SELECT DISTINCT ON (f.imo) f.imo, s.ship_key, s.ship_type,
+            s.tonnage AS dwt, s.year_built, f.eedi AS attained_eedi
+        FROM fact_table f, ship_dimension s
+        WHERE f.ship_key = s.ship_key
+        ORDER BY f.imo, f.issue_date_key DESC
+    ''')
+    return pd.DataFrame(fetch_columns(cursor))
+
+
+def _nullable(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    return value
+
+
+def store(cursor, results):
+    """Replaces the contents of the compliance table with results"""
+    cursor.execute(f'DELETE FROM {COMPLIANCE_TABLE};')
+    rows = results[COMPLIANCE_COLUMNS].itertuples(index=False)
+    cursor.copy_expert(
+        f'COPY {COMPLIANCE_TABLE} ({", ".join(COMPLIANCE_COLUMNS)}) FROM STDIN WITH (FORMAT csv)',
+        IteratorFile(csv_line([_nullable(val) for val in row]) for row in rows)
+    )
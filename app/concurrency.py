@@ -0,0 +1,80 @@
+"""
+Thread pools for the blocking work of the async views, so that a view can
+await independent queries and figure renders at once and take as long as the
+slowest of them rather than their sum.
+
+Each query runs on a thread of the query pool with that thread's database
+connection, which is closed or kept at the end of the query like at the end
+of a request (see DB_CONN_MODE), so the pool holds at most
+ASYNC_QUERY_THREADS connections. Figures are rendered on the render pool.
+
+Execute wrappers installed with instrument() see the queries of the query
+pool too, as connections belong to a thread and the pool's are not the
+caller's.
+"""
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+_executors = {}
+_executors_lock = threading.Lock()
+_execute_wrappers = contextvars.ContextVar('execute_wrappers', default=())
+
+
+def executor(name, max_workers):
+    """Returns the named thread pool, created on first use"""
+    if name not in _executors:
+        with _executors_lock:
+            if name not in _executors:
+                _executors[name] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+    return _executors[name]
+
+
+@contextmanager
+def instrument(wrapper):
+    """
+    Installs an execute wrapper (see connection.execute_wrapper) on the
+    current thread's connection and, for the current context, on those of the
+    query pool.
+    """
+    token = _execute_wrappers.set(_execute_wrappers.get() + (wrapper,))
+    try:
+        with connections['default'].execute_wrapper(wrapper):
+            yield
+    finally:
+        _execute_wrappers.reset(token)
+
+
+def _run_query(func, *args):
+    try:
+        with ExitStack() as stack:
+            for wrapper in _execute_wrappers.get():
+                stack.enter_context(connections['default'].execute_wrapper(wrapper))
+            with connections['default'].cursor() as cursor:
+                return func(cursor, *args)
+    finally:
+        close_old_connections()
+
+
+async def query(func, *args):
+    """Runs func(cursor, *args) on the query pool and returns its result"""
+    loop = asyncio.get_running_loop()
+    pool = executor('query', settings.ASYNC_QUERY_THREADS)
+    # In the caller's context, for the execute wrappers
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(pool, functools.partial(context.run, _run_query, func, *args))
+
+
+async def render(func, *args):
+    """Runs func(*args) on the render pool and returns its result"""
+    loop = asyncio.get_running_loop()
+    pool = executor('render', settings.ASYNC_RENDER_THREADS)
+    # In the caller's context, for the timings of app.perf
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(pool, functools.partial(context.run, func, *args))
@@ -0,0 +1,11 @@
+from django.conf import settings
+
+from app.figures import STATIC, PLOTLY_JS_STATIC_PATH
+
+
+def plotly(request):
+    """Tells templates whether to load the shared plotly.js bundle"""
+    return {
+        'plotly_js_static': settings.PLOTLY_JS_MODE == STATIC,
+        'plotly_js_path': PLOTLY_JS_STATIC_PATH,
+    }
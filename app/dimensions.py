@@ -0,0 +1,75 @@
+"""
+Distinct values of the dimensions that forms suggest and filters offer: ship
+types, verifiers, engine types and years built.
+
+They are read from the star-schema dimension tables (and type_summary for
+ship types only found in co2emission_reduced), never from the fact tables,
+and kept in the 'dimensions' cache, which is shared by all worker processes.
+Writes through the app patch the cached values (see add_values and
+invalidate), so they do not go stale until the cache timeout.
+"""
+from django.core.cache import caches
+from django.db import connections
+
+from app.aggregates import SUMMARY_TABLE
+
+DIMENSIONS_CACHE = 'dimensions'
+DIMENSION_CACHE_SEC = 24 * 60 * 60
+
+# Dimension -> (table, query of its distinct values) for each table it is read from
+DIMENSIONS = {
+    'ship_type': [
+        ('ship_dimension', 'SELECT DISTINCT ship_type FROM ship_dimension'),
+        (SUMMARY_TABLE, f'SELECT type FROM {SUMMARY_TABLE}'),
+    ],
+    'verifier': [('verifiers', 'SELECT verifier_name FROM verifiers')],
+    'engine_type': [('ship_dimension', 'SELECT DISTINCT engine_type FROM ship_dimension')],
+    'year_built': [('ship_dimension', 'SELECT DISTINCT year_built FROM ship_dimension')],
+}
+
+
+def _key(dimension):
+    return f'{dimension}-VALUES'
+
+
+def query_values(cursor, dimension):
+    """Returns the sorted distinct values of a dimension, from the tables that exist"""
+    values = set()
+    for table, sql in DIMENSIONS[dimension]:
+        cursor.execute('SELECT to_regclass(%s)', [table])
+        if cursor.fetchone()[0] is None:
+            continue
+        cursor.execute(sql)
+        values.update(row[0] for row in cursor.fetchall())
+    values.discard(None)
+    return sorted(values)
+
+
+def get_values(dimension):
+    """Returns the sorted distinct values of a dimension, from the cache if possible"""
+    cache = caches[DIMENSIONS_CACHE]
+    values = cache.get(_key(dimension))
+    if values is None:
+        with connections['default'].cursor() as cursor:
+            values = query_values(cursor, dimension)
+        cache.set(_key(dimension), values, timeout=DIMENSION_CACHE_SEC)
+    return values
+
+
+def ship_types():
+    return get_values('ship_type')
+
+
+def add_values(dimension, values):
+    """Patches values written to the database into the cached values of a dimension"""
+    cache = caches[DIMENSIONS_CACHE]
+    cached = cache.get(_key(dimension))
+    new = set(values) - {None}
+    if cached is None or new.issubset(cached):
+        return
+    cache.set(_key(dimension), sorted(new.union(cached)), timeout=DIMENSION_CACHE_SEC)
+
+
+def invalidate(*dimensions):
+    """Drops the cached values of dimensions, or of all of them, to be read again"""
+    caches[DIMENSIONS_CACHE].delete_many([_key(dimension) for dimension in dimensions or DIMENSIONS])
@@ -0,0 +1,126 @@
+"""
+Streaming exports of the emissions table and the analytics queries, as CSV,
+Parquet or an Arrow IPC stream.
+
+Rows are read from a server-side cursor EXPORT_BATCH_SIZE at a time, and each
+batch is encoded and sent before the next one is fetched, so a worker holds a
+single batch whatever the size of the export. Parquet and Arrow need pyarrow,
+which is only imported for them.
+"""
+import csv
+import io
+
+import psycopg2.extensions
+
+from app.utils import NUMERIC_AS_FLOAT, streaming_cursor
+
+EXPORT_BATCH_SIZE = 10000
+
+# Format -> (content type, file extension)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+}
+
+# PostgreSQL type OID -> pyarrow type name, anything else is exported as text
+ARROW_TYPES = {
+    16: 'bool_',
+    20: 'int64', 21: 'int64', 23: 'int64',
+    700: 'float64', 701: 'float64', 1700: 'float64',
+    1082: 'date32',
+}
+
+
+def fetch_batches(sql, params=None, size=EXPORT_BATCH_SIZE):
+    """
+    Yields the result of a query as (description, rows) batches of up to size
+    rows, the first one even if the result is empty. NUMERIC comes back as float.
+    """
+    with streaming_cursor() as cursor:
+        psycopg2.extensions.register_type(NUMERIC_AS_FLOAT, cursor.cursor)
+        cursor.execute(sql, params)
+        rows = cursor.fetchmany(size)
+        # A server-side cursor only has a description after the first fetch
+        description = cursor.description
+        yield description, rows
+        while len(rows) == size:
+            rows = cursor.fetchmany(size)
+            if rows:
+                yield description, rows
+
+
+def csv_chunks(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for i, (description, rows) in enumerate(batches):
+        if i == 0:
+            writer.writerow(col[0] for col in description)
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+class _ChunkSink:
+    """Write-only file that keeps what pyarrow wrote until it is drained"""
+
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def arrow_chunks(batches, file_format):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    sink, writer, schema = _ChunkSink(), None, None
+    for description, rows in batches:
+        if writer is None:
+            schema = pa.schema([
+                (col[0], getattr(pa, ARROW_TYPES.get(col[1], 'string'))()) for col in description
+            ])
+            if file_format == 'parquet':
+                writer = pq.ParquetWriter(sink, schema)
+            else:
+                writer = pa.ipc.new_stream(sink, schema)
+        columns = list(zip(*rows)) or [()] * len(schema)
+        batch = pa.record_batch(
+            [pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+            schema=schema
+        )
+        writer.write_batch(batch)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def stream(file_format, sql, params=None):
+    """Returns an iterator over the encoded chunks of a query's result"""
+    batches = fetch_batches(sql, params)
+    if file_format == 'csv':
+        return csv_chunks(batches)
+    return arrow_chunks(batches, file_format)
+
+
+def pyarrow_installed():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
@@ -0,0 +1,72 @@
+"""
+Turns Plotly figures into HTML for the templates.
+
+With PLOTLY_JS_MODE = 'inline' every figure is rendered by plotly.offline.plot
+and carries its own copy of plotly.js. With 'static' (the default), plotly.js
+is served once as a static file (see app.finders) and figures are emitted as
+JSON specs that the bootstrap script in visual.html draws. Numeric NumPy
+arrays in the specs are sent base64 encoded as {"dtype", "bdata"}, which the
+bootstrap turns into typed arrays.
+"""
+import base64
+import uuid
+
+import numpy as np
+
+import plotly.io as pio
+from django.conf import settings
+from plotly.offline import plot
+from plotly.tools import return_figure_from_figure_or_data
+
+from app import perf
+
+INLINE = 'inline'
+STATIC = 'static'
+PLOTLY_JS_STATIC_PATH = 'plotly/plotly.min.js'
+
+# Same config plot() uses for its divs
+FIGURE_CONFIG = {'showLink': False}
+
+
+def encode_arrays(value):
+    """
+    Replaces the numeric NumPy arrays in a figure dict by their little-endian
+    bytes in base64, the typed array spec of plotly.py 6. Other arrays become
+    lists.
+    """
+    if isinstance(value, dict):
+        return {key: encode_arrays(val) for key, val in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode_arrays(val) for val in value]
+    if not isinstance(value, np.ndarray):
+        return value
+    if value.ndim != 1 or value.dtype.kind not in 'iuf':
+        return value.tolist()
+    if value.dtype.kind in 'iu' and value.dtype.itemsize == 8:
+        # JavaScript has no 64 bit typed arrays for numbers
+        fits = value.size == 0 or np.iinfo(np.int32).min <= value.min() <= value.max() <= np.iinfo(np.int32).max
+        value = value.astype(np.int32 if fits else np.float64)
+    value = value.astype(value.dtype.newbyteorder('<'), copy=False)
+    return {
+        'dtype': f'{value.dtype.kind}{value.dtype.itemsize}',
+        'bdata': base64.b64encode(value.tobytes()).decode(),
+    }
+
+
+@perf.timed('serialize')
+def figure_div(figure):
+    """Returns the HTML for a figure, in the configured plotly.js mode"""
+    if settings.PLOTLY_JS_MODE == INLINE:
+        return plot(figure, output_type='div')
+
+    figure = return_figure_from_figure_or_data(figure, True)
+    figure = encode_arrays(figure)
+    figure['config'] = FIGURE_CONFIG
+    spec = pio.to_json(figure, validate=False)
+    # The spec sits in a <script> tag, which must not be closed early
+    spec = spec.replace('</', '<\\/')
+    div_id = str(uuid.uuid4())
+    return (
+        f'<div id="{div_id}" class="plotly-graph-div"></div>'
+        f'<script type="application/json" data-plotly-figure="{div_id}">{spec}</script>'
+    )
@@ -0,0 +1,35 @@
+import os
+
+import plotly
+from django.contrib.staticfiles.finders import BaseFinder
+from django.core.files.storage import FileSystemStorage
+
+from app.figures import PLOTLY_JS_STATIC_PATH
+
+
+class PlotlyJsFinder(BaseFinder):
+    """
+    Exposes the plotly.js bundle shipped with the plotly package as a static
+    file, so collectstatic gives it a hashed name and whitenoise serves it
+    compressed and cached, in the same version as the installed plotly.
+    """
+    prefix, name = os.path.split(PLOTLY_JS_STATIC_PATH)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.storage = FileSystemStorage(
+            location=os.path.join(os.path.dirname(plotly.__file__), 'package_data')
+        )
+        self.storage.prefix = self.prefix
+
+    def check(self, **kwargs):
+        return []
+
+    def find(self, path, all=False):
+        if path != PLOTLY_JS_STATIC_PATH:
+            return []
+        match = self.storage.path(self.name)
+        return [match] if all else match
+
+    def list(self, ignore_patterns):
+        yield self.name, self.storage
@@ -0,0 +1,418 @@
+"""
+Synthetic fleets for scale testing, generated with
+`python manage.py generate_fleet --scale N`.
+
+A fleet of N times the ships of eda/ship_dimension.csv is drawn by resampling
+the ships of the CSV together with their facts (eda/facttable.csv), so that
+the particulars, verifier and metrics of a synthetic ship keep the joint
+distribution of a real one, and jittering the continuous values. Every ship
+gets a fact per reporting year and a row in co2emission_reduced with its
+latest DoC, which also gets N times the rows of df_eedi_agg.csv that have no
+facts. Verifiers grow with the square root of the scale, as a larger fleet is
+still verified by a handful of companies.
+
+Ships are drawn CHUNK_SHIPS at a time from random generators seeded by the
+seed and the chunk, so the data only depends on the seed and memory does not
+grow with the scale. Rows are written with binary COPY, and facts a year at a
+time so that their date keys follow the physical order like loaded MRV years.
+"""
+import io
+import math
+import os
+import re
+import struct
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+from app import schema, search
+from app.mrv import insert_dates_sql
+
+SHIPS_CSV = os.path.join(settings.BASE_DIR, 'eda', 'ship_dimension.csv')
+FACTS_CSV = os.path.join(settings.BASE_DIR, 'eda', 'facttable.csv')
+VERIFIERS_CSV = os.path.join(settings.BASE_DIR, 'eda', 'verifiers.csv')
+EMISSIONS_CSV = os.path.join(settings.BASE_DIR, 'df_eedi_agg.csv')
+
+CHUNK_SHIPS = 250000
+# First IMO number of the fleet, the lowest that ImoForm accepts
+FIRST_IMO = 1111111
+LAST_IMO = 9999999
+# MMSIs of real ships start with a 2-7 country digit, these cannot clash
+FIRST_MMSI = 100000000
+CALL_SIGN_CHARS = b'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+# Share of 5 character call signs, as in eda/generate random ship dimension.ipynb
+LONG_CALL_SIGN_SHARE = 0.35
+# Standard deviations of the log-normal noise on particulars and metrics
+PARTICULARS_NOISE = 0.05
+METRICS_NOISE = 0.1
+EEDI_NOISE = 0.05
+DATE_JITTER_DAYS = 14
+
+TABLES = ['fact_table', 'co2emission_reduced', 'ship_dimension', 'verifiers', 'd_date']
+# Column -> binary COPY type (see copy_binary) of the tables written
+VERIFIER_TYPES = {
+    'verifier_key': '>i8',
+    'verifier_name': 'text',
+    'verifier_number': 'text',
+    'verifier_nab': 'text',
+    'verifier_address': 'text',
+    'verifier_city': 'text',
+    'verifier_country': 'text',
+}
+SHIP_TYPES = {
+    'ship_key': '>i8',
+    'ship_name': 'text',
+    'ship_type': 'text',
+    'call_sign': 'text',
+    'speed': '>f4',
+    'year_built': '>i4',
+    'length': '>f4',
+    'width': '>f4',
+    'tonnage': '>f4',
+    'engine_type': 'text',
+    'mmsi': '>i8',
+}
+FACT_TYPES = {
+    'imo': '>i8',
+    'fuel_consumption': '>f4',
+    'sea_time': '>f4',
+    'co2_distance': '>f4',
+    'co2_transport': '>f4',
+    'eedi': '>f4',
+    'verifier_key': '>i8',
+    'ship_key': '>i8',
+    'issue_date_key': '>i8',
+    'expiry_date_key': '>i8',
+}
+EMISSION_TYPES = {
+    'imo': '>i8',
+    'ship_name': 'text',
+    'type': 'text',
+    'technical_efficiency_number': '>f4',
+    'issue': 'date',
+    'expiry': 'date',
+}
+METRICS = ['fuel_consumption', 'sea_time', 'co2_distance', 'co2_transport']
+
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+COPY_TRAILER = struct.pack('>h', -1)
+POSTGRES_EPOCH = np.datetime64('2000-01-01', 'D')
+
+
+def read_samples():
+    """
+    Returns the rows to resample: the ships joined to their facts, the
+    verifiers, and the emissions of ships without facts
+    """
+    ships = pd.read_csv(SHIPS_CSV, index_col=0)
+    facts = pd.read_csv(FACTS_CSV).rename(columns={'EEDI': 'eedi'})
+    fleet = ships.merge(facts, on='ship_key').sort_values('ship_key', ignore_index=True)
+    fleet['issue'] = pd.to_datetime(fleet['issue_date_key'].astype(str), format='%Y%m%d')
+
+    verifiers = pd.read_csv(VERIFIERS_CSV)
+    verifiers.columns = list(VERIFIER_TYPES)
+
+    emissions = pd.read_csv(EMISSIONS_CSV, parse_dates=['issue', 'expiry'])
+    emissions = emissions[~emissions['imo'].isin(facts['imo'])].reset_index(drop=True)
+    return fleet, verifiers, emissions
+
+
+def date_keys(dates):
+    """d_date keys of a datetime64[D] array, e.g. 20210430"""
+    months = dates.astype('M8[M]')
+    years = months.astype('M8[Y]').astype(np.int64) + 1970
+    return (
+        years * 10000
+        + (months.astype(np.int64) % 12 + 1) * 100
+        + (dates - months.astype('M8[D]')).astype(np.int64) + 1
+    )
+
+
+def key_dates(keys):
+    """datetime64[D] array of d_date keys, the inverse of date_keys"""
+    keys = np.asarray(keys, dtype=np.int64)
+    months = ((keys // 10000 - 1970) * 12 + keys // 100 % 100 - 1).astype('M8[M]')
+    return months.astype('M8[D]') + (keys % 100 - 1)
+
+
+def encode(values):
+    """UTF-8 encodes strings into a NumPy bytes array"""
+    return pd.Series(values).str.encode('utf-8').to_numpy().astype('S')
+
+
+def numbered(names, numbers):
+    """
+    Appends ' <number>' to the names of a bytes array where number > 0, by
+    writing the digits after the end of each name in a byte matrix. The
+    names of the CSVs have up to 32 bytes, so they stay within VARCHAR(64).
+    """
+    names, numbers = np.asarray(names), np.asarray(numbers)
+    size, width = len(names), names.dtype.itemsize
+    digits = numbers.astype('S')
+    digit_width = digits.dtype.itemsize
+    matrix = np.zeros((size, width + 1 + digit_width), dtype=np.uint8)
+    matrix[:, :width] = names.view(np.uint8).reshape(size, width)
+    rows = np.flatnonzero(numbers > 0)
+    ends = np.char.str_len(names[rows])
+    matrix[rows, ends] = ord(' ')
+    matrix[rows[:, None], ends[:, None] + 1 + np.arange(digit_width)] = (
+        digits[rows].view(np.uint8).reshape(len(rows), digit_width)
+    )
+    return matrix.view(f'S{matrix.shape[1]}').ravel()
+
+
+def call_signs(rng, size):
+    """Random 4 or 5 character call signs, as bytes"""
+    chars = np.frombuffer(CALL_SIGN_CHARS + b'\x00', dtype='S1')
+    picks = rng.integers(0, len(CALL_SIGN_CHARS), (size, 5))
+    # A trailing NUL is dropped by the S5 view, which shortens the call sign
+    picks[:, 4] = np.where(rng.random(size) < LONG_CALL_SIGN_SHARE, picks[:, 4], len(CALL_SIGN_CHARS))
+    return chars[picks].view('S5').ravel()
+
+
+def _binary_values(values, pg_type):
+    """Returns the values of a column as a NumPy type for binary COPY, and their byte lengths"""
+    values = np.asarray(values)
+    if pg_type == 'text':
+        if values.dtype.kind != 'S':
+            values = encode(values)
+        if values.dtype.itemsize == 0:
+            values = values.astype('S1')
+        return values, np.char.str_len(values)
+    if pg_type == 'date':
+        values = (values.astype('M8[D]') - POSTGRES_EPOCH).astype(np.int64)
+        pg_type = '>i4'
+    width = np.dtype(pg_type).itemsize
+    null = np.isnan(values) if values.dtype.kind == 'f' else np.zeros(len(values), dtype=bool)
+    return values.astype(pg_type), np.where(null, -1, width)
+
+
+def copy_binary(cursor, table, columns, types):
+    """
+    Writes the columns of a DataFrame or dict of arrays to a table with
+    COPY ... (FORMAT binary), types mapping each column to a big-endian NumPy
+    type, 'text' or 'date', and NaN becoming NULL. The rows are laid out in a
+    structured array with a fixed width per field, whose bytes past the
+    length of each text or NULL value are then dropped.
+    """
+    encoded = [_binary_values(columns[col], pg_type) for col, pg_type in types.items()]
+    size = len(encoded[0][0])
+    fields = [('count', '>i2')]
+    for i, (values, lengths) in enumerate(encoded):
+        fields += [(f'length{i}', '>i4'), (f'value{i}', values.dtype)]
+    rows = np.empty(size, dtype=fields)
+    rows['count'] = len(types)
+    keep = None
+    for i, (values, lengths) in enumerate(encoded):
+        rows[f'length{i}'] = lengths
+        rows[f'value{i}'] = values
+        width = values.dtype.itemsize
+        if (lengths < width).any():
+            if keep is None:
+                keep = np.ones((size, rows.dtype.itemsize), dtype=bool)
+            offset = rows.dtype.fields[f'value{i}'][1]
+            keep[:, offset:offset + width] = np.arange(width) < lengths[:, None]
+    data = rows.tobytes() if keep is None else rows.view(np.uint8).reshape(size, -1)[keep].tobytes()
+    cursor.copy_expert(
+        f'COPY {table} ({", ".join(types)}) FROM STDIN WITH (FORMAT binary)',
+        io.BytesIO(COPY_HEADER + data + COPY_TRAILER)
+    )
+
+
+def secondary_indexes():
+    """{index: statement} of the indexes of the tables written, besides their keys"""
+    statements = list(schema.INDEXES.values()) + search.INDEXES['co2emission_reduced']
+    return {
+        re.search(r'INDEX IF NOT EXISTS (\w+)', statement).group(1): statement
+        for statement in statements
+    }
+
+
+class FleetGenerator:
+    """Generates a fleet of scale times the ships of the CSVs from a seed"""
+
+    def __init__(self, cursor, scale=1, seed=0, years=1):
+        self.cursor = cursor
+        self.seed = seed
+        self.years = years
+        self.fleet, self.base_verifiers, self.base_emissions = read_samples()
+        # Text columns encoded once, for the draws to take their bytes
+        self.fleet_text = {col: encode(self.fleet[col]) for col in ('ship_name', 'ship_type', 'engine_type')}
+        self.emission_text = {col: encode(self.base_emissions[col]) for col in ('ship_name', 'type')}
+        self.ship_count = round(len(self.fleet) * scale)
+        self.extra_count = round(len(self.base_emissions) * scale)
+        self.verifier_copies = max(1, math.ceil(math.sqrt(scale)))
+        if FIRST_IMO + self.ship_count + self.extra_count - 1 > LAST_IMO:
+            raise ValueError(
+                f'{self.ship_count + self.extra_count} ships do not fit in the 7 digit IMO '
+                f'numbers, lower the scale and raise the years instead'
+            )
+        self.stats = {'ships': 0, 'facts': 0, 'emissions': 0, 'verifiers': 0, 'dates': 0}
+        self.first_date = self.last_date = None
+
+    def chunks(self):
+        return range(math.ceil(self.ship_count / CHUNK_SHIPS))
+
+    def rng(self, *keys):
+        return np.random.default_rng([self.seed, *keys])
+
+    def verifiers(self):
+        copies = np.repeat(np.arange(self.verifier_copies), len(self.base_verifiers))
+        frame = pd.concat([self.base_verifiers] * self.verifier_copies, ignore_index=True)
+        frame['verifier_key'] += copies * len(self.base_verifiers)
+        columns = {col: frame[col].to_numpy() for col in VERIFIER_TYPES}
+        for col in ('verifier_name', 'verifier_number'):
+            columns[col] = numbered(encode(frame[col]), copies)
+        return columns
+
+    def draws(self, chunk):
+        """
+        Returns the rows of the fleet the ships of a chunk are drawn from,
+        with the ship key, IMO and verifier key of the ships
+        """
+        rng = self.rng(chunk)
+        start = chunk * CHUNK_SHIPS
+        keys = np.arange(start, min(start + CHUNK_SHIPS, self.ship_count))
+        samples = rng.integers(0, len(self.fleet), len(keys))
+        drawn = self.fleet.iloc[samples].reset_index(drop=True)
+        drawn['sample'] = samples
+        drawn['ship_key'] = keys
+        drawn['imo'] = FIRST_IMO + keys
+        drawn['verifier_key'] += len(self.base_verifiers) * rng.integers(0, self.verifier_copies, len(keys))
+        return drawn
+
+    def ships(self, drawn, chunk):
+        """ship_dimension rows of the ships of a chunk, as arrays"""
+        rng = self.rng(chunk, 0)
+        size = len(drawn)
+        keys = drawn['ship_key'].to_numpy()
+        text = {col: values[drawn['sample'].to_numpy()] for col, values in self.fleet_text.items()}
+
+        def jitter(col):
+            return np.round(drawn[col].to_numpy() * rng.lognormal(0, PARTICULARS_NOISE, size))
+
+        return {
+            'ship_key': keys,
+            'ship_name': numbered(text['ship_name'], keys // len(self.fleet)),
+            'ship_type': text['ship_type'],
+            'call_sign': call_signs(rng, size),
+            'speed': np.maximum(drawn['speed'].to_numpy() + rng.integers(-1, 2, size), 1),
+            'year_built': np.minimum(drawn['year_built'].to_numpy() + rng.integers(-2, 3, size),
+                                     drawn['issue'].dt.year.to_numpy()),
+            'length': jitter('length'),
+            'width': jitter('width'),
+            'tonnage': jitter('tonnage'),
+            'engine_type': text['engine_type'],
+            'mmsi': FIRST_MMSI + keys,
+        }
+
+    def facts(self, drawn, chunk, year):
+        """Facts of the ships of a chunk, year years before those of the CSV, as arrays"""
+        rng = self.rng(chunk, year + 1)
+        size = len(drawn)
+        issue = drawn['issue'].to_numpy().astype('M8[D]')
+        year_start = issue.astype('M8[Y]')
+        jittered = np.clip(
+            issue + rng.integers(-DATE_JITTER_DAYS, DATE_JITTER_DAYS + 1, size),
+            year_start.astype('M8[D]'), (year_start + 1).astype('M8[D]') - 1
+        )
+        return {
+            'imo': drawn['imo'].to_numpy(),
+            **{
+                col: np.round(drawn[col].to_numpy() * rng.lognormal(0, METRICS_NOISE, size), 2)
+                for col in METRICS
+            },
+            'eedi': np.round(drawn['eedi'].to_numpy() * rng.lognormal(0, EEDI_NOISE, size), 2),
+            'verifier_key': drawn['verifier_key'].to_numpy(),
+            'ship_key': drawn['ship_key'].to_numpy(),
+            # The facts of the CSV are from 2021, and every year has the days of 2021
+            'issue_date_key': date_keys(jittered) - year * 10000,
+            'expiry_date_key': drawn['expiry_date_key'].to_numpy() - year * 10000,
+        }
+
+    def emissions(self, ships, facts):
+        """co2emission_reduced rows of the ships of a chunk, from their latest facts"""
+        return {
+            'imo': FIRST_IMO + ships['ship_key'],
+            'ship_name': ships['ship_name'],
+            'type': ships['ship_type'],
+            'technical_efficiency_number': facts['eedi'],
+            'issue': key_dates(facts['issue_date_key']),
+            'expiry': key_dates(facts['expiry_date_key']),
+        }
+
+    def extra_emissions(self):
+        """co2emission_reduced rows of ships without facts, with IMOs after the fleet's"""
+        rng = self.rng(len(self.chunks()))
+        index = np.arange(self.extra_count)
+        samples = rng.integers(0, len(self.base_emissions), self.extra_count)
+        drawn = self.base_emissions.iloc[samples].reset_index(drop=True)
+        return {
+            'imo': FIRST_IMO + self.ship_count + index,
+            'ship_name': numbered(self.emission_text['ship_name'][samples], index // len(self.base_emissions)),
+            'type': self.emission_text['type'][samples],
+            'technical_efficiency_number': np.round(
+                drawn['technical_efficiency_number'] * rng.lognormal(0, EEDI_NOISE, self.extra_count), 2
+            ),
+            'issue': drawn['issue'].to_numpy().astype('M8[D]'),
+            'expiry': drawn['expiry'].to_numpy().astype('M8[D]'),
+        }
+
+    def cover_dates(self, *dates):
+        """Widens the range of days d_date is filled with to datetime64[D] arrays"""
+        for values in dates:
+            if not len(values):
+                continue
+            first, last = values.min(), values.max()
+            self.first_date = first if self.first_date is None else min(self.first_date, first)
+            self.last_date = last if self.last_date is None else max(self.last_date, last)
+
+    def generate(self):
+        """
+        Replaces the star schema and co2emission_reduced with the fleet and
+        returns the rows written per table. Must run in a transaction; the
+        indexes besides the keys are dropped while the rows are written and
+        created again afterwards.
+        """
+        cursor = self.cursor
+        indexes = secondary_indexes()
+        cursor.execute(f'TRUNCATE {", ".join(TABLES)} RESTART IDENTITY')
+        for name in indexes:
+            cursor.execute(f'DROP INDEX IF EXISTS {name}')
+
+        verifiers = self.verifiers()
+        copy_binary(cursor, 'verifiers', verifiers, VERIFIER_TYPES)
+        self.stats['verifiers'] = len(verifiers['verifier_key'])
+
+        # Oldest year first, each year going through every chunk
+        for year in reversed(range(self.years)):
+            for chunk in self.chunks():
+                drawn = self.draws(chunk)
+                facts = self.facts(drawn, chunk, year)
+                copy_binary(cursor, 'fact_table', facts, FACT_TYPES)
+                self.stats['facts'] += len(drawn)
+                if year == 0:
+                    ships = self.ships(drawn, chunk)
+                    copy_binary(cursor, 'ship_dimension', ships, SHIP_TYPES)
+                    emissions = self.emissions(ships, facts)
+                    copy_binary(cursor, 'co2emission_reduced', emissions, EMISSION_TYPES)
+                    self.stats['ships'] += len(drawn)
+                    self.stats['emissions'] += len(drawn)
+                self.cover_dates(key_dates(facts['issue_date_key']), key_dates(facts['expiry_date_key']))
+        extra = self.extra_emissions()
+        copy_binary(cursor, 'co2emission_reduced', extra, EMISSION_TYPES)
+        self.stats['emissions'] += self.extra_count
+        self.cover_dates(extra['issue'], extra['expiry'])
+
+        if self.first_date is not None:
+            cursor.execute(insert_dates_sql(
+                "SELECT generate_series(%s::DATE, %s::DATE, '1 day')::DATE"
+            ), [str(self.first_date), str(self.last_date)])
+            self.stats['dates'] = cursor.rowcount
+
+        for statement in indexes.values():
+            cursor.execute(statement)
+        for table in TABLES:
+            cursor.execute(f'ANALYZE {table}')
+        return self.stats
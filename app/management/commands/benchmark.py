@@ -0,0 +1,69 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.benchmarks import SUITES, regressions
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs a benchmark suite and prints its results. With --baseline, fails if any '
+        'metric got worse than in the JSON of an earlier run by more than --tolerance'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('suite', choices=sorted(SUITES))
+        parser.add_argument('--repeat', type=int, default=5, help='Number of runs per measurement')
+        parser.add_argument('--json', dest='json_path', help='Also write the results as JSON to this file')
+        parser.add_argument('--baseline', help='JSON written by --json of an earlier run to compare with')
+        parser.add_argument(
+            '--tolerance', type=float, default=0.2,
+            help='Relative increase of a metric over the baseline that is not a regression'
+        )
+        parser.add_argument(
+            '--scales', type=float, nargs='+',
+            help='views, olap: seed the database with generate_fleet at each scale, replacing its data'
+        )
+        parser.add_argument('--seed', type=int, default=0, help='views, olap: seed of generate_fleet')
+        parser.add_argument('--years', type=int, default=1, help='views, olap: years of facts of generate_fleet')
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            if baseline.get('suite') != options['suite']:
+                raise CommandError(f'{options["baseline"]} has the results of {baseline.get("suite")}')
+
+        rows = SUITES[options['suite']](options)
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as f:
+                json.dump({'suite': options['suite'], 'results': rows}, f, indent=2, default=str)
+
+        self.write_table(rows)
+        if baseline is None:
+            return
+        found = regressions(SUITES[options['suite']], baseline['results'], rows, options['tolerance'])
+        if found:
+            self.stdout.write('')
+            self.write_table(found)
+            raise CommandError(f'{len(found)} metrics regressed against {options["baseline"]}')
+        self.stdout.write(self.style.SUCCESS(f'No regressions against {options["baseline"]}'))
+
+    def write_table(self, rows):
+        if not rows:
+            return
+        columns = list(rows[0])
+        table = [columns] + [[self.format_value(row.get(col)) for col in columns] for row in rows]
+        widths = [max(len(line[i]) for line in table) for i in range(len(columns))]
+        for line in table:
+            self.stdout.write('  '.join(val.ljust(width) for val, width in zip(line, widths)))
+
+    @staticmethod
+    def format_value(value):
+        if value is None:
+            return '-'
+        if isinstance(value, float):
+            return f'{value:.2f}'
+        return str(value)
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from app import caching
+
+
+class Command(BaseCommand):
+    help = (
+        'Marks cached figures as stale, run after changing co2emission_reduced '
+        'or the star-schema tables outside of the app (e.g. with the eda/ scripts)'
+    )
+
+    def handle(self, *args, **options):
+        version = caching.bump_data_version()
+        self.stdout.write(self.style.SUCCESS(f'Data version is now {version}'))
@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from app import olap
+
+
+class Command(BaseCommand):
+    help = (
+        'Loads the in-memory analytics engine and fails if any chart it answers differs '
+        'from the result of its SQL query'
+    )
+
+    def handle(self, *args, **options):
+        with connections['default'].cursor() as cursor:
+            start = time.perf_counter()
+            engine = olap.Engine.load(cursor)
+            loaded = time.perf_counter() - start
+            results = olap.compare(cursor, engine)
+
+        for view, y_axis, mismatched in results:
+            chart = f'{view} {y_axis}' if y_axis else view
+            self.stdout.write(f'{chart}: {"differs in " + ", ".join(mismatched) if mismatched else "equal"}')
+
+        failures = [result for result in results if result[2]]
+        if failures:
+            raise CommandError(f'{len(failures)} of {len(results)} charts differ from the SQL path')
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(results)} charts equal to the SQL path, '
+            f'{len(engine.facts["ship_key"])} facts loaded in {loaded:.2f}s'
+        ))
@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from app import plans
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs the queries of the pages under EXPLAIN (ANALYZE, BUFFERS) and fails if any '
+        'of them reads --min-rows rows or more with a sequential scan'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--min-rows', type=int, default=settings.PLAN_CHECK_MIN_ROWS,
+            help='Rows a sequential scan may not read, the tables must hold at least as many'
+        )
+        parser.add_argument('--paths', nargs='+', help='Pages to check, defaults to every page')
+
+    def handle(self, *args, **options):
+        min_rows = options['min_rows']
+        with connections['default'].cursor() as cursor:
+            for table in plans.SCALE_TABLES:
+                cursor.execute(f'SELECT COUNT(*) FROM {table}')
+                count = cursor.fetchone()[0]
+                if count < min_rows:
+                    raise CommandError(
+                        f'{table} has {count} rows, load at least {min_rows} (see generate_fleet) to check the plans'
+                    )
+                cursor.execute(f'ANALYZE {table}')
+            results = plans.check(cursor, options['paths'] or plans.page_paths(cursor), min_rows)
+
+        columns = list(results[0]) if results else []
+        table = [columns] + [[f'{val:.2f}' if isinstance(val, float) else str(val) for val in row.values()]
+                             for row in results]
+        widths = [max(len(line[i]) for line in table) for i in range(len(columns))]
+        for line in table:
+            self.stdout.write('  '.join(val.ljust(width) for val, width in zip(line, widths)))
+
+        failures = [row for row in results if row['seq_scans']]
+        if failures:
+            raise CommandError(f'{len(failures)} of {len(results)} queries read {min_rows}+ rows sequentially')
+        self.stdout.write(self.style.SUCCESS(f'{len(results)} queries without large sequential scans'))
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from app import analytics, caching, compliance
+
+
+class Command(BaseCommand):
+    help = 'Evaluates the EEDI compliance of every ship and stores it in the compliance table'
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        with transaction.atomic(), connections['default'].cursor() as cursor:
+            if not analytics.star_schema_exists(cursor):
+                raise CommandError('The star-schema tables have not been created yet')
+            ships = compliance.fetch_ships(cursor)
+            fetched = time.perf_counter()
+            results = compliance.evaluate(ships)
+            evaluated = time.perf_counter()
+            compliance.store(cursor, results)
+        caching.bump_data_version()
+        stored = time.perf_counter()
+
+        non_compliant = int((results['compliant'] == False).sum())  # noqa: E712
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(results)} ships evaluated, {non_compliant} non-compliant '
+            f'(fetch {fetched - start:.3f}s, evaluate {evaluated - fetched:.3f}s, '
+            f'store {stored - evaluated:.3f}s)'
+        ))
@@ -0,0 +1,72 @@
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from app import aggregates, analytics, dimensions, search
+from app.fleet import FleetGenerator
+
+
+class Command(BaseCommand):
+    help = (
+        'Replaces the star schema and co2emission_reduced with a synthetic fleet of --scale '
+        'times the ships of the CSVs in eda/, for benchmarks and plan checks at scale'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scale', type=float, default=1,
+            help='Ships, and emissions of ships without facts, as a multiple of the CSVs'
+        )
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the random generators')
+        parser.add_argument(
+            '--years', type=int, default=1,
+            help='Reporting years of facts per ship, which multiply the facts but not the ships'
+        )
+        parser.add_argument(
+            '--no-refresh', action='store_true',
+            help='Do not refresh the analytics materialized views afterwards'
+        )
+        parser.add_argument(
+            '--noinput', '--no-input', action='store_false', dest='interactive',
+            help='Do not ask before replacing the data'
+        )
+
+    def handle(self, *args, **options):
+        if options['scale'] <= 0 or options['years'] < 1:
+            raise CommandError('--scale must be positive and --years at least 1')
+        if options['interactive']:
+            answer = input(
+                'This replaces every row of the star schema and co2emission_reduced.\n'
+                "Type 'yes' to continue, or 'no' to cancel: "
+            )
+            if answer != 'yes':
+                raise CommandError('Fleet generation cancelled')
+
+        start = time.perf_counter()
+        with transaction.atomic(), connections['default'].cursor() as cursor:
+            if not analytics.star_schema_exists(cursor):
+                raise CommandError('The star-schema tables have not been created yet')
+            try:
+                generator = FleetGenerator(cursor, options['scale'], options['seed'], options['years'])
+            except ValueError as e:
+                raise CommandError(str(e)) from e
+            stats = generator.generate()
+            generated = time.perf_counter()
+            aggregates.rebuild(cursor)
+            search.rebuild(cursor)
+        rebuilt = time.perf_counter()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{stats["ships"]} ships, {stats["facts"]} facts, {stats["emissions"]} emissions, '
+            f'{stats["verifiers"]} verifiers and {stats["dates"]} dates in {generated - start:.2f}s '
+            f'({stats["facts"] / (generated - start):,.0f} facts/s), type_summary and '
+            f'ship_identifiers rebuilt in {rebuilt - generated:.2f}s'
+        ))
+
+        dimensions.invalidate()
+        call_command('compute_compliance', stdout=self.stdout)
+        if not options['no_refresh']:
+            # Nothing reads the replaced tables consistently until they are refreshed anyway
+            call_command('refresh_analytics', blocking=True, stdout=self.stdout)
@@ -0,0 +1,62 @@
+import glob
+import os
+import time
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from app import aggregates, analytics, dimensions, search
+from app.mrv import MrvLoader, read_rows
+
+DEFAULT_FILES = os.path.join(settings.BASE_DIR, 'eda', 'files', '*EU MRV Publication of information.xlsx')
+
+
+class Command(BaseCommand):
+    help = (
+        'Bulk loads EU MRV publications (.xlsx or CSV exports) into the star schema '
+        'and co2emission_reduced'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'files', nargs='*',
+            help='Workbooks or CSV files to load, defaults to every workbook in eda/files/'
+        )
+        parser.add_argument(
+            '--no-refresh', action='store_true',
+            help='Do not refresh the analytics materialized views afterwards'
+        )
+
+    def handle(self, *args, **options):
+        files = options['files'] or sorted(glob.glob(DEFAULT_FILES))
+        if not files:
+            raise CommandError('No MRV files to load')
+
+        for path in files:
+            start = time.perf_counter()
+            with transaction.atomic(), connections['default'].cursor() as cursor:
+                if not analytics.star_schema_exists(cursor):
+                    raise CommandError('The star-schema tables have not been created yet')
+                loader = MrvLoader(cursor)
+                loader.stage(read_rows(path))
+                loader.upsert()
+                aggregates.rebuild(cursor)
+                search.rebuild(cursor)
+            elapsed = time.perf_counter() - start
+
+            stats = loader.stats
+            self.stdout.write(self.style.SUCCESS(
+                f'{os.path.basename(path)}: {stats["read"]} rows read, {stats["staged"]} staged '
+                f'({stats["skipped"]} without EEDI, DoC or verifier), {stats["facts"]} facts and '
+                f'{stats["emissions"]} emissions upserted, {stats["unknown_ships"]} rows of ships '
+                f'not in ship_dimension, {stats["new_verifiers"]} new verifiers in {elapsed:.2f}s '
+                f'({stats["read"] / elapsed:,.0f} rows/s)'
+            ))
+
+        # New ship types, verifiers and years
+        dimensions.invalidate()
+        call_command('compute_compliance', stdout=self.stdout)
+        if not options['no_refresh']:
+            call_command('refresh_analytics', stdout=self.stdout)
@@ -0,0 +1,99 @@
+import threading
+import time
+import urllib.request
+from urllib.error import HTTPError
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from app.benchmarks import percentile
+
+DEFAULT_PATHS = [
+    '/emissions/',
+    '/aggregation/',
+    '/visual/',
+    '/dashboard/',
+    '/fuel_performance/',
+    '/verifiers_ranking/',
+    '/built_year_efficiency/',
+]
+
+
+def sessions_opened(cursor):
+    """Sessions ever opened on the database, None before PostgreSQL 14"""
+    cursor.execute('''
+        SELECT to_jsonb(s) -> 'sessions'
+        FROM pg_stat_database s
+        WHERE datname = current_database()
+    ''')
+    value = cursor.fetchone()[0]
+    return None if value is None else int(value)
+
+
+class Command(BaseCommand):
+    help = (
+        'Load tests a running server and prints p50/p99 latency and the PostgreSQL '
+        'connections opened per second. Run it once per DB_CONN_MODE of the server, '
+        'or against gunicorn core.wsgi and gunicorn core.asgi -k uvicorn.workers.UvicornWorker '
+        'to compare them. Start the server with '
+        'CACHE_BACKEND=django.core.cache.backends.dummy.DummyCache to measure the queries '
+        'of the chart pages rather than their figure cache.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', nargs='?', default='http://127.0.0.1:8000')
+        parser.add_argument('--paths', nargs='+', default=DEFAULT_PATHS)
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--duration', type=float, default=30, help='Seconds to run for')
+
+    def handle(self, *args, **options):
+        url = options['url'].rstrip('/')
+        paths = options['paths']
+        samples = {path: [] for path in paths}
+        errors = []
+        deadline = time.monotonic() + options['duration']
+
+        def worker(offset):
+            i = offset
+            while time.monotonic() < deadline:
+                path = paths[i % len(paths)]
+                i += 1
+                start = time.perf_counter()
+                try:
+                    with urllib.request.urlopen(url + path) as response:
+                        response.read()
+                except (HTTPError, OSError) as e:
+                    errors.append(e)
+                    continue
+                samples[path].append(time.perf_counter() - start)
+
+        with connections['default'].cursor() as cursor:
+            sessions_before = sessions_opened(cursor)
+        started = time.monotonic()
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(options['concurrency'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+        with connections['default'].cursor() as cursor:
+            sessions_after = sessions_opened(cursor)
+
+        all_samples = [sample for path_samples in samples.values() for sample in path_samples]
+        rows = [(path, samples[path]) for path in paths] + [('all', all_samples)]
+        self.stdout.write(f'{"path":<28}{"requests":>10}{"p50 ms":>10}{"p99 ms":>10}')
+        for path, path_samples in rows:
+            if not path_samples:
+                self.stdout.write(f'{path:<28}{0:>10}{"-":>10}{"-":>10}')
+                continue
+            self.stdout.write(
+                f'{path:<28}{len(path_samples):>10}'
+                f'{percentile(path_samples, 50) * 1000:>10.1f}{percentile(path_samples, 99) * 1000:>10.1f}'
+            )
+
+        self.stdout.write(f'requests/s: {len(all_samples) / elapsed:.1f}, errors: {len(errors)}')
+        if sessions_before is None or sessions_after is None:
+            self.stdout.write('connections opened/s: - (needs PostgreSQL 14 or newer)')
+        else:
+            opened = sessions_after - sessions_before
+            self.stdout.write(f'connections opened/s: {opened / elapsed:.1f}')
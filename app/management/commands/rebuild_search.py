@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from app import analytics, caching, search
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuilds the call signs and MMSIs of the ship search from ship_dimension, '
+        'run after loading data into the star-schema tables'
+    )
+
+    def handle(self, *args, **options):
+        with transaction.atomic(), connections['default'].cursor() as cursor:
+            if not analytics.star_schema_exists(cursor):
+                raise CommandError('The star-schema tables have not been created yet')
+            search.rebuild(cursor)
+            cursor.execute(f'SELECT COUNT(*) FROM {search.IDENTIFIERS_TABLE}')
+            count = cursor.fetchone()[0]
+        caching.bump_data_version()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt search identifiers for {count} ships'))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from app import aggregates, caching, dimensions
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the per ship type summary table from co2emission_reduced'
+
+    def handle(self, *args, **options):
+        with transaction.atomic(), connections['default'].cursor() as cursor:
+            aggregates.rebuild(cursor)
+            cursor.execute(f'SELECT COUNT(*) FROM {aggregates.SUMMARY_TABLE}')
+            count = cursor.fetchone()[0]
+        caching.bump_data_version()
+        dimensions.invalidate('ship_type')
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt summary for {count} ship types'))
@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from app import analytics, caching
+
+
+class Command(BaseCommand):
+    help = (
+        'Creates missing analytics materialized views and refreshes all of them, '
+        'run after loading data into the star-schema tables'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--blocking', action='store_true',
+            help='Refresh without CONCURRENTLY, which is faster but locks out readers'
+        )
+        parser.add_argument(
+            '--sql', action='store_true',
+            help='Print the SQL creating the views instead, the script of eda/create_materialized_views.sql'
+        )
+
+    def handle(self, *args, **options):
+        if options['sql']:
+            self.stdout.write(analytics.create_materialized_views_script(), ending='')
+            return
+        start = time.perf_counter()
+        with connections['default'].cursor() as cursor:
+            if not analytics.star_schema_exists(cursor):
+                raise CommandError('The star-schema tables have not been created yet')
+            analytics.create_materialized_views(cursor)
+            analytics.refresh_materialized_views(cursor, concurrently=not options['blocking'])
+        caching.bump_data_version()
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Refreshed {len(analytics.MATERIALIZED_VIEWS)} materialized views in {elapsed:.2f}s'
+        ))
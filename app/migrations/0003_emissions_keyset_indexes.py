@@ -0,0 +1,28 @@
+from django.db import migrations
+
+from app.utils import when_table_exists
+
+# Sortable columns of the emissions table, see app.views.COLUMNS. The imo
+# column is already covered by the primary key.
+SORT_COLUMNS = ['ship_name', 'type', 'technical_efficiency_number', 'issue', 'expiry']
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_auto_20210903_0751'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            when_table_exists('co2emission_reduced', [
+                f'CREATE INDEX IF NOT EXISTS co2emission_reduced_{col}_imo_idx '
+                f'ON co2emission_reduced ({col}, imo)'
+                for col in SORT_COLUMNS
+            ]),
+            reverse_sql=when_table_exists('co2emission_reduced', [
+                f'DROP INDEX IF EXISTS co2emission_reduced_{col}_imo_idx'
+                for col in SORT_COLUMNS
+            ]),
+        ),
+    ]
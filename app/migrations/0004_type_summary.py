@@ -0,0 +1,60 @@
+from django.db import migrations
+
+from app.utils import when_table_exists
+
+# The summary of the rows already there, as app.aggregates.rebuild computed
+# it at this migration
+POPULATE_SUMMARY = [
+    'DELETE FROM type_summary',
+    '''
+    INSERT INTO type_summary
+        (type, ship_count, value_count, value_sum, value_sum_sq, value_min, value_max)
+    SELECT type,
+        COUNT(*),
+        COUNT(technical_efficiency_number),
+        COALESCE(SUM(technical_efficiency_number::DOUBLE PRECISION), 0),
+        COALESCE(SUM(technical_efficiency_number::DOUBLE PRECISION ^ 2), 0),
+        MIN(technical_efficiency_number),
+        MAX(technical_efficiency_number)
+    FROM co2emission_reduced
+    GROUP BY type
+    ''',
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0003_emissions_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            '''
+            CREATE TABLE IF NOT EXISTS type_summary (
+                type VARCHAR(64) PRIMARY KEY,
+                ship_count BIGINT NOT NULL,
+                value_count BIGINT NOT NULL,
+                value_sum DOUBLE PRECISION NOT NULL,
+                value_sum_sq DOUBLE PRECISION NOT NULL,
+                value_min REAL,
+                value_max REAL
+            );
+            ''',
+            reverse_sql='DROP TABLE IF EXISTS type_summary;',
+        ),
+        # Lets the summary look up a type's min and max again after a delete
+        migrations.RunSQL(
+            when_table_exists('co2emission_reduced', [
+                'CREATE INDEX IF NOT EXISTS co2emission_reduced_type_ten_idx '
+                'ON co2emission_reduced (type, technical_efficiency_number)',
+            ]),
+            reverse_sql=when_table_exists('co2emission_reduced', [
+                'DROP INDEX IF EXISTS co2emission_reduced_type_ten_idx',
+            ]),
+        ),
+        migrations.RunSQL(
+            when_table_exists('co2emission_reduced', POPULATE_SUMMARY),
+            migrations.RunSQL.noop,
+        ),
+    ]
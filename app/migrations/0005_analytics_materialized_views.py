@@ -0,0 +1,87 @@
+from django.db import migrations
+
+from app import analytics
+
+# The views as of this migration, later ones are created by their own
+FUEL_PERFORMANCE_METRICS = [
+    'f.eedi', 's.tonnage', 's.width', 's.length', 's.speed', 'f.sea_time', 'f.co2_distance', 'f.co2_transport',
+]
+PERCENTILE_METRICS = ['eedi', 'co2_distance', 'co2_transport', 'fuel_consumption']
+
+
+def fuel_performance_sql(y_axis):
+    return f'''
+        SELECT s.ship_type, s.engine_type,
+            ROUND(AVG({y_axis})::NUMERIC,2) as metric,
+            ROUND(AVG(f.fuel_consumption)::NUMERIC,2) as fuelconsumption,
+            LN(COUNT(*)) as scaled_count,
+            (CASE
+            WHEN s.ship_type ISNULL AND s.engine_type ISNULL THEN 'Grand Total'
+            WHEN s.engine_type ISNULL THEN 'Subtotal'||' '||s.ship_type
+            ELSE s.ship_type|| ' ' || s.engine_type
+            END) as label,
+            GROUPING(s.ship_type, s.engine_type) as grouping_level
+        FROM fact_table f, ship_dimension s
+        WHERE f.ship_key = s.ship_key
+        GROUP BY ROLLUP(s.ship_type, s.engine_type)
+    '''
+
+
+VERIFIER_RANKING_SQL = '''
+    SELECT v.verifier_name, d.month_actual,
+        ROUND(AVG(f.EEDI)::NUMERIC,2) as avg_eedi,
+        RANK() OVER(PARTITION BY d.month_actual ORDER BY ROUND(AVG(f.EEDI)::NUMERIC,2) ASC) rank
+    FROM fact_table f, verifiers v, d_date d
+    WHERE f.issue_date_key = d.date_dim_id
+        AND f.verifier_key = v.verifier_key
+    GROUP BY v.verifier_name, d.month_actual
+'''
+
+
+def percentile_sql(y_axis):
+    return f'''
+        SELECT s.year_built,
+            ROUND(PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY f.{y_axis} ASC)::NUMERIC,2) AS percentile_25,
+            ROUND(PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY f.{y_axis} ASC)::NUMERIC,2) AS percentile_75
+        FROM fact_table f, ship_dimension s
+        WHERE f.ship_key = s.ship_key
+        GROUP BY s.year_built
+    '''
+
+
+# View name -> (defining query, columns of its unique index)
+VIEWS = {
+    **{
+        f'mv_fuel_performance_{metric.split(".")[-1]}': (fuel_performance_sql(metric), 'grouping_level, ship_type, engine_type')
+        for metric in FUEL_PERFORMANCE_METRICS
+    },
+    'mv_verifier_ranking': (VERIFIER_RANKING_SQL, 'verifier_name, month_actual'),
+    **{f'mv_percentile_{metric}': (percentile_sql(metric), 'year_built') for metric in PERCENTILE_METRICS},
+}
+
+
+def create_views(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        # The star schema is loaded outside of migrations (see eda/), the
+        # refresh_analytics command creates the views once it exists
+        if analytics.star_schema_exists(cursor):
+            for name, (sql, key) in VIEWS.items():
+                cursor.execute(f'CREATE MATERIALIZED VIEW IF NOT EXISTS {name} AS {sql};')
+                cursor.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {name}_key ON {name} ({key});')
+
+
+def drop_views(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        for name in VIEWS:
+            cursor.execute(f'DROP MATERIALIZED VIEW IF EXISTS {name};')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_type_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_views, drop_views),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_analytics_materialized_views'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            '''
+            CREATE TABLE IF NOT EXISTS eedi_compliance (
+                imo BIGINT PRIMARY KEY,
+                ship_key BIGINT NOT NULL,
+                ship_type VARCHAR(64),
+                dwt REAL,
+                year_built INT,
+                attained_eedi REAL,
+                reference_eedi DOUBLE PRECISION,
+                required_eedi DOUBLE PRECISION,
+                ratio DOUBLE PRECISION,
+                phase SMALLINT NOT NULL,
+                highest_phase_met SMALLINT NOT NULL,
+                compliant BOOLEAN
+            );
+            CREATE INDEX IF NOT EXISTS eedi_compliance_non_compliant_idx
+                ON eedi_compliance (ratio DESC, imo) WHERE NOT compliant;
+            ''',
+            reverse_sql='DROP TABLE IF EXISTS eedi_compliance;',
+        ),
+    ]
@@ -0,0 +1,86 @@
+import csv
+import os
+
+from django.conf import settings
+from django.db import migrations
+
+from app import analytics
+from app.utils import when_table_exists
+
+# The search table and indexes as of this migration, app.search holds the
+# current ones
+IDENTIFIERS_DDL = '''
+    CREATE TABLE IF NOT EXISTS ship_identifiers (
+        imo BIGINT PRIMARY KEY,
+        ship_key BIGINT NOT NULL,
+        call_sign VARCHAR(10),
+        mmsi BIGINT
+    );
+'''
+
+IDENTIFIERS_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS ship_identifiers_call_sign_trgm_idx '
+    'ON ship_identifiers USING gin (call_sign gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS ship_identifiers_mmsi_idx ON ship_identifiers (mmsi)',
+]
+
+EMISSION_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS co2emission_reduced_ship_name_trgm_idx '
+    'ON co2emission_reduced USING gin (ship_name gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS co2emission_reduced_ship_name_prefix_idx '
+    'ON co2emission_reduced (upper(ship_name) text_pattern_ops)',
+]
+
+MMSI_TO_IMO_CSV = os.path.join(settings.BASE_DIR, 'eda', 'mmsi-to-imo.csv')
+
+
+def ship_keys_by_imo(cursor):
+    # Ships linked to IMOs through their MMSI, then by the facts loaded
+    cursor.execute('SELECT mmsi, ship_key FROM ship_dimension')
+    keys_by_mmsi = dict(cursor.fetchall())
+    ship_keys = {}
+    with open(MMSI_TO_IMO_CSV, newline='') as f:
+        for row in csv.DictReader(f):
+            if int(row['mmsi']) in keys_by_mmsi:
+                ship_keys[int(row['imo'])] = keys_by_mmsi[int(row['mmsi'])]
+    cursor.execute('SELECT DISTINCT imo, ship_key FROM fact_table')
+    ship_keys.update(cursor.fetchall())
+    return ship_keys
+
+
+def populate_identifiers(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        # Filled by load_mrv and rebuild_search once the star schema is loaded
+        if analytics.star_schema_exists(cursor):
+            ship_keys = ship_keys_by_imo(cursor)
+            cursor.execute('TRUNCATE ship_identifiers')
+            cursor.execute('''
+                INSERT INTO ship_identifiers (imo, ship_key, call_sign, mmsi)
+                SELECT k.imo, k.ship_key, d.call_sign, d.mmsi
+                FROM unnest(%s::bigint[], %s::bigint[]) AS k (imo, ship_key)
+                JOIN ship_dimension d ON d.ship_key = k.ship_key;
+            ''', [list(ship_keys), list(ship_keys.values())])
+            cursor.execute('ANALYZE ship_identifiers')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_eedi_compliance'),
+    ]
+
+    operations = [
+        migrations.RunSQL('CREATE EXTENSION IF NOT EXISTS pg_trgm;', migrations.RunSQL.noop),
+        migrations.RunSQL(
+            [IDENTIFIERS_DDL] + IDENTIFIERS_INDEXES,
+            reverse_sql='DROP TABLE IF EXISTS ship_identifiers;',
+        ),
+        migrations.RunSQL(
+            when_table_exists('co2emission_reduced', EMISSION_INDEXES),
+            reverse_sql=when_table_exists('co2emission_reduced', [
+                'DROP INDEX IF EXISTS co2emission_reduced_ship_name_trgm_idx',
+                'DROP INDEX IF EXISTS co2emission_reduced_ship_name_prefix_idx',
+            ]),
+        ),
+        migrations.RunPython(populate_identifiers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,186 @@
+import importlib
+
+from django.db import migrations
+
+# The analytics views as of this migration, those of 0005
+VIEWS = importlib.import_module('app.migrations.0005_analytics_materialized_views').VIEWS
+
+# The schema as of this migration, app.schema holds the current one
+TABLES = [
+    '''
+        CREATE TABLE IF NOT EXISTS d_date (
+            date_dim_id INT NOT NULL PRIMARY KEY,
+            date_actual DATE NOT NULL,
+            month_actual INT NOT NULL,
+            month_name VARCHAR(9) NOT NULL,
+            month_name_abbreviated CHAR(3) NOT NULL,
+            quarter_actual CHAR(2) NOT NULL,
+            quarter_name VARCHAR(9) NOT NULL,
+            year_actual INT NOT NULL,
+            mmyyyy CHAR(6) NOT NULL,
+            mmddyyyy CHAR(10) NOT NULL
+        );
+    ''',
+    '''
+        CREATE TABLE IF NOT EXISTS ship_dimension (
+            ship_key BIGINT NOT NULL PRIMARY KEY,
+            ship_name VARCHAR(64),
+            ship_type VARCHAR(64),
+            call_sign VARCHAR(10) NOT NULL,
+            speed REAL NOT NULL,
+            year_built INT NOT NULL,
+            length REAL NOT NULL,
+            width REAL NOT NULL,
+            tonnage REAL NOT NULL,
+            engine_type VARCHAR(64) NOT NULL,
+            mmsi BIGINT NOT NULL
+        );
+    ''',
+    '''
+        CREATE TABLE IF NOT EXISTS verifiers (
+            verifier_key BIGINT NOT NULL PRIMARY KEY,
+            verifier_name VARCHAR(128) NOT NULL,
+            verifier_number VARCHAR(64) NOT NULL,
+            verifier_nab VARCHAR(128) NOT NULL,
+            verifier_address VARCHAR(128) NOT NULL,
+            verifier_city VARCHAR(64) NOT NULL,
+            verifier_country VARCHAR(64) NOT NULL
+        );
+    ''',
+    '''
+        CREATE TABLE IF NOT EXISTS fact_table (
+            imo BIGINT,
+            fuel_consumption REAL,
+            sea_time REAL,
+            co2_distance REAL,
+            co2_transport REAL,
+            eedi REAL,
+            verifier_key BIGINT,
+            ship_key BIGINT,
+            issue_date_key BIGINT,
+            expiry_date_key BIGINT,
+            fact_key BIGINT GENERATED BY DEFAULT AS IDENTITY
+        );
+        ALTER TABLE fact_table ADD COLUMN IF NOT EXISTS fact_key BIGINT GENERATED BY DEFAULT AS IDENTITY;
+    ''',
+    '''
+        CREATE TABLE IF NOT EXISTS co2emission_reduced (
+            imo BIGINT PRIMARY KEY,
+            ship_name VARCHAR(64) NOT NULL,
+            type VARCHAR(64) NOT NULL,
+            issue DATE NOT NULL,
+            expiry DATE NOT NULL,
+            technical_efficiency_number REAL NOT NULL
+        );
+    ''',
+]
+
+# Foreign keys are NOT VALID, as tables loaded from eda/ may hold facts
+# without a dimension row
+CONSTRAINTS = [
+    ('d_date', 'd_date_pkey', 'PRIMARY KEY (date_dim_id)'),
+    ('ship_dimension', 'ship_dimension_pkey', 'PRIMARY KEY (ship_key)'),
+    ('verifiers', 'verifiers_pkey', 'PRIMARY KEY (verifier_key)'),
+    ('fact_table', 'fact_table_pkey', 'PRIMARY KEY (fact_key)'),
+    ('fact_table', 'fact_table_issue_date_key_fkey',
+     'FOREIGN KEY (issue_date_key) REFERENCES d_date (date_dim_id) NOT VALID'),
+    ('fact_table', 'fact_table_expiry_date_key_fkey',
+     'FOREIGN KEY (expiry_date_key) REFERENCES d_date (date_dim_id) NOT VALID'),
+    ('fact_table', 'fact_table_verifier_key_fkey',
+     'FOREIGN KEY (verifier_key) REFERENCES verifiers (verifier_key) NOT VALID'),
+    ('fact_table', 'fact_table_ship_key_fkey',
+     'FOREIGN KEY (ship_key) REFERENCES ship_dimension (ship_key) NOT VALID'),
+]
+
+
+def add_constraint(table, name, definition):
+    if definition.startswith('PRIMARY KEY'):
+        exists = "contype = 'p'"
+    else:
+        exists = f"conname = '{name}'"
+    return f'''
+        DO $$
+        BEGIN
+            IF NOT EXISTS (
+                SELECT 1 FROM pg_constraint WHERE conrelid = '{table}'::regclass AND {exists}
+            ) THEN
+                ALTER TABLE {table} ADD CONSTRAINT {name} {definition};
+            END IF;
+        END
+        $$;
+    '''
+
+
+# Facts loaded from eda/ are not checked for one DoC per ship and issue date
+# like the MRV loader does, so duplicates are removed before the unique index
+# is built, keeping the one loaded last (the highest fact_key)
+DEDUPLICATE_FACTS = '''
+    DELETE FROM fact_table f
+    USING fact_table later
+    WHERE f.imo = later.imo
+        AND f.issue_date_key = later.issue_date_key
+        AND f.fact_key < later.fact_key;
+'''
+
+FACT_TABLE_INDEXES = {
+    'fact_table_imo_issue_date_key_idx':
+        'CREATE UNIQUE INDEX IF NOT EXISTS fact_table_imo_issue_date_key_idx ON fact_table (imo, issue_date_key DESC)',
+    'fact_table_ship_key_idx':
+        'CREATE INDEX IF NOT EXISTS fact_table_ship_key_idx ON fact_table (ship_key) '
+        'INCLUDE (eedi, fuel_consumption, sea_time, co2_distance, co2_transport)',
+    'fact_table_verifier_key_idx':
+        'CREATE INDEX IF NOT EXISTS fact_table_verifier_key_idx ON fact_table (verifier_key, issue_date_key) INCLUDE (eedi)',
+    'fact_table_issue_date_key_brin':
+        'CREATE INDEX IF NOT EXISTS fact_table_issue_date_key_brin ON fact_table USING brin (issue_date_key)',
+    'fact_table_expiry_date_key_brin':
+        'CREATE INDEX IF NOT EXISTS fact_table_expiry_date_key_brin ON fact_table USING brin (expiry_date_key)',
+}
+
+# Those of 0003, 0004 and 0007, which only created them if the table existed
+EMISSION_INDEXES = [
+    *[
+        f'CREATE INDEX IF NOT EXISTS co2emission_reduced_{col}_imo_idx ON co2emission_reduced ({col}, imo)'
+        for col in ['ship_name', 'type', 'technical_efficiency_number', 'issue', 'expiry']
+    ],
+    'CREATE INDEX IF NOT EXISTS co2emission_reduced_type_ten_idx ON co2emission_reduced (type, technical_efficiency_number)',
+    'CREATE INDEX IF NOT EXISTS co2emission_reduced_ship_name_trgm_idx '
+    'ON co2emission_reduced USING gin (ship_name gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS co2emission_reduced_ship_name_prefix_idx '
+    'ON co2emission_reduced (upper(ship_name) text_pattern_ops)',
+]
+
+
+def create_views(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        # Skipped by 0005 on databases where this migration created the tables
+        for name, (sql, key) in VIEWS.items():
+            cursor.execute(f'CREATE MATERIALIZED VIEW IF NOT EXISTS {name} AS {sql};')
+            cursor.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {name}_key ON {name} ({key});')
+        cursor.execute('ANALYZE fact_table')
+
+
+def drop_views(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        for name in VIEWS:
+            cursor.execute(f'DROP MATERIALIZED VIEW IF EXISTS {name};')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_ship_search'),
+    ]
+
+    operations = [
+        migrations.RunSQL(TABLES, migrations.RunSQL.noop),
+        migrations.RunSQL(
+            [add_constraint(*constraint) for constraint in CONSTRAINTS],
+            migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(DEDUPLICATE_FACTS, migrations.RunSQL.noop),
+        migrations.RunSQL(
+            list(FACT_TABLE_INDEXES.values()) + EMISSION_INDEXES,
+            reverse_sql=[f'DROP INDEX IF EXISTS {name}' for name in FACT_TABLE_INDEXES],
+        ),
+        migrations.RunPython(create_views, drop_views),
+    ]
@@ -0,0 +1,61 @@
+from django.db import migrations
+
+from app import analytics
+
+METRICS = ['eedi', 'co2_distance', 'co2_transport', 'fuel_consumption']
+
+
+def quantile_sketch_sql(metric):
+    # The bucket keys of app.sketches as of this migration
+    bucket = (
+        f'CASE WHEN ABS(f.{metric}) < 1e-09 THEN 0 '
+        f'ELSE SIGN(f.{metric})::INT * (CEIL(LN(ABS(f.{metric})::DOUBLE PRECISION) / 0.020000666706669435) + 1038)::INT END'
+    )
+    return f'''
+        SELECT year_built, ship_type, verifier_name, month_actual,
+            array_agg(bucket ORDER BY bucket) AS buckets,
+            array_agg(n ORDER BY bucket) AS counts
+        FROM (
+            SELECT s.year_built, s.ship_type, v.verifier_name, d.month_actual,
+                {bucket} AS bucket,
+                COUNT(*) AS n
+            FROM fact_table f
+            JOIN ship_dimension s ON s.ship_key = f.ship_key
+            LEFT JOIN verifiers v ON v.verifier_key = f.verifier_key
+            LEFT JOIN d_date d ON d.date_dim_id = f.issue_date_key
+            WHERE f.{metric} IS NOT NULL
+            GROUP BY 1, 2, 3, 4, 5
+        ) AS buckets
+        GROUP BY year_built, ship_type, verifier_name, month_actual
+    '''
+
+
+SKETCH_VIEWS = {f'mv_quantile_sketch_{metric}': quantile_sketch_sql(metric) for metric in METRICS}
+
+
+def create_views(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        if analytics.star_schema_exists(cursor):
+            for name, sql in SKETCH_VIEWS.items():
+                cursor.execute(f'CREATE MATERIALIZED VIEW IF NOT EXISTS {name} AS {sql};')
+                cursor.execute(
+                    f'CREATE UNIQUE INDEX IF NOT EXISTS {name}_key '
+                    f'ON {name} (year_built, ship_type, verifier_name, month_actual);'
+                )
+
+
+def drop_views(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        for name in SKETCH_VIEWS:
+            cursor.execute(f'DROP MATERIALIZED VIEW IF EXISTS {name};')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_star_schema'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_views, drop_views),
+    ]
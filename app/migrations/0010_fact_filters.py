@@ -0,0 +1,39 @@
+from django.db import migrations
+
+from app import analytics
+
+FACT_FILTERS_SQL = '''
+    SELECT 'year' AS filter, d.year_actual::TEXT AS value
+    FROM (SELECT DISTINCT issue_date_key FROM fact_table) AS f
+    JOIN d_date d ON d.date_dim_id = f.issue_date_key
+    GROUP BY d.year_actual
+    UNION ALL
+    SELECT DISTINCT 'ship_type', ship_type FROM ship_dimension WHERE ship_type IS NOT NULL
+    UNION ALL
+    SELECT DISTINCT 'engine_type', engine_type FROM ship_dimension
+    UNION ALL
+    SELECT DISTINCT 'verifier', verifier_name FROM verifiers
+'''
+
+
+def create_views(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        if analytics.star_schema_exists(cursor):
+            cursor.execute(f'CREATE MATERIALIZED VIEW IF NOT EXISTS mv_fact_filters AS {FACT_FILTERS_SQL};')
+            cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS mv_fact_filters_key ON mv_fact_filters (filter, value);')
+
+
+def drop_views(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('DROP MATERIALIZED VIEW IF EXISTS mv_fact_filters;')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_quantile_sketches'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_views, drop_views),
+    ]
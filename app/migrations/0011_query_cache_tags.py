@@ -0,0 +1,53 @@
+from django.db import migrations
+
+# The version table and bump function as of this migration, app.querycache
+# holds the current ones
+CREATE_SQL = '''
+    CREATE TABLE IF NOT EXISTS cache_tag_versions (
+        tag TEXT PRIMARY KEY,
+        version BIGINT NOT NULL
+    );
+    CREATE OR REPLACE FUNCTION bump_cache_tag() RETURNS trigger AS $$
+    DECLARE
+        new_version BIGINT;
+    BEGIN
+        INSERT INTO cache_tag_versions AS t (tag, version) VALUES (TG_TABLE_NAME, 1)
+        ON CONFLICT (tag) DO UPDATE SET version = t.version + 1
+        RETURNING version INTO new_version;
+        PERFORM pg_notify('query_cache', TG_TABLE_NAME || ' ' || new_version);
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+'''
+
+TAGGED_TABLES = [
+    'co2emission_reduced', 'type_summary', 'eedi_compliance',
+    'fact_table', 'ship_dimension', 'verifiers', 'd_date',
+]
+
+
+def trigger_sql(table):
+    return f'''
+        DROP TRIGGER IF EXISTS {table}_cache_tag ON {table};
+        CREATE TRIGGER {table}_cache_tag
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+        FOR EACH STATEMENT EXECUTE PROCEDURE bump_cache_tag();
+    '''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_fact_filters'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            CREATE_SQL,
+            'DROP TABLE IF EXISTS cache_tag_versions; DROP FUNCTION IF EXISTS bump_cache_tag() CASCADE;',
+        ),
+        migrations.RunSQL(
+            [trigger_sql(table) for table in TAGGED_TABLES],
+            migrations.RunSQL.noop,
+        ),
+    ]
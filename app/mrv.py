@@ -0,0 +1,319 @@
+"""
+Bulk loading of the yearly EU MRV publications (eda/files/*.xlsx, or CSV
+exports of them) into the star schema and co2emission_reduced.
+
+Rows are streamed from the file, cleaned the same way as
+eda/data_cleanup.ipynb, given their ship, verifier and date surrogate keys
+from in-memory maps and written with COPY into a staging table, from where
+they are upserted with a handful of set-based statements.
+"""
+import csv
+import os
+import re
+from datetime import date, datetime
+
+from django.conf import settings
+
+from app.utils import IteratorFile, csv_line
+
+# Workbook header -> field name
+MRV_COLUMNS = {
+    'IMO Number': 'imo',
+    'Name': 'ship_name',
+    'Ship type': 'ship_type',
+    'Technical efficiency': 'technical_efficiency',
+    'DoC issue date': 'issue_date',
+    'DoC expiry date': 'expiry_date',
+    'Verifier Name': 'verifier_name',
+    'Verifier Accreditation number': 'verifier_number',
+    'Verifier NAB': 'verifier_nab',
+    'Verifier Address': 'verifier_address',
+    'Verifier City': 'verifier_city',
+    'Verifier Country': 'verifier_country',
+    'Total fuel consumption [m tonnes]': 'fuel_consumption',
+    'Annual Time spent at sea [hours]': 'sea_time',
+    'Annual average CO₂ emissions per distance [kg CO₂ / n mile]': 'co2_distance',
+    'Annual average CO₂ emissions per transport work (mass) [g CO₂ / m tonnes · n miles]': 'co2_transport',
+}
+VERIFIER_FIELDS = [
+    'verifier_name', 'verifier_number', 'verifier_nab',
+    'verifier_address', 'verifier_city', 'verifier_country',
+]
+STAGING_COLUMNS = [
+    'imo', 'ship_name', 'ship_type', 'eedi', 'issue', 'expiry',
+    'fuel_consumption', 'sea_time', 'co2_distance', 'co2_transport',
+    'verifier_key', 'ship_key', 'issue_date_key', 'expiry_date_key',
+]
+MMSI_TO_IMO_CSV = os.path.join(settings.BASE_DIR, 'eda', 'mmsi-to-imo.csv')
+
+EFFICIENCY_RE = re.compile(r'^(\w+)\s*\((\d*\.?\d*)')
+
+
+def read_rows(path):
+    """
+    Yields the rows of an MRV publication as dicts keyed by field name, from
+    an .xlsx workbook or a CSV export of it. The header is the first row that
+    contains 'IMO Number', as the workbooks start with a few title rows.
+    """
+    if path.endswith('.xlsx'):
+        # Only needed for workbooks, CSV exports work without it
+        import openpyxl
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        sheet = workbook.worksheets[0]
+        # The workbooks report wrong dimensions, which truncates read-only mode
+        sheet.reset_dimensions()
+        rows = sheet.iter_rows(values_only=True)
+    else:
+        f = open(path, newline='', encoding='utf-8-sig')
+        rows = csv.reader(f)
+
+    indices = None
+    for row in rows:
+        if indices is None:
+            if 'IMO Number' in row:
+                indices = {
+                    MRV_COLUMNS[header]: i for i, header in enumerate(row) if header in MRV_COLUMNS
+                }
+            continue
+        yield {field: row[i] if i < len(row) else None for field, i in indices.items()}
+
+    if path.endswith('.xlsx'):
+        workbook.close()
+    else:
+        f.close()
+
+
+def parse_number(value):
+    """Returns a value as float, or None for blanks, 'N/A' and 'Division by zero!'"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).replace(',', ''))
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_date(value):
+    """Returns a date from a datetime or a dd/mm/yyyy string, or None"""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    try:
+        return datetime.strptime(str(value).strip(), '%d/%m/%Y').date()
+    except ValueError:
+        return None
+
+
+def parse_row(row):
+    """
+    Cleans one MRV row like eda/data_cleanup.ipynb does and returns a dict,
+    or None if the row has no EEDI, DoC dates or verifier.
+    """
+    match = EFFICIENCY_RE.match(str(row.get('technical_efficiency') or ''))
+    if not match or match.group(1) != 'EEDI':
+        return None
+    eedi = parse_number(match.group(2))
+    issue, expiry = parse_date(row['issue_date']), parse_date(row['expiry_date'])
+    imo = parse_number(row['imo'])
+    if None in (eedi, issue, expiry, imo) or not row.get('verifier_name'):
+        return None
+
+    return {
+        'imo': int(imo),
+        'ship_name': str(row['ship_name'] or '')[:64],
+        'ship_type': str(row['ship_type'] or '')[:64],
+        'eedi': eedi,
+        'issue': issue,
+        'expiry': expiry,
+        'fuel_consumption': parse_number(row.get('fuel_consumption')),
+        'sea_time': parse_number(row.get('sea_time')),
+        'co2_distance': parse_number(row.get('co2_distance')),
+        'co2_transport': parse_number(row.get('co2_transport')),
+        **{field: str(row.get(field) or '').strip() for field in VERIFIER_FIELDS},
+    }
+
+
+def date_key(value):
+    """The d_date surrogate key of a date, e.g. 20210430"""
+    return value.year * 10000 + value.month * 100 + value.day
+
+
+def insert_dates_sql(dates):
+    """
+    INSERT of the d_date rows, with the same columns as eda/datepopulate.sql,
+    of the dates a query returns that d_date does not have yet
+    """
+    return f'''
+        INSERT INTO d_date
+        SELECT TO_CHAR(datum, 'yyyymmdd')::INT AS date_dim_id,
+            datum AS date_actual,
+            EXTRACT(MONTH FROM datum)::INT AS month_actual,
+            TO_CHAR(datum, 'TMMonth') AS month_name,
+            TO_CHAR(datum, 'Mon') AS month_name_abbreviated,
+            EXTRACT(QUARTER FROM datum) AS quarter_actual,
+            'Q' || EXTRACT(QUARTER FROM datum) AS quarter_name,
+            EXTRACT(YEAR FROM datum)::INT AS year_actual,
+            TO_CHAR(datum, 'mmyyyy')::CHAR(6) AS mmyyyy,
+            TO_CHAR(datum, 'mmddyyyy')::CHAR(10) AS mmddyyyy
+        FROM ({dates}) dates (datum)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM d_date WHERE date_dim_id = TO_CHAR(datum, 'yyyymmdd')::INT
+        );
+    '''
+
+
+def ship_keys_by_imo(cursor):
+    """
+    Returns {imo: ship_key} of the ship_dimension rows. Ships are linked to
+    IMOs by the facts already loaded, and through their MMSI for ships that
+    have no facts yet.
+    """
+    cursor.execute('SELECT mmsi, ship_key FROM ship_dimension')
+    keys_by_mmsi = dict(cursor.fetchall())
+    ship_keys = {}
+    with open(MMSI_TO_IMO_CSV, newline='') as f:
+        for row in csv.DictReader(f):
+            if int(row['mmsi']) in keys_by_mmsi:
+                ship_keys[int(row['imo'])] = keys_by_mmsi[int(row['mmsi'])]
+    cursor.execute('SELECT DISTINCT imo, ship_key FROM fact_table')
+    ship_keys.update(cursor.fetchall())
+    return ship_keys
+
+
+class MrvLoader:
+    """Loads MRV rows through a cursor, keeping the surrogate key maps in memory"""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.stats = {'read': 0, 'skipped': 0, 'staged': 0, 'unknown_ships': 0}
+        self.new_verifiers = []
+
+        cursor.execute('SELECT verifier_name, verifier_key FROM verifiers')
+        self.verifier_keys = dict(cursor.fetchall())
+        self.next_verifier_key = max(self.verifier_keys.values(), default=0) + 1
+
+        self.ship_keys = ship_keys_by_imo(cursor)
+
+        cursor.execute(f'''
+            CREATE TEMP TABLE mrv_staging (
+                imo BIGINT,
+                ship_name VARCHAR(64),
+                ship_type VARCHAR(64),
+                eedi REAL,
+                issue DATE,
+                expiry DATE,
+                fuel_consumption REAL,
+                sea_time REAL,
+                co2_distance REAL,
+                co2_transport REAL,
+                verifier_key BIGINT,
+                ship_key BIGINT,
+                issue_date_key INT,
+                expiry_date_key INT
+            ) ON COMMIT DROP;
+        ''')
+
+    def verifier_key(self, record):
+        name = record['verifier_name']
+        if name not in self.verifier_keys:
+            self.verifier_keys[name] = self.next_verifier_key
+            self.new_verifiers.append(
+                [self.next_verifier_key] + [record[field] for field in VERIFIER_FIELDS]
+            )
+            self.next_verifier_key += 1
+        return self.verifier_keys[name]
+
+    def staging_lines(self, rows):
+        for row in rows:
+            self.stats['read'] += 1
+            record = parse_row(row)
+            if record is None:
+                self.stats['skipped'] += 1
+                continue
+            ship_key = self.ship_keys.get(record['imo'])
+            if ship_key is None:
+                self.stats['unknown_ships'] += 1
+            self.stats['staged'] += 1
+            yield csv_line([
+                record['imo'], record['ship_name'], record['ship_type'], record['eedi'],
+                record['issue'], record['expiry'], record['fuel_consumption'],
+                record['sea_time'], record['co2_distance'], record['co2_transport'],
+                self.verifier_key(record), ship_key,
+                date_key(record['issue']), date_key(record['expiry']),
+            ])
+
+    def stage(self, rows):
+        """Streams rows into the staging table with COPY"""
+        self.cursor.copy_expert(
+            f'COPY mrv_staging ({", ".join(STAGING_COLUMNS)}) FROM STDIN WITH (FORMAT csv)',
+            IteratorFile(self.staging_lines(rows))
+        )
+
+    def upsert(self):
+        """
+        Moves the staged rows into the star schema and co2emission_reduced.
+        Facts of ships that are not in ship_dimension only go to
+        co2emission_reduced, like the inner join in eda/data_cleanup.ipynb.
+        """
+        cursor = self.cursor
+        if self.new_verifiers:
+            cursor.execute(f'''
+                INSERT INTO verifiers (verifier_key, {", ".join(VERIFIER_FIELDS)})
+                VALUES {", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(self.new_verifiers))};
+            ''', [val for verifier in self.new_verifiers for val in verifier])
+
+        cursor.execute(insert_dates_sql(
+            'SELECT issue FROM mrv_staging UNION SELECT expiry FROM mrv_staging'
+        ))
+
+        cursor.execute('''
+            UPDATE ship_dimension s
+            SET ship_name = latest.ship_name, ship_type = latest.ship_type
+            FROM (
+                SELECT DISTINCT ON (ship_key) ship_key, ship_name, ship_type
+                FROM mrv_staging
+                WHERE ship_key IS NOT NULL
+                ORDER BY ship_key, issue DESC
+            ) latest
+            WHERE s.ship_key = latest.ship_key
+                AND (s.ship_name, s.ship_type) IS DISTINCT FROM (latest.ship_name, latest.ship_type);
+        ''')
+
+        # A ship has one DoC per issue date, reloading a year replaces its facts
+        cursor.execute('''
+            DELETE FROM fact_table f
+            USING mrv_staging st
+            WHERE f.imo = st.imo AND f.issue_date_key = st.issue_date_key;
+        ''')
+        cursor.execute('''
+            INSERT INTO fact_table (
+                imo, fuel_consumption, sea_time, co2_distance, co2_transport, eedi,
+                verifier_key, ship_key, issue_date_key, expiry_date_key
+            )
+            SELECT DISTINCT ON (imo, issue_date_key)
+                imo, fuel_consumption, sea_time, co2_distance, co2_transport, eedi,
+                verifier_key, ship_key, issue_date_key, expiry_date_key
+            FROM mrv_staging
+            WHERE ship_key IS NOT NULL
+            ORDER BY imo, issue_date_key;
+        ''')
+        facts = cursor.rowcount
+
+        # co2emission_reduced holds the latest DoC of every ship
+        cursor.execute('''
+            INSERT INTO co2emission_reduced (imo, ship_name, type, technical_efficiency_number, issue, expiry)
+            SELECT DISTINCT ON (imo) imo, ship_name, ship_type, eedi, issue, expiry
+            FROM mrv_staging
+            ORDER BY imo, issue DESC
+            ON CONFLICT (imo) DO UPDATE SET
+                ship_name = EXCLUDED.ship_name,
+                type = EXCLUDED.type,
+                technical_efficiency_number = EXCLUDED.technical_efficiency_number,
+                issue = EXCLUDED.issue,
+                expiry = EXCLUDED.expiry
+            WHERE co2emission_reduced.issue <= EXCLUDED.issue;
+        ''')
+        self.stats['facts'] = facts
+        self.stats['emissions'] = cursor.rowcount
+        self.stats['new_verifiers'] = len(self.new_verifiers)
@@ -0,0 +1,567 @@
+"""
+In-memory analytics engine, which answers the chart pages from NumPy arrays
+instead of PostgreSQL when ANALYTICS_IN_MEMORY is set.
+
+Each worker process loads the star schema with binary COPY whenever one of
+its tables is written to, and the per type values of co2emission_reduced,
+which the forms write to, only when that is (see app.querycache for the table
+versions). Facts are kept as a column per metric, with the row of the ship
+they join and the codes of their verifier and issue month. Text columns are
+dictionary encoded, the codes following the collation order of the database
+with NULL last, so that ordering by code is ordering by value. The queries of
+app.analytics are then answered by group-by kernels over the codes: bincount
+for the sums and counts of ROLLUP and AVG, a partition per year built for
+PERCENTILE_CONT, with results rounded like ROUND(x::NUMERIC, 2).
+
+The checkbox filters of the chart pages (issue year, ship type, engine type
+and verifier) are served from a packed bitmap of the rows of every value
+(see Bitmaps), or by SQL when ANALYTICS_IN_MEMORY is not set. Any
+combination of ticked boxes is a few bitwise ORs and ANDs of bitmaps, and
+the group-by kernels run over the rows it selects. The bitmaps take a bit
+per fact for every value, 1.25 MB per value at 10 million facts.
+
+`python manage.py check_olap` compares every chart with the SQL path, and
+the olap benchmark suite times both.
+"""
+import copy
+import math
+import threading
+from contextlib import contextmanager
+from decimal import ROUND_HALF_UP, Decimal
+
+import numpy as np
+from django.db import connections, transaction
+
+from app import aggregates, analytics, querycache
+from app.fleet import COPY_HEADER
+from app.utils import query_columns
+
+# Column -> (expression, big-endian type), NULL keys as -1 and NULL metrics
+# as NaN so that every row has the same width
+FACT_COLUMNS = {
+    'ship_key': ('COALESCE(f.ship_key, -1)', '>i8'),
+    'verifier_key': ('COALESCE(f.verifier_key, -1)', '>i8'),
+    'month': ('COALESCE(d.month_actual, -1)::SMALLINT', '>i2'),
+    'year': ('COALESCE(d.year_actual, -1)::SMALLINT', '>i2'),
+    'eedi': ("COALESCE(f.eedi, 'NaN')", '>f4'),
+    'fuel_consumption': ("COALESCE(f.fuel_consumption, 'NaN')", '>f4'),
+    'sea_time': ("COALESCE(f.sea_time, 'NaN')", '>f4'),
+    'co2_distance': ("COALESCE(f.co2_distance, 'NaN')", '>f4'),
+    'co2_transport': ("COALESCE(f.co2_transport, 'NaN')", '>f4'),
+}
+SHIP_COLUMNS = {
+    'ship_key': ('ship_key', '>i8'),
+    'ship_type': ('(DENSE_RANK() OVER (ORDER BY ship_type) - 1)::INT', '>i4'),
+    'engine_type': ('(DENSE_RANK() OVER (ORDER BY engine_type) - 1)::INT', '>i4'),
+    'year_built': ('year_built', '>i4'),
+    'speed': ('speed', '>f4'),
+    'length': ('length', '>f4'),
+    'width': ('width', '>f4'),
+    'tonnage': ('tonnage', '>f4'),
+}
+VERIFIER_COLUMNS = {
+    'verifier_key': ('verifier_key', '>i8'),
+    'verifier_name': ('(DENSE_RANK() OVER (ORDER BY verifier_name) - 1)::INT', '>i4'),
+}
+EMISSION_COLUMNS = {
+    'type': ('(DENSE_RANK() OVER (ORDER BY type) - 1)::INT', '>i4'),
+    'value': ('technical_efficiency_number', '>f4'),
+    'year': ('EXTRACT(YEAR FROM issue)::SMALLINT', '>i2'),
+}
+
+# Filters of the chart pages of the facts, and of the visual page
+FACT_FILTERS = ['year', 'ship_type', 'engine_type', 'verifier']
+EMISSION_FILTERS = ['year', 'ship_type']
+
+# Charts answered by the engine, as (view, y_axis) like views.chart_query
+CHARTS = [
+    ('visual', None),
+    *[('fuel_performance', metric) for metric in analytics.FUEL_PERFORMANCE_METRICS],
+    ('verifiers_ranking', None),
+    *[('built_year_efficiency', metric) for metric in analytics.PERCENTILE_METRICS],
+]
+
+# Rounded values may differ by a unit of the last digit from the SQL path, as
+# sums in another order can fall on the other side of a rounding tie
+ROUNDED_TOLERANCE = 0.01
+
+EMISSION_TABLE = 'co2emission_reduced'
+
+_engine = None
+_lock = threading.Lock()
+
+
+class _BinaryRows:
+    """
+    File-like target of COPY ... TO STDOUT WITH (FORMAT binary) for rows of
+    fixed width fields, which parses the rows as they arrive
+    """
+    def __init__(self, types):
+        fields = [('count', '>i2')]
+        for i, (name, pg_type) in enumerate(types.items()):
+            fields += [(f'length{i}', '>i4'), (name, pg_type)]
+        self.dtype = np.dtype(fields)
+        self.buffer = bytearray()
+        self.chunks = []
+        self.header = True
+
+    def write(self, data):
+        self.buffer += data
+        if self.header:
+            if len(self.buffer) < len(COPY_HEADER):
+                return
+            del self.buffer[:len(COPY_HEADER)]
+            self.header = False
+        # What is left at the end is the trailer
+        count = len(self.buffer) // self.dtype.itemsize
+        if count:
+            self.chunks.append(np.frombuffer(self.buffer, self.dtype, count).copy())
+            del self.buffer[:count * self.dtype.itemsize]
+
+    def columns(self):
+        rows = np.concatenate(self.chunks) if self.chunks else np.empty(0, self.dtype)
+        return {
+            name: rows[name].astype(rows.dtype[name].newbyteorder('='))
+            for name in self.dtype.names[2::2]
+        }
+
+
+def copy_columns(cursor, table, columns):
+    """
+    Reads the columns of a table (or a FROM clause) with binary COPY into a
+    dict of NumPy arrays, columns mapping each name to the expression and the
+    big-endian type of a column that is never NULL
+    """
+    target = _BinaryRows({name: pg_type for name, (_, pg_type) in columns.items()})
+    select = ', '.join(expression for expression, _ in columns.values())
+    cursor.copy_expert(f'COPY (SELECT {select} FROM {table}) TO STDOUT WITH (FORMAT binary)', target)
+    return target.columns()
+
+
+def dictionary(cursor, table, column):
+    """Distinct values of a column in the order of their DENSE_RANK codes"""
+    cursor.execute(f'SELECT DISTINCT {column} FROM {table} ORDER BY {column}')
+    return [value for value, in cursor.fetchall()]
+
+
+def round_numeric(values, digits=2):
+    """
+    ROUND(value::NUMERIC, digits) of float values: to 15 significant digits
+    like the cast, then half away from zero
+    """
+    quantum = Decimal(1).scaleb(-digits)
+    return np.array([
+        value if math.isnan(value) else float(Decimal(f'{value:.15g}').quantize(quantum, ROUND_HALF_UP))
+        for value in np.asarray(values, dtype=float).tolist()
+    ], dtype=float)
+
+
+def _sums(groups, values, size):
+    # SUM and COUNT of the values per group, NULL (NaN) values left out
+    valid = ~np.isnan(values)
+    return (
+        np.bincount(groups, weights=np.where(valid, values, 0), minlength=size),
+        np.bincount(groups, weights=valid, minlength=size),
+    )
+
+
+def _averages(sums, counts):
+    # AVG, NaN (NULL) where there are no values
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+
+def _objects(values):
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def _codes(values):
+    # Codes of the distinct non-negative values of an array, -1 for negative
+    # ones, and the values
+    distinct = np.unique(values[values >= 0])
+    return np.where(values >= 0, np.searchsorted(distinct, values), -1), distinct.tolist()
+
+
+class Bitmaps:
+    """
+    The rows of every value of some columns as bitmaps packed 8 rows a byte,
+    and the rows where each column is not NULL. columns maps each name to
+    the codes of the rows, -1 for NULL, and the values of the codes.
+    """
+    def __init__(self, columns, size):
+        self.size = size
+        self.bitmaps = {}
+        self.valid = {}
+        self.index = {}
+        for name, (codes, values) in columns.items():
+            self.bitmaps[name] = np.array(
+                [np.packbits(codes == code) for code in range(len(values))], dtype=np.uint8
+            ).reshape(len(values), (size + 7) // 8)
+            self.valid[name] = np.packbits(codes >= 0)
+            # Values as the query parameters of the filters have them
+            self.index[name] = {str(value): code for code, value in enumerate(values) if value is not None}
+
+    def mask(self, selection):
+        """
+        Boolean array of the rows that have one of the selected values in
+        every column of selection, a dict of column -> values, None if it is
+        empty. Values not in a column select no row.
+        """
+        result = None
+        for name, values in selection.items():
+            index = self.index[name]
+            selected = np.zeros(len(self.bitmaps[name]), dtype=bool)
+            selected[[index[value] for value in values if value in index]] = True
+            # With most values ticked, the rows of the others are fewer to
+            # combine, so that ticking more boxes does not cost more
+            if selected.sum() * 2 <= len(selected):
+                bits = np.bitwise_or.reduce(self.bitmaps[name][selected], axis=0)
+            else:
+                bits = self.valid[name] & ~np.bitwise_or.reduce(self.bitmaps[name][~selected], axis=0)
+            result = bits if result is None else result & bits
+        if result is None:
+            return None
+        return np.unpackbits(result, count=self.size).view(bool)
+
+
+class Engine:
+    """The arrays of one data version and the queries of the chart pages over them"""
+    def __init__(self, facts, ships, verifiers, emissions, dictionaries, version=None, emission_version=None):
+        self.version = version
+        self.dictionaries = dictionaries
+        self.facts = facts
+        order = np.argsort(ships['ship_key'], kind='stable')
+        self.ships = {name: values[order] for name, values in ships.items()}
+        self.fact_ship = self.join(self.ships['ship_key'], facts['ship_key'])
+        # The facts joined to a ship, and the row of their ship
+        self.ship_facts = np.flatnonzero(self.fact_ship >= 0)
+        self.joined_ship = self.fact_ship[self.ship_facts]
+
+        # ROLLUP groups of the joined facts, and what does not depend on the metric
+        size = len(dictionaries['ship_type']) * len(dictionaries['engine_type'])
+        self.rollup_groups = (
+            self.ships['ship_type'][self.joined_ship].astype(np.int64) * len(dictionaries['engine_type'])
+            + self.ships['engine_type'][self.joined_ship]
+        )
+        self.rollup_counts = np.bincount(self.rollup_groups, minlength=size)
+        self.rollup_fuel = _sums(self.rollup_groups, facts['fuel_consumption'][self.ship_facts], size)
+
+        order = np.argsort(verifiers['verifier_key'], kind='stable')
+        rows = self.join(verifiers['verifier_key'][order], facts['verifier_key'])
+        # Verifiers are grouped by name, which several keys may share
+        names = np.append(verifiers['verifier_name'][order], -1)
+        self.fact_verifier = names[rows]
+
+        # Joined facts grouped by year built, for the percentiles. As small
+        # offsets the years are radix sorted.
+        years = self.ships['year_built'][self.joined_ship]
+        offsets = years - years.min() if len(years) else years
+        order = np.argsort(offsets.astype(np.int16) if offsets.max(initial=0) < 2 ** 15 else offsets, kind='stable')
+        self.year_facts = self.ship_facts[order]
+        self.years, starts = np.unique(years[order], return_index=True)
+        self.year_bounds = np.append(starts, len(order))
+
+        # Ships and verifiers of the facts coded past the end when missing
+        # are NULL to the filters
+        fact_ship = np.append(np.arange(len(self.ships['ship_key'])), -1)[self.fact_ship]
+        self.fact_bitmaps = Bitmaps({
+            'year': _codes(facts['year']),
+            'ship_type': (np.append(self.ships['ship_type'], -1)[fact_ship], dictionaries['ship_type']),
+            'engine_type': (np.append(self.ships['engine_type'], -1)[fact_ship], dictionaries['engine_type']),
+            'verifier': (self.fact_verifier, dictionaries['verifier_name']),
+        }, len(self.fact_ship))
+        self.set_emissions(emissions, dictionaries['type'], emission_version)
+
+    def set_emissions(self, emissions, types, version=None):
+        """Sets the arrays of co2emission_reduced, of the types dictionary"""
+        self.emission_version = version
+        self.dictionaries = {**self.dictionaries, 'type': types}
+        order = np.argsort(emissions['type'], kind='stable')
+        self.emission_types = emissions['type'][order]
+        self.emission_values = emissions['value'][order].astype(float)
+        self.emission_bitmaps = Bitmaps({
+            'year': _codes(emissions['year'][order]),
+            'ship_type': (self.emission_types, types),
+        }, len(order))
+
+    def with_emissions(self, emissions, types, version=None):
+        """A copy of the engine with other arrays of co2emission_reduced"""
+        engine = copy.copy(self)
+        engine.set_emissions(emissions, types, version)
+        return engine
+
+    @staticmethod
+    def join(sorted_keys, keys):
+        """Positions of keys in the array sorted_keys, -1 where missing"""
+        if not len(sorted_keys):
+            return np.full(len(keys), -1, dtype=np.int32)
+        low, high = int(sorted_keys[0]), int(sorted_keys[-1])
+        if high - low < 4 * len(sorted_keys) + 1024:
+            # Keys from an identity column are dense enough to look up by
+            # offset, which unlike a binary search does not jump around memory
+            rows = np.full(high - low + 2, -1, dtype=np.int32)
+            rows[sorted_keys - low] = np.arange(len(sorted_keys), dtype=np.int32)
+            return rows[np.where((keys >= low) & (keys <= high), keys - low, high - low + 1)]
+        rows = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+        return np.where(sorted_keys[rows] == keys, rows, -1).astype(np.int32)
+
+    @classmethod
+    def load(cls, cursor, version=None, emission_version=None):
+        """Reads the star schema and co2emission_reduced in one snapshot"""
+        with snapshot(cursor):
+            facts = copy_columns(
+                cursor, 'fact_table f LEFT JOIN d_date d ON d.date_dim_id = f.issue_date_key', FACT_COLUMNS
+            )
+            ships = copy_columns(cursor, 'ship_dimension', SHIP_COLUMNS)
+            verifiers = copy_columns(cursor, 'verifiers', VERIFIER_COLUMNS)
+            emissions, types = load_emissions(cursor)
+            dictionaries = {
+                'ship_type': dictionary(cursor, 'ship_dimension', 'ship_type'),
+                'engine_type': dictionary(cursor, 'ship_dimension', 'engine_type'),
+                'verifier_name': dictionary(cursor, 'verifiers', 'verifier_name'),
+                'type': types,
+            }
+        return cls(facts, ships, verifiers, emissions, dictionaries, version, emission_version)
+
+    def ship_metric(self, y_axis, selected=None):
+        """
+        Values of a metric of fuel_performance_sql for the facts joined to a
+        ship, or those of them at the positions selected
+        """
+        table, column = y_axis.split('.')
+        if table == 'f':
+            return self.facts[column][self.ship_facts if selected is None else self.ship_facts[selected]]
+        return self.ships[column][self.joined_ship if selected is None else self.joined_ship[selected]]
+
+    def fuel_performance(self, y_axis, rows=None):
+        """
+        fuel_performance_query: ROLLUP(ship_type, engine_type), ship type and
+        engine descending, over the facts of the boolean array rows if given
+        """
+        types, engines = self.dictionaries['ship_type'], self.dictionaries['engine_type']
+        size = len(types) * len(engines)
+        groups, counts, fuel = self.rollup_groups, self.rollup_counts, self.rollup_fuel
+        # Positions rather than a boolean mask, which is slower to apply
+        selected = None if rows is None else np.flatnonzero(rows[self.ship_facts])
+        if selected is not None:
+            groups = groups[selected]
+            counts = np.bincount(groups, minlength=size)
+            fuel = _sums(groups, self.ship_metric('f.fuel_consumption', selected), size)
+        metric = self.ship_metric(y_axis, selected)
+        # Rows of count, metric sum and count, fuel sum and count per group,
+        # with the type and engine codes of the groups, rolled up ones coded
+        # past the end of their dictionary
+        stats = np.stack([counts, *_sums(groups, metric, size), *fuel])
+        present = np.flatnonzero(stats[0])
+        by_type = stats.reshape(len(stats), len(types), len(engines)).sum(axis=2)
+        type_present = np.flatnonzero(by_type[0])
+        total = stats.sum(axis=1, keepdims=True)[:, :1 if len(groups) else 0]
+        stats = np.concatenate([stats[:, present], by_type[:, type_present], total], axis=1)
+        type_codes = np.concatenate([present // len(engines), type_present, np.full(total.shape[1], len(types))])
+        engine_codes = np.concatenate([
+            present % len(engines), np.full(len(type_present) + total.shape[1], len(engines))
+        ])
+        counts, metrics, fuels = stats[0], _averages(stats[1], stats[2]), _averages(stats[3], stats[4])
+
+        # DESC puts NULL first, which rolled up columns and NULL values are
+        # both coded above any value
+        order = np.lexsort((-engine_codes, -type_codes))
+        ship_types = [None if code >= len(types) else types[code] for code in type_codes[order]]
+        engine_types = [None if code >= len(engines) else engines[code] for code in engine_codes[order]]
+        labels = []
+        for ship_type, engine_type in zip(ship_types, engine_types):
+            if ship_type is None and engine_type is None:
+                labels.append('Grand Total')
+            elif engine_type is None:
+                labels.append(f'Subtotal {ship_type}')
+            else:
+                labels.append(None if ship_type is None else f'{ship_type} {engine_type}')
+        return {
+            'ship_type': _objects(ship_types),
+            'engine_type': _objects(engine_types),
+            'metric': round_numeric(metrics[order]),
+            'fuelconsumption': round_numeric(fuels[order]),
+            'scaled_count': np.log(counts[order].astype(float)),
+            'label': _objects(labels),
+        }
+
+    def verifier_ranking(self, rows=None):
+        """verifier_ranking_query: average EEDI per verifier and month, ranked within the month"""
+        names = self.dictionaries['verifier_name']
+        joined = (self.fact_verifier >= 0) & (self.facts['month'] >= 0)
+        joined = np.flatnonzero(joined if rows is None else joined & rows)
+        months = self.facts['month'][joined].astype(np.int64)
+        width = int(months.max()) + 1 if len(months) else 1
+        groups = self.fact_verifier[joined] * width + months
+        size = len(names) * width
+        present = np.flatnonzero(np.bincount(groups, minlength=size))
+        verifiers, months = present // width, present % width
+        averages = round_numeric(_averages(*_sums(groups, self.facts['eedi'][joined], size))[present])
+
+        # RANK() OVER (PARTITION BY month ORDER BY average), NULL last: one
+        # more than the groups of the month before the first of equal value
+        sortable = np.where(np.isnan(averages), np.inf, averages)
+        order = np.lexsort((sortable, months))
+        positions = np.arange(len(order))
+        new_month = np.r_[True, months[order][1:] != months[order][:-1]]
+        new_value = new_month | np.r_[True, sortable[order][1:] != sortable[order][:-1]]
+        ranks = np.empty(len(order), dtype=np.int64)
+        ranks[order] = (
+            np.maximum.accumulate(np.where(new_value, positions, 0))
+            - np.maximum.accumulate(np.where(new_month, positions, 0)) + 1
+        )
+        # present is already ordered by verifier name and month
+        return {
+            'verifier_name': _objects([names[code] for code in verifiers]),
+            'month_actual': months,
+            'avg_eedi': averages,
+            'rank': ranks,
+        }
+
+    def percentile(self, y_axis, rows=None):
+        """percentile_query: PERCENTILE_CONT(0.25) and (0.75) of a metric per year built"""
+        values = self.facts[y_axis][self.year_facts].astype(float)
+        years, bounds = self.years, self.year_bounds
+        if rows is not None:
+            selected = rows[self.year_facts]
+            values = values[selected]
+            # Years of which no fact is selected have no row
+            bounds = np.append(0, np.cumsum(selected))[bounds]
+            present = bounds[1:] > bounds[:-1]
+            years, bounds = years[present], np.append(bounds[:-1][present], bounds[-1])
+        result = np.full((len(years), 2), np.nan)
+        for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+            group = values[start:end]
+            group = group[~np.isnan(group)]
+            if not len(group):
+                continue
+            positions = np.array([0.25, 0.75]) * (len(group) - 1)
+            lower, upper = np.floor(positions).astype(int), np.ceil(positions).astype(int)
+            group = np.partition(group, np.unique(np.r_[lower, upper]))
+            result[i] = group[lower] + (positions - lower) * (group[upper] - group[lower])
+        return {
+            'year_built': years.astype(np.int64),
+            'percentile_25': round_numeric(result[:, 0]),
+            'percentile_75': round_numeric(result[:, 1]),
+        }
+
+    def type_summary(self, rows=None):
+        """The type_summary query of the visual page: count, min, avg and max per type"""
+        types = self.dictionaries['type']
+        codes, values = self.emission_types, self.emission_values
+        if rows is not None:
+            codes, values = codes[rows], values[rows]
+        counts = np.bincount(codes, minlength=len(types))
+        present = np.flatnonzero(counts)
+        starts = np.searchsorted(codes, present)
+        return {
+            'type': _objects([types[code] for code in present]),
+            'count': counts[present].astype(np.int64),
+            'min': np.minimum.reduceat(values, starts) if len(values) else np.empty(0),
+            'avg': _averages(*_sums(codes, values, len(types)))[present],
+            'max': np.maximum.reduceat(values, starts) if len(values) else np.empty(0),
+        }
+
+    def chart_columns(self, view, y_axis=None, filters=None):
+        """
+        Columns of a chart, as query_columns returns those of its query, for
+        the rows with the values of filters, a dict of EMISSION_FILTERS for
+        the visual page and of FACT_FILTERS for the others -> values
+        """
+        if view == 'visual':
+            return self.type_summary(self.emission_bitmaps.mask(filters or {}))
+        rows = self.fact_bitmaps.mask(filters or {})
+        if view == 'fuel_performance':
+            return self.fuel_performance(y_axis, rows)
+        if view == 'verifiers_ranking':
+            return self.verifier_ranking(rows)
+        if view == 'built_year_efficiency':
+            return self.percentile(y_axis, rows)
+        raise ValueError(f'No chart {view}')
+
+
+@contextmanager
+def snapshot(cursor):
+    """A transaction in which the reads of cursor see one snapshot"""
+    nested = connections['default'].in_atomic_block
+    with transaction.atomic():
+        if not nested:
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+        yield
+
+
+def load_emissions(cursor):
+    """The arrays of co2emission_reduced and the dictionary of their types"""
+    return copy_columns(cursor, 'co2emission_reduced', EMISSION_COLUMNS), dictionary(cursor, 'co2emission_reduced', 'type')
+
+
+def engine(cursor):
+    """
+    Returns the engine of the current versions of the tables, loading it with
+    cursor if the star schema changed, or only the arrays of
+    co2emission_reduced if they did, as the forms write to it
+    """
+    global _engine
+    versions = querycache.current_versions(analytics.STAR_SCHEMA_TABLES + [EMISSION_TABLE])
+    emission_version = versions.pop(EMISSION_TABLE)
+    version = sum(versions.values())
+    current = _engine
+    if current is not None and (current.version, current.emission_version) == (version, emission_version):
+        return current
+    with _lock:
+        if _engine is None or _engine.version != version:
+            _engine = Engine.load(cursor, version, emission_version)
+        elif _engine.emission_version != emission_version:
+            with snapshot(cursor):
+                _engine = _engine.with_emissions(*load_emissions(cursor), emission_version)
+        return _engine
+
+
+def chart_columns(cursor, view, y_axis=None, filters=None):
+    """Columns of a chart page from the engine of the current data version"""
+    return engine(cursor).chart_columns(view, y_axis, filters)
+
+
+def chart_sql(view, y_axis=None):
+    """The query of the SQL path of a chart, from the tables rather than the materialized views"""
+    if view == 'visual':
+        return f'SELECT {aggregates.SUMMARY_COLUMNS} FROM {aggregates.SUMMARY_TABLE} ORDER BY type'
+    if view == 'fuel_performance':
+        return analytics.fuel_performance_query(y_axis, live=True)
+    if view == 'verifiers_ranking':
+        return analytics.verifier_ranking_query(live=True)
+    if view == 'built_year_efficiency':
+        return analytics.percentile_query(y_axis, live=True)
+    raise ValueError(f'No chart {view}')
+
+
+def mismatched_columns(expected, actual):
+    """Names of the columns of query_columns results that differ"""
+    mismatched = []
+    for name, values in expected.items():
+        other = actual.get(name)
+        if other is None or len(other) != len(values):
+            mismatched.append(name)
+        elif values.dtype.kind == 'f' or other.dtype.kind == 'f':
+            # Columns of NULLs only come back as objects
+            values, other = (
+                np.array([np.nan if val is None else val for val in column], dtype=float)
+                for column in (values, other)
+            )
+            if not np.allclose(values, other, rtol=1e-9, atol=ROUNDED_TOLERANCE, equal_nan=True):
+                mismatched.append(name)
+        elif values.tolist() != other.tolist():
+            mismatched.append(name)
+    return mismatched
+
+
+def compare(cursor, engine):
+    """Returns (view, y_axis, mismatched columns) of every chart"""
+    return [
+        (view, y_axis, mismatched_columns(
+            query_columns(cursor, chart_sql(view, y_axis)), engine.chart_columns(view, y_axis)
+        ))
+        for view, y_axis in CHARTS
+    ]
@@ -0,0 +1,299 @@
+"""
+Per-request performance instrumentation.
+
+PerfMiddleware counts every request and its duration per view. A sample of
+PERF_SAMPLE_RATE of the requests is recorded in detail: the number and time
+of their queries, through an execute wrapper (see concurrency.instrument),
+and the time spent in the code the views mark with timed(), such as figure
+building and serialization, and in template rendering (see
+DjangoTemplates). Sampled responses carry these timings in a Server-Timing
+header, and the metrics view exposes the counters and histograms of all
+requests in the Prometheus text format. Timings are summed over threads, so
+those of the async views, which run queries and renders at once, can add up
+to more than the request took.
+
+The metrics are kept per worker process, each of which must be scraped.
+Under ASGI, the queries of sync views run on a thread of asgiref, which the
+execute wrapper does not see.
+"""
+import asyncio
+import contextvars
+import functools
+import random
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.template.backends.django import DjangoTemplates as BaseDjangoTemplates
+from django.utils.deprecation import MiddlewareMixin
+
+from app import concurrency
+
+METRICS_PREFIX = 'maritime'
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+BYTES_BUCKETS = (1e3, 1e4, 1e5, 3e5, 1e6, 3e6, 1e7)
+
+_recorder = contextvars.ContextVar('perf_recorder', default=None)
+
+
+class Recorder:
+    """The queries and timings of a request, possibly from several threads"""
+    def __init__(self):
+        self.queries = 0
+        self.timings = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.timings[name] += seconds
+
+    def execute(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            with self._lock:
+                self.queries += 1
+                self.timings['db'] += time.perf_counter() - start
+
+
+@contextmanager
+def recording():
+    """
+    Records the queries and timings of the code run within, on this thread
+    and on the pools of app.concurrency, and yields the Recorder. Within a
+    recording already active, yields that one.
+    """
+    recorder = _recorder.get()
+    if recorder is not None:
+        yield recorder
+        return
+    recorder = Recorder()
+    token = _recorder.set(recorder)
+    try:
+        with concurrency.instrument(recorder.execute):
+            yield recorder
+    finally:
+        _recorder.reset(token)
+
+
+class timed:
+    """
+    Adds the time of a block, or of every call of a decorated function, to
+    the named timing of the recording (Server-Timing metric names are
+    tokens, so no spaces). Does nothing but a lookup when none is active.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.recorder = _recorder.get()
+        if self.recorder is not None:
+            self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        if self.recorder is not None:
+            self.recorder.add(self.name, time.perf_counter() - self.start)
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _recorder.get() is None:
+                return func(*args, **kwargs)
+            with timed(self.name):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+class _Template:
+    def __init__(self, template):
+        self._template = template
+
+    def render(self, context=None, request=None):
+        with timed('template'):
+            return self._template.render(context, request)
+
+    def __getattr__(self, name):
+        return getattr(self._template, name)
+
+
+class DjangoTemplates(BaseDjangoTemplates):
+    """The Django template backend, timing renders as 'template'"""
+    def from_string(self, template_code):
+        return _Template(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return _Template(super().get_template(template_name))
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Registry:
+    """Counters and histograms by metric name and label values"""
+    def __init__(self):
+        self.counters = defaultdict(lambda: defaultdict(float))
+        self.histograms = defaultdict(dict)
+        self.descriptions = {}
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, description, buckets=None):
+        self.descriptions[name] = description
+        if buckets is not None:
+            self.buckets[name] = buckets
+
+    def inc(self, name, labels, value=1):
+        with self._lock:
+            self.counters[name][labels] += value
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            histograms = self.histograms[name]
+            if labels not in histograms:
+                histograms[labels] = Histogram(self.buckets[name])
+            histograms[labels].observe(value)
+
+    def clear(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def exposition(self):
+        """Returns the metrics in the Prometheus text format"""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                lines += [f'# HELP {name} {self.descriptions[name]}', f'# TYPE {name} counter']
+                for labels, value in sorted(series.items()):
+                    lines.append(f'{name}{_labels(labels)} {value:g}')
+            for name, series in sorted(self.histograms.items()):
+                lines += [f'# HELP {name} {self.descriptions[name]}', f'# TYPE {name} histogram']
+                for labels, histogram in sorted(series.items()):
+                    total = 0
+                    for bound, count in zip([*histogram.buckets, '+Inf'], histogram.counts):
+                        total += count
+                        le = bound if bound == '+Inf' else f'{bound:g}'
+                        lines.append(f'{name}_bucket{_labels(labels + (("le", le),))} {total}')
+                    lines.append(f'{name}_sum{_labels(labels)} {histogram.sum:g}')
+                    lines.append(f'{name}_count{_labels(labels)} {total}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    values = ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return f'{{{values}}}'
+
+
+registry = Registry()
+
+REQUESTS = f'{METRICS_PREFIX}_requests_total'
+SAMPLED = f'{METRICS_PREFIX}_requests_sampled_total'
+DURATION = f'{METRICS_PREFIX}_request_duration_seconds'
+QUERIES = f'{METRICS_PREFIX}_request_queries'
+RESPONSE_BYTES = f'{METRICS_PREFIX}_response_bytes'
+# Label values of the request methods, any other counted as 'other'
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+# Timing -> histogram of the sampled requests
+TIMING_METRICS = {
+    'db': f'{METRICS_PREFIX}_request_db_seconds',
+    'figure': f'{METRICS_PREFIX}_request_figure_seconds',
+    'serialize': f'{METRICS_PREFIX}_request_serialize_seconds',
+    'template': f'{METRICS_PREFIX}_request_template_seconds',
+}
+registry.describe(REQUESTS, 'Requests by view, method and status')
+registry.describe(SAMPLED, 'Requests recorded in detail by view')
+registry.describe(DURATION, 'Time to the response by view', SECONDS_BUCKETS)
+registry.describe(QUERIES, 'Queries per sampled request by view', QUERIES_BUCKETS)
+registry.describe(RESPONSE_BYTES, 'Response size of sampled requests by view', BYTES_BUCKETS)
+for timing, metric in TIMING_METRICS.items():
+    registry.describe(metric, f'Time in {timing} per sampled request by view', SECONDS_BUCKETS)
+
+
+def server_timing(recorder, total):
+    """Returns the Server-Timing header value of a recorded request"""
+    metrics = [f'db;dur={recorder.timings["db"] * 1000:.1f};desc="{recorder.queries} queries"']
+    metrics += [
+        f'{name};dur={seconds * 1000:.1f}'
+        for name, seconds in recorder.timings.items() if name != 'db'
+    ]
+    metrics.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(metrics)
+
+
+class PerfMiddleware(MiddlewareMixin):
+    """
+    Counts requests and times them per view, and records a sample of
+    PERF_SAMPLE_RATE of them (and any made within a recording) in detail.
+    Runs without a thread switch in front of both sync and async views.
+    """
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if not self.sampled():
+            start = time.perf_counter()
+            response = self.get_response(request)
+            self.count(request, response, time.perf_counter() - start)
+            return response
+        start = time.perf_counter()
+        with recording() as recorder:
+            response = self.get_response(request)
+        self.record(request, response, recorder, time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        if not self.sampled():
+            start = time.perf_counter()
+            response = await self.get_response(request)
+            self.count(request, response, time.perf_counter() - start)
+            return response
+        start = time.perf_counter()
+        with recording() as recorder:
+            response = await self.get_response(request)
+        self.record(request, response, recorder, time.perf_counter() - start)
+        return response
+
+    @staticmethod
+    def sampled():
+        rate = settings.PERF_SAMPLE_RATE
+        return _recorder.get() is not None or (rate > 0 and random.random() < rate)
+
+    @staticmethod
+    def view_labels(request):
+        match = getattr(request, 'resolver_match', None)
+        # Only names of routes, so that the label values are bounded
+        return (('view', (match.url_name or match.view_name) if match else 'unresolved'),)
+
+    def count(self, request, response, total):
+        labels = self.view_labels(request)
+        method = request.method if request.method in METHODS else 'other'
+        registry.inc(REQUESTS, labels + (('method', method), ('status', response.status_code)))
+        registry.observe(DURATION, labels, total)
+        return labels
+
+    def record(self, request, response, recorder, total):
+        response['Server-Timing'] = server_timing(recorder, total)
+        labels = self.count(request, response, total)
+        registry.inc(SAMPLED, labels)
+        registry.observe(QUERIES, labels, recorder.queries)
+        for timing, metric in TIMING_METRICS.items():
+            registry.observe(metric, labels, recorder.timings[timing])
+        if not response.streaming:
+            registry.observe(RESPONSE_BYTES, labels, len(response.content))
@@ -0,0 +1,97 @@
+"""
+Query plan regression checks, run with `python manage.py check_plans`.
+
+The queries behind the pages are captured while requesting them with the
+test client, then run again under EXPLAIN (ANALYZE, BUFFERS). A sequential
+scan is a regression when it reads at least min_rows rows, so that scans of
+small tables (type_summary, the materialized views) pass at any data scale
+while a missing index on a large table fails.
+"""
+from django.core.cache import caches
+from django.test import Client
+
+from app import caching, concurrency, querycache
+from app.views import COLUMNS
+
+# Tables that must hold at least min_rows rows for the check to mean anything
+SCALE_TABLES = ['co2emission_reduced', 'fact_table']
+
+
+def page_paths(cursor):
+    """Paths of the pages to check, with an IMO of the data for the detail page"""
+    cursor.execute('SELECT imo FROM co2emission_reduced ORDER BY imo LIMIT 1')
+    row = cursor.fetchone()
+    return [
+        *[f'/emissions/?order_by={col}' for col in COLUMNS],
+        *([f'/emissions/imo/{row[0]}'] if row else []),
+        '/aggregation/',
+        '/compliance/',
+        '/visual/',
+        '/dashboard/',
+        '/fuel_performance/',
+        '/verifiers_ranking/',
+        '/built_year_efficiency/',
+        '/api/v1/visual',
+    ]
+
+
+def capture_queries(paths, client=None):
+    """Requests paths and returns the (path, sql, params) of the SELECTs they ran"""
+    client = client or Client()
+    queries = []
+    current = {}
+
+    def capture(execute, sql, params, many, context):
+        if not many and sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+            queries.append((current['path'], sql, params))
+        return execute(sql, params, many, context)
+
+    with concurrency.instrument(capture):
+        for path in paths:
+            current['path'] = path
+            # Cold caches, so that the queries run
+            caching.bump_data_version()
+            caches[querycache.QUERY_CACHE].clear()
+            client.get(path)
+    return queries
+
+
+def explain(cursor, sql, params=None):
+    """Runs a query under EXPLAIN (ANALYZE, BUFFERS) and returns its JSON plan"""
+    cursor.execute(f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}', params)
+    return cursor.fetchone()[0][0]
+
+
+def plan_nodes(node):
+    yield node
+    for child in node.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+def seq_scans(plan, min_rows):
+    """Returns (relation, rows read) of the sequential scans of at least min_rows rows"""
+    scans = []
+    for node in plan_nodes(plan['Plan']):
+        if node['Node Type'] != 'Seq Scan':
+            continue
+        rows = (node['Actual Rows'] + node.get('Rows Removed by Filter', 0)) * node['Actual Loops']
+        if rows >= min_rows:
+            scans.append((node['Relation Name'], rows))
+    return scans
+
+
+def check(cursor, paths, min_rows):
+    """Returns a result row per query of the pages, with its sequential scans"""
+    results = []
+    for path, sql, params in capture_queries(paths):
+        plan = explain(cursor, sql, params)
+        root = plan['Plan']
+        results.append({
+            'path': path,
+            'query': ' '.join(sql.split())[:60],
+            'ms': plan['Execution Time'],
+            'shared_hit': root.get('Shared Hit Blocks', 0),
+            'shared_read': root.get('Shared Read Blocks', 0),
+            'seq_scans': ', '.join(f'{relation} ({rows} rows)' for relation, rows in seq_scans(plan, min_rows)),
+        })
+    return results
@@ -0,0 +1,257 @@
+"""
+Query result cache shared by the worker processes, invalidated through
+PostgreSQL LISTEN/NOTIFY.
+
+Results are cached in the 'queries' cache under the normalized SQL and
+parameters of the query and the versions of the tables it reads, its tags.
+Statement-level triggers on every table in TAGGED_TABLES (see migration
+0011) bump the version of their table in cache_tag_versions and NOTIFY the
+new version on the CHANNEL when their transaction commits. A listener
+thread in each worker process keeps the versions it is told about, so a
+write from any process or from psql makes the cached results of that table
+unreachable everywhere. They can then be kept for QUERY_CACHE_TIMEOUT, far
+longer than anything keyed by the data version of app.caching, which every
+write bumps.
+
+A notification reaches the other processes a few milliseconds after the
+commit. The writing process reads the versions itself (see sync) so that
+it never shows its own writes stale. Queries in a transaction bypass the
+cache, as it may have written to the tables and roll back: its rows, cached
+under the versions it bumped, would be served once a later write commits
+the same versions. Until the listener is connected, and while it
+reconnects, the versions are read from cache_tag_versions on every lookup,
+which costs a query but is never stale.
+
+Concurrent writes to a table queue on its row of cache_tag_versions until
+they commit.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import select
+import threading
+
+import psycopg2
+import psycopg2.extensions
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+
+from app.utils import row_type
+
+logger = logging.getLogger(__name__)
+
+QUERY_CACHE = 'queries'
+CHANNEL = 'query_cache'
+VERSIONS_TABLE = 'cache_tag_versions'
+# Tables whose writes invalidate the results that read them
+TAGGED_TABLES = [
+    'co2emission_reduced', 'type_summary', 'eedi_compliance',
+    'fact_table', 'ship_dimension', 'verifiers', 'd_date',
+]
+POLL_SEC = 5
+RECONNECT_SEC = 5
+
+CREATE_SQL = f'''
+    CREATE TABLE IF NOT EXISTS {VERSIONS_TABLE} (
+        tag TEXT PRIMARY KEY,
+        version BIGINT NOT NULL
+    );
+    CREATE OR REPLACE FUNCTION bump_cache_tag() RETURNS trigger AS $$
+    DECLARE
+        new_version BIGINT;
+    BEGIN
+        INSERT INTO {VERSIONS_TABLE} AS t (tag, version) VALUES (TG_TABLE_NAME, 1)
+        ON CONFLICT (tag) DO UPDATE SET version = t.version + 1
+        RETURNING version INTO new_version;
+        PERFORM pg_notify('{CHANNEL}', TG_TABLE_NAME || ' ' || new_version);
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+'''
+
+
+def trigger_sql(table):
+    return f'''
+        DROP TRIGGER IF EXISTS {table}_cache_tag ON {table};
+        CREATE TRIGGER {table}_cache_tag
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+        FOR EACH STATEMENT EXECUTE PROCEDURE bump_cache_tag();
+    '''
+
+
+_TABLE_PATTERN = re.compile(r'\b({})\b'.format('|'.join(TAGGED_TABLES)))
+
+_versions = {}
+_lock = threading.Lock()
+_listener = None
+
+
+def normalize(sql):
+    """The SQL of a query with its whitespace collapsed"""
+    return ' '.join(sql.split())
+
+
+def tables_read(sql):
+    """The tagged tables named in a query, sorted"""
+    return sorted(set(_TABLE_PATTERN.findall(sql)))
+
+
+def _set_versions(rows):
+    with _lock:
+        for tag, version in rows:
+            # Notifications may arrive after the versions were read
+            _versions[tag] = max(version, _versions.get(tag, 0))
+
+
+def read_versions(cursor, tags):
+    """The versions of tags in cache_tag_versions, 0 for tables never written"""
+    cursor.execute(f'SELECT tag, version FROM {VERSIONS_TABLE} WHERE tag = ANY(%s)', [list(tags)])
+    versions = dict.fromkeys(tags, 0)
+    versions.update(cursor.fetchall())
+    return versions
+
+
+def sync(cursor=None):
+    """
+    Reads the versions of every tag, for the process that just wrote to a
+    table to see its write without waiting for the notification
+    """
+    if cursor is None:
+        with connections['default'].cursor() as cursor:
+            return sync(cursor)
+    _set_versions(read_versions(cursor, TAGGED_TABLES).items())
+
+
+class Listener(threading.Thread):
+    """LISTENs on CHANNEL on a connection of its own and records the versions notified"""
+    def __init__(self, conn_params):
+        super().__init__(name='querycache-listener', daemon=True)
+        self.conn_params = conn_params
+        self.pid = os.getpid()
+        self.connected = threading.Event()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.listen()
+            except (psycopg2.Error, OSError):
+                logger.warning('Query cache listener disconnected, retrying', exc_info=True)
+            self.connected.clear()
+            self.stopped.wait(RECONNECT_SEC)
+
+    def listen(self):
+        conn = psycopg2.connect(**self.conn_params)
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cursor:
+                cursor.execute(f'LISTEN {CHANNEL}')
+                # After LISTEN, so that no write falls in between
+                cursor.execute(f'SELECT tag, version FROM {VERSIONS_TABLE}')
+                _set_versions(cursor.fetchall())
+            self.connected.set()
+            while not self.stopped.is_set():
+                if select.select([conn], [], [], POLL_SEC) == ([], [], []):
+                    continue
+                conn.poll()
+                rows = []
+                while conn.notifies:
+                    tag, version = conn.notifies.pop(0).payload.rsplit(' ', 1)
+                    rows.append((tag, int(version)))
+                _set_versions(rows)
+        finally:
+            conn.close()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def listener():
+    """The listener of this process, started on first use (after any fork)"""
+    global _listener
+    current = _listener
+    if current is not None and current.pid == os.getpid():
+        return current
+    with _lock:
+        if _listener is None or _listener.pid != os.getpid():
+            _versions.clear()
+            _listener = Listener(connections['default'].get_connection_params())
+            _listener.start()
+        return _listener
+
+
+def _notified_versions(tags):
+    # The versions of tags as notified, None while not listening
+    if settings.QUERY_CACHE_LISTEN and listener().connected.is_set():
+        with _lock:
+            return {tag: _versions.get(tag, 0) for tag in tags}
+    return None
+
+
+def tag_versions(cursor, tags):
+    """The current versions of tags, as notified or else read"""
+    versions = _notified_versions(tags)
+    return read_versions(cursor, tags) if versions is None else versions
+
+
+def current_versions(tags):
+    """tag_versions, connecting only if they must be read"""
+    versions = _notified_versions(tags)
+    if versions is None:
+        with connections['default'].cursor() as cursor:
+            versions = read_versions(cursor, tags)
+    return versions
+
+
+def bump(tag):
+    """
+    Bumps the version of a tag of no table, as the triggers do those of the
+    tables, and returns it. Takes effect when the transaction commits.
+    """
+    with connections['default'].cursor() as cursor:
+        cursor.execute(f'''
+            INSERT INTO {VERSIONS_TABLE} AS t (tag, version) VALUES (%s, 1)
+            ON CONFLICT (tag) DO UPDATE SET version = t.version + 1
+            RETURNING version
+        ''', [tag])
+        version = cursor.fetchone()[0]
+        cursor.execute('SELECT pg_notify(%s, %s)', [CHANNEL, f'{tag} {version}'])
+    _set_versions([(tag, version)])
+    return version
+
+
+def cache_key(sql, params, versions):
+    payload = json.dumps([normalize(sql), params], default=str)
+    digest = hashlib.md5(payload.encode()).hexdigest()
+    tags = '-'.join(f'{tag}.{version}' for tag, version in sorted(versions.items()))
+    return f'QUERY-{digest}-{tags}'
+
+
+def _execute(cursor, sql, params):
+    # Column names and rows, as namedtuples do not pickle
+    cursor.execute(sql, params)
+    return tuple(col[0] for col in cursor.description), cursor.fetchall()
+
+
+def fetchall(cursor, sql, params=None):
+    """
+    Runs a query and returns its rows as namedtuplefetchall does, from the
+    cache while none of the tagged tables it reads has been written to.
+    Queries of no tagged table, and queries in a transaction, are not cached.
+    """
+    tags = tables_read(sql)
+    in_transaction = connections['default'].in_atomic_block
+    if tags and settings.QUERY_CACHE_TIMEOUT and not in_transaction:
+        cache = caches[QUERY_CACHE]
+        key = cache_key(sql, params, tag_versions(cursor, tags))
+        result = cache.get(key)
+        if result is None:
+            result = _execute(cursor, sql, params)
+            cache.set(key, result, timeout=settings.QUERY_CACHE_TIMEOUT)
+    else:
+        result = _execute(cursor, sql, params)
+    columns, rows = result
+    return list(map(row_type(columns)._make, rows))
@@ -0,0 +1,148 @@
+"""
+Tables of the star schema and co2emission_reduced, with their keys and the
+indexes that serve the queries of the pages, the loaders and the analytics
+materialized views.
+
+Migration 0008 created them from a copy of these definitions as they were
+then. Databases set up earlier from the scripts in eda/ and
+create_co2_table.sql keep their tables, and only get the keys and indexes
+they miss, after their duplicate facts are removed.
+"""
+
+TABLES = {
+    'd_date': '''
+        CREATE TABLE IF NOT EXISTS d_date (
+            date_dim_id INT NOT NULL PRIMARY KEY,
+            date_actual DATE NOT NULL,
+            month_actual INT NOT NULL,
+            month_name VARCHAR(9) NOT NULL,
+            month_name_abbreviated CHAR(3) NOT NULL,
+            quarter_actual CHAR(2) NOT NULL,
+            quarter_name VARCHAR(9) NOT NULL,
+            year_actual INT NOT NULL,
+            mmyyyy CHAR(6) NOT NULL,
+            mmddyyyy CHAR(10) NOT NULL
+        );
+    ''',
+    'ship_dimension': '''
+        CREATE TABLE IF NOT EXISTS ship_dimension (
+            ship_key BIGINT NOT NULL PRIMARY KEY,
+            ship_name VARCHAR(64),
+            ship_type VARCHAR(64),
+            call_sign VARCHAR(10) NOT NULL,
+            speed REAL NOT NULL,
+            year_built INT NOT NULL,
+            length REAL NOT NULL,
+            width REAL NOT NULL,
+            tonnage REAL NOT NULL,
+            engine_type VARCHAR(64) NOT NULL,
+            mmsi BIGINT NOT NULL
+        );
+    ''',
+    'verifiers': '''
+        CREATE TABLE IF NOT EXISTS verifiers (
+            verifier_key BIGINT NOT NULL PRIMARY KEY,
+            verifier_name VARCHAR(128) NOT NULL,
+            verifier_number VARCHAR(64) NOT NULL,
+            verifier_nab VARCHAR(128) NOT NULL,
+            verifier_address VARCHAR(128) NOT NULL,
+            verifier_city VARCHAR(64) NOT NULL,
+            verifier_country VARCHAR(64) NOT NULL
+        );
+    ''',
+    # fact_key comes last, as tables loaded from eda/ get it added
+    'fact_table': '''
+        CREATE TABLE IF NOT EXISTS fact_table (
+            imo BIGINT,
+            fuel_consumption REAL,
+            sea_time REAL,
+            co2_distance REAL,
+            co2_transport REAL,
+            eedi REAL,
+            verifier_key BIGINT,
+            ship_key BIGINT,
+            issue_date_key BIGINT,
+            expiry_date_key BIGINT,
+            fact_key BIGINT GENERATED BY DEFAULT AS IDENTITY
+        );
+        ALTER TABLE fact_table ADD COLUMN IF NOT EXISTS fact_key BIGINT GENERATED BY DEFAULT AS IDENTITY;
+    ''',
+    'co2emission_reduced': '''
+        CREATE TABLE IF NOT EXISTS co2emission_reduced (
+            imo BIGINT PRIMARY KEY,
+            ship_name VARCHAR(64) NOT NULL,
+            type VARCHAR(64) NOT NULL,
+            issue DATE NOT NULL,
+            expiry DATE NOT NULL,
+            technical_efficiency_number REAL NOT NULL
+        );
+    ''',
+}
+
+# (table, constraint, definition). Foreign keys are NOT VALID so that adding
+# them does not fail on rows loaded before, they hold for every new row.
+CONSTRAINTS = [
+    ('d_date', 'd_date_pkey', 'PRIMARY KEY (date_dim_id)'),
+    ('ship_dimension', 'ship_dimension_pkey', 'PRIMARY KEY (ship_key)'),
+    ('verifiers', 'verifiers_pkey', 'PRIMARY KEY (verifier_key)'),
+    ('fact_table', 'fact_table_pkey', 'PRIMARY KEY (fact_key)'),
+    ('fact_table', 'fact_table_issue_date_key_fkey',
+     'FOREIGN KEY (issue_date_key) REFERENCES d_date (date_dim_id) NOT VALID'),
+    ('fact_table', 'fact_table_expiry_date_key_fkey',
+     'FOREIGN KEY (expiry_date_key) REFERENCES d_date (date_dim_id) NOT VALID'),
+    ('fact_table', 'fact_table_verifier_key_fkey',
+     'FOREIGN KEY (verifier_key) REFERENCES verifiers (verifier_key) NOT VALID'),
+    ('fact_table', 'fact_table_ship_key_fkey',
+     'FOREIGN KEY (ship_key) REFERENCES ship_dimension (ship_key) NOT VALID'),
+]
+
+
+def _index(name, definition, unique=False):
+    return name, f'CREATE {"UNIQUE " if unique else ""}INDEX IF NOT EXISTS {name} ON {definition}'
+
+
+# Index -> statement of every index on the tables, including those that
+# earlier migrations only created if the tables already existed
+INDEXES = dict([
+    # One DoC per ship and issue date, the key the MRV loader replaces facts
+    # by, in the order compliance reads the latest DoC of each ship. The
+    # loader keeps it unique, facts loaded otherwise must be deduplicated
+    # first (see migration 0008)
+    _index('fact_table_imo_issue_date_key_idx', 'fact_table (imo, issue_date_key DESC)', unique=True),
+    # The joins to the dimensions, covering the metrics the analytics
+    # queries aggregate so that they can be answered from the index
+    _index('fact_table_ship_key_idx', 'fact_table (ship_key) '
+           'INCLUDE (eedi, fuel_consumption, sea_time, co2_distance, co2_transport)'),
+    _index('fact_table_verifier_key_idx', 'fact_table (verifier_key, issue_date_key) INCLUDE (eedi)'),
+    # Facts are loaded a year at a time, so the date keys follow the
+    # physical order and a BRIN index of a few pages serves date ranges
+    _index('fact_table_issue_date_key_brin', 'fact_table USING brin (issue_date_key)'),
+    _index('fact_table_expiry_date_key_brin', 'fact_table USING brin (expiry_date_key)'),
+    # Keyset pagination on every sortable column of the emissions page
+    *[
+        _index(f'co2emission_reduced_{col}_imo_idx', f'co2emission_reduced ({col}, imo)')
+        for col in ['ship_name', 'type', 'technical_efficiency_number', 'issue', 'expiry']
+    ],
+    # Per type min and max of the maintained type_summary table
+    _index('co2emission_reduced_type_ten_idx', 'co2emission_reduced (type, technical_efficiency_number)'),
+])
+
+
+def add_constraint(table, name, definition):
+    """Adds a constraint unless the table has it, or any primary key for a primary key"""
+    if definition.startswith('PRIMARY KEY'):
+        exists = "contype = 'p'"
+    else:
+        exists = f"conname = '{name}'"
+    return f'''
+        DO $$
+        BEGIN
+            IF NOT EXISTS (
+                SELECT 1 FROM pg_constraint WHERE conrelid = '{table}'::regclass AND {exists}
+            ) THEN
+                ALTER TABLE {table} ADD CONSTRAINT {name} {definition};
+            END IF;
+        END
+        $$;
+    '''
+
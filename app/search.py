@@ -0,0 +1,164 @@
+"""
+Typeahead search of ships by name, IMO number, call sign or MMSI.
+
+Names and IMO numbers are matched in co2emission_reduced, so that ships
+written through the app are found straight away. Call signs and MMSIs are
+matched in ship_identifiers, which links the ship_dimension rows to IMO
+numbers (see mrv.ship_keys_by_imo) and is rebuilt whenever the star schema
+is loaded. Names are matched by prefix with a pattern index and by
+similarity with a pg_trgm GIN index, call signs by prefix with a pg_trgm GIN
+index and numbers by prefix with range scans. Prefix matches come first, then
+the rest ranked by similarity.
+
+Results are cached for a short while, which absorbs the same prefixes being
+typed again and again.
+"""
+from django.db import connections
+
+from app import caching
+from app.mrv import ship_keys_by_imo
+
+IDENTIFIERS_TABLE = 'ship_identifiers'
+SEARCH_LIMIT = 10
+SEARCH_MAX_LIMIT = 50
+# One character matches a large part of the fleet and is never useful
+SEARCH_MIN_LENGTH = 2
+# Shorter queries have too few trigrams to tell similar names apart
+FUZZY_MIN_LENGTH = 3
+SEARCH_CACHE_SEC = 60
+IMO_DIGITS = 7
+MMSI_DIGITS = 9
+
+IDENTIFIERS_DDL = f'''
+    CREATE TABLE IF NOT EXISTS {IDENTIFIERS_TABLE} (
+        imo BIGINT PRIMARY KEY,
+        ship_key BIGINT NOT NULL,
+        call_sign VARCHAR(10),
+        mmsi BIGINT
+    );
+'''
+
+# Table -> index statements, also used by the search benchmark
+INDEXES = {
+    'co2emission_reduced': [
+        'CREATE INDEX IF NOT EXISTS co2emission_reduced_ship_name_trgm_idx '
+        'ON co2emission_reduced USING gin (ship_name gin_trgm_ops)',
+        'CREATE INDEX IF NOT EXISTS co2emission_reduced_ship_name_prefix_idx '
+        'ON co2emission_reduced (upper(ship_name) text_pattern_ops)',
+    ],
+    IDENTIFIERS_TABLE: [
+        f'CREATE INDEX IF NOT EXISTS {IDENTIFIERS_TABLE}_call_sign_trgm_idx '
+        f'ON {IDENTIFIERS_TABLE} USING gin (call_sign gin_trgm_ops)',
+        f'CREATE INDEX IF NOT EXISTS {IDENTIFIERS_TABLE}_mmsi_idx ON {IDENTIFIERS_TABLE} (mmsi)',
+    ],
+}
+
+
+def rebuild(cursor):
+    """Fills ship_identifiers again from ship_dimension, must run in a transaction"""
+    ship_keys = ship_keys_by_imo(cursor)
+    cursor.execute(f'TRUNCATE {IDENTIFIERS_TABLE}')
+    cursor.execute(f'''
+        INSERT INTO {IDENTIFIERS_TABLE} (imo, ship_key, call_sign, mmsi)
+        SELECT k.imo, k.ship_key, d.call_sign, d.mmsi
+        FROM unnest(%s::bigint[], %s::bigint[]) AS k (imo, ship_key)
+        JOIN ship_dimension d ON d.ship_key = k.ship_key;
+    ''', [list(ship_keys), list(ship_keys.values())])
+    cursor.execute(f'ANALYZE {IDENTIFIERS_TABLE}')
+
+
+def normalize(query):
+    """Collapses whitespace, so that queries typed differently share a cache entry"""
+    return ' '.join(query.split()).upper()
+
+
+def digit_range(digits, width):
+    """
+    Returns the (first, last) numbers of width digits that start with a string
+    of digits, or None if it cannot start one.
+    """
+    if not digits.isdigit() or len(digits) > width:
+        return None
+    scale = 10 ** (width - len(digits))
+    return int(digits) * scale, (int(digits) + 1) * scale - 1
+
+
+def like_prefix(query):
+    return query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def search_query(query):
+    """Returns the search SQL for a normalized query and its parameters"""
+    params = {'query': query, 'prefix': like_prefix(query)}
+    # Each returns up to limit (imo, score), prefix matches scoring over 1
+    # and similar names below, so a ship can be matched more than once
+    matches = [
+        # A range scan of the pattern index, in its order (~<~), which stops
+        # after limit rows however many names start with a short prefix
+        '''
+        SELECT imo, 1 + similarity(ship_name, %(query)s) FROM co2emission_reduced
+        WHERE upper(ship_name) LIKE %(prefix)s
+        ORDER BY upper(ship_name) USING ~<~ LIMIT %(limit)s
+        ''',
+        f'''
+        SELECT imo, 1 + similarity(call_sign, %(query)s) FROM {IDENTIFIERS_TABLE}
+        WHERE call_sign LIKE %(prefix)s
+        ORDER BY call_sign LIMIT %(limit)s
+        ''',
+    ]
+    if len(query) >= FUZZY_MIN_LENGTH:
+        matches.append('''
+        SELECT imo, similarity(ship_name, %(query)s) FROM co2emission_reduced
+        WHERE ship_name %% %(query)s
+        ORDER BY 2 DESC LIMIT %(limit)s
+        ''')
+    imo_range = digit_range(query, IMO_DIGITS)
+    if imo_range:
+        params['imo_first'], params['imo_last'] = imo_range
+        matches.append('''
+        SELECT imo, 2 FROM co2emission_reduced
+        WHERE imo BETWEEN %(imo_first)s AND %(imo_last)s
+        ORDER BY imo LIMIT %(limit)s
+        ''')
+    mmsi_range = digit_range(query, MMSI_DIGITS)
+    if mmsi_range:
+        params['mmsi_first'], params['mmsi_last'] = mmsi_range
+        matches.append(f'''
+        SELECT imo, 2 FROM {IDENTIFIERS_TABLE}
+        WHERE mmsi BETWEEN %(mmsi_first)s AND %(mmsi_last)s
+        ORDER BY mmsi LIMIT %(limit)s
+        ''')
+
+    sql = f'''
+        WITH matches (imo, score) AS ({" UNION ALL ".join(f"({match})" for match in matches)})
+        SELECT e.imo, e.ship_name, e.type, i.call_sign, i.mmsi, MAX(m.score) AS score
+        FROM matches m
+        JOIN co2emission_reduced e ON e.imo = m.imo
+        LEFT JOIN {IDENTIFIERS_TABLE} i ON i.imo = m.imo
+        GROUP BY e.imo, i.imo
+        ORDER BY score DESC, e.ship_name, e.imo
+        LIMIT %(limit)s;
+    '''
+    return sql, params
+
+
+def search(cursor, query, limit=SEARCH_LIMIT):
+    """Returns up to limit ships matching a query as dicts, best matches first"""
+    query = normalize(query)
+    if len(query) < SEARCH_MIN_LENGTH:
+        return []
+    sql, params = search_query(query)
+    cursor.execute(sql, {**params, 'limit': limit})
+    columns = [col[0] for col in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def cached_search(query, limit=SEARCH_LIMIT):
+    """search, cached for SEARCH_CACHE_SEC and the current data version"""
+    def build():
+        with connections['default'].cursor() as cursor:
+            return search(cursor, query, limit)
+
+    return caching.cached_value(
+        'SEARCH', {'query': normalize(query), 'limit': limit}, build, timeout=SEARCH_CACHE_SEC
+    )
@@ -0,0 +1,109 @@
+"""
+Mergeable quantile sketches of the fact metrics.
+
+A sketch is a count of values per logarithmic bucket (the DDSketch layout):
+bucket k holds the values in (GAMMA^(k-1), GAMMA^k] and stands for
+2 GAMMA^k / (GAMMA + 1), which is within RELATIVE_ACCURACY of every value
+in it. Negative values are bucketed by their absolute value with a negative
+key and values closer to zero than MIN_VALUE share key 0, so that keys sort
+like the values. Sketches merge by adding the counts of equal keys, which
+SQL does with unnest and SUM.
+
+The materialized views mv_quantile_sketch_<metric> (see app.analytics) hold a
+sketch per year built, ship type, verifier and issue month, built by
+refresh_analytics after every load. Any quantile of the facts under any
+filter on those columns is then read from the merged sketches without
+touching fact_table.
+
+Error bound: a quantile interpolated between two ranks like PERCENTILE_CONT
+is within RELATIVE_ACCURACY (1%) of the exact value relative to it, when the
+values of the two ranks have the same sign, and within MIN_VALUE of it near
+zero. Unlike t-digest or KLL sketches the bound does not depend on the rank
+or the number of values, and a sketch never has more buckets than values.
+"""
+import math
+
+import numpy as np
+
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LN_GAMMA = math.log(GAMMA)
+MIN_VALUE = 1e-9
+# Added to the bucket index of values of MIN_VALUE and up so that it is at least 1
+BIAS = 1 - math.floor(math.log(MIN_VALUE) / LN_GAMMA)
+
+
+def bucket_sql(expression):
+    """SQL of the bucket key of a value, NULL for NULL"""
+    return (
+        f'CASE WHEN ABS({expression}) < {MIN_VALUE!r} THEN 0 '
+        f'ELSE SIGN({expression})::INT * (CEIL(LN(ABS({expression})::DOUBLE PRECISION) / {LN_GAMMA!r}) + {BIAS})::INT END'
+    )
+
+
+def bucket_keys(values):
+    """Bucket keys of an array of values, as bucket_sql computes them"""
+    values = np.asarray(values, dtype=float)
+    magnitudes = np.abs(values)
+    with np.errstate(divide='ignore'):
+        keys = np.ceil(np.log(np.maximum(magnitudes, MIN_VALUE)) / LN_GAMMA) + BIAS
+    return np.where(magnitudes < MIN_VALUE, 0, np.sign(values) * keys).astype(np.int64)
+
+
+def bucket_values(keys):
+    """The values that the buckets of keys stand for"""
+    keys = np.asarray(keys, dtype=np.int64)
+    values = 2 * GAMMA ** (np.abs(keys) - BIAS).astype(float) / (GAMMA + 1)
+    return np.where(keys == 0, 0.0, np.sign(keys) * values)
+
+
+def sketch(values):
+    """The sorted keys and counts of the sketch of an array of values, NaN left out"""
+    values = np.asarray(values, dtype=float)
+    return np.unique(bucket_keys(values[~np.isnan(values)]), return_counts=True)
+
+
+def merge(*sketches):
+    """Merges sketches of (keys, counts) into one"""
+    keys = np.concatenate([keys for keys, _ in sketches])
+    counts = np.concatenate([counts for _, counts in sketches])
+    merged, positions = np.unique(keys, return_inverse=True)
+    return merged, np.bincount(positions.ravel(), weights=counts, minlength=len(merged)).astype(np.int64)
+
+
+def quantiles(keys, counts, qs):
+    """
+    Quantiles of a sketch of sorted keys, interpolated between ranks like
+    PERCENTILE_CONT, NaN if it is empty
+    """
+    qs = np.asarray(qs, dtype=float)
+    ends = np.cumsum(counts)
+    if not len(ends) or ends[-1] == 0:
+        return np.full(len(qs), np.nan)
+    positions = qs * (ends[-1] - 1)
+    lower, upper = np.floor(positions), np.ceil(positions)
+    # The bucket of rank r is the first whose cumulative count exceeds it
+    values = bucket_values(keys)
+    lower_values = values[np.searchsorted(ends, lower, side='right')]
+    upper_values = values[np.searchsorted(ends, upper, side='right')]
+    return lower_values + (positions - lower) * (upper_values - lower_values)
+
+
+def quantile_columns(columns, qs):
+    """
+    Turns the merged buckets of analytics.quantile_sketch_query, ordered by
+    year built and key, into columns of the year built, the number of values
+    and each quantile (percentile_<q * 100>)
+    """
+    years, starts = np.unique(columns['year_built'], return_index=True)
+    bounds = np.append(starts, len(columns['year_built'])).astype(np.int64)
+    counts = columns['count'].astype(np.int64)
+    results = np.array([
+        quantiles(columns['bucket'][start:end], counts[start:end], qs)
+        for start, end in zip(bounds[:-1], bounds[1:])
+    ]).reshape(len(years), len(qs))
+    return {
+        'year_built': years.astype(np.int64),
+        'count': np.add.reduceat(counts, starts) if len(counts) else np.empty(0, dtype=np.int64),
+        **{f'percentile_{q * 100:g}': results[:, i] for i, q in enumerate(qs)},
+    }
@@ -1,7 +1,65 @@
 from django.contrib.auth.models import AnonymousUser, User
-from django.test import TestCase, RequestFactory
+import asyncio
+import base64
+import json
+import os
+import random
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from decimal import Decimal
+from unittest import mock
 
-from .views import index
+import numpy as np
+import pandas as pd
+import psycopg2
+import psycopg2.extensions
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from django.http import HttpResponse
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, RequestFactory, override_settings
+
+from core.db import pool
+from . import aggregates, analytics, batches, benchmarks, caching, concurrency, dimensions, fleet, olap, perf, plans, querycache, search, sketches, views
+from .aggregates import SUMMARY_COLUMNS, SUMMARY_TABLE
+from .compliance import evaluate
+from .figures import encode_arrays
+from .forms import ImoForm
+from .benchmarks import ListCursor
+from .utils import encode_cursor, decode_cursor, fetch_columns, namedtuplefetchall, namedtupleiter
+from .views import index, insert_update_values, delete_values, api_etag, token_key
+
+LOCMEM_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'default'},
+    'dimensions': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'dimensions'},
+    'queries': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'queries'},
+    'versions': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'versions'},
+}
+
+
+def fake_tag_versions(test):
+    """
+    Keeps the tag versions of app.querycache, and so the data version, in a
+    dict for the duration of a test without a database
+    """
+    versions = {}
+
+    def bump(tag):
+        versions[tag] = versions.get(tag, 0) + 1
+        return versions[tag]
+
+    for patch in [
+        mock.patch.object(querycache, 'current_versions', lambda tags: {tag: versions.get(tag, 0) for tag in tags}),
+        mock.patch.object(querycache, 'bump', bump),
+        mock.patch.object(querycache, 'sync', lambda cursor=None: None),
+    ]:
+        patch.start()
+        test.addCleanup(patch.stop)
+    return versions
 
 
 class SimpleTest(TestCase):
@@ -17,3 +75,901 @@ class SimpleTest(TestCase):
         # Test my_view() as if it were deployed at /customer/details
         response = index(request)
         self.assertEqual(response.status_code, 200)
+
+
+class CursorTokenTest(SimpleTestCase):
+    def test_round_trip(self):
+        token = encode_cursor([date(2021, 3, 5), 9070620], 12)
+        self.assertEqual(decode_cursor(token), (['2021-03-05', 9070620], 12))
+
+    def test_malformed_token(self):
+        self.assertIsNone(decode_cursor(''))
+        self.assertIsNone(decode_cursor('not-a-token'))
+
+    def test_token_of_other_order(self):
+        token = decode_cursor(encode_cursor([date(2021, 3, 5), 9070620], 12))
+        self.assertEqual(token_key(token, ['issue', 'imo']), ([date(2021, 3, 5), 9070620], 12))
+        # Wrong arity, as for a link of another order_by, or wrong types
+        self.assertIsNone(token_key(token, ['imo']))
+        self.assertIsNone(token_key(token, ['technical_efficiency_number', 'imo']))
+        self.assertIsNone(token_key(decode_cursor(encode_cursor(['x', '9070620'], 2)), ['type', 'imo']))
+        self.assertIsNone(token_key(None, ['imo']))
+
+    def test_numbered_page_redirects(self):
+        # Old numbered links start at the first keyset page, without OFFSET
+        response = self.client.get('/emissions/40?order_by=type')
+        self.assertRedirects(response, '/emissions/?order_by=type', fetch_redirect_response=False)
+        response = self.client.get('/emissions/2')
+        self.assertRedirects(response, '/emissions/', fetch_redirect_response=False)
+
+
+class RowFetchTest(SimpleTestCase):
+    def test_row_type_is_cached(self):
+        first = namedtuplefetchall(ListCursor(['imo', 'type'], [(1, 'Tanker')]))
+        second = list(namedtupleiter(ListCursor(['imo', 'type'], [(2, 'Bulk carrier')]), size=1))
+        self.assertIs(type(first[0]), type(second[0]))
+        self.assertEqual(second[0].type, 'Bulk carrier')
+
+    def test_fetch_columns(self):
+        cursor = ListCursor(['imo', 'avg', 'type'], [(1, Decimal('2.50'), 'Tanker'), (2, None, None)])
+        columns = fetch_columns(cursor)
+        self.assertEqual(columns['imo'].dtype, np.int64)
+        self.assertEqual(columns['avg'][0], 2.5)
+        self.assertTrue(np.isnan(columns['avg'][1]))
+        self.assertEqual(list(columns['type']), ['Tanker', None])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class DimensionsTest(SimpleTestCase):
+    def setUp(self):
+        cache = caches[dimensions.DIMENSIONS_CACHE]
+        cache.set('ship_type-VALUES', ['Bulk carrier', 'Oil tanker'])
+        self.addCleanup(cache.clear)
+
+    def test_form_suggestions_are_patched_on_write(self):
+        data = {
+            'imo': 9000001, 'ship_name': 'SHIP', 'type': 'LNG carrier',
+            'issue': '2021-01-01', 'expiry': '2022-06-30',
+        }
+        # A type not suggested yet is accepted as a new one
+        self.assertTrue(ImoForm(data).is_valid())
+        self.assertEqual(ImoForm().fields['type'].suggestions(), ['Bulk carrier', 'Oil tanker'])
+        dimensions.add_values('ship_type', ['LNG carrier'])
+        self.assertEqual(ImoForm().fields['type'].suggestions(), ['Bulk carrier', 'LNG carrier', 'Oil tanker'])
+
+    def test_invalidate(self):
+        dimensions.invalidate('ship_type')
+        # Not patched in, it is read from the database on next use
+        dimensions.add_values('ship_type', ['LNG carrier'])
+        self.assertIsNone(caches[dimensions.DIMENSIONS_CACHE].get('ship_type-VALUES'))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BatchValidationTest(SimpleTestCase):
+    def test_validate(self):
+        body = (
+            b'action,imo,ship_name,type,technical_efficiency_number,issue,expiry\n'
+            b',9000001,SHIP 1,Bulk carrier,3.25,2021-01-01,06/30/2022\n'
+            b',abc,,' + b'x' * 65 + b',-1,2021-13-01,\n'
+            b'delete,9000002,,,,,\n'
+            b',9000003,SHIP 3,Bulk carrier,1234.567,2021-01-01,2022-06-30\n'
+        )
+        upserts, deletes, errors = batches.validate(batches.parse(body, 'text/csv'))
+        self.assertEqual(upserts['imo'].tolist(), [9000001])
+        self.assertEqual(upserts['expiry'].tolist(), [date(2022, 6, 30)])
+        self.assertEqual(deletes, [9000002])
+        self.assertEqual([error['row'] for error in errors], [1, 3])
+        self.assertEqual(
+            sorted(errors[0]['errors']),
+            ['expiry', 'imo', 'issue', 'ship_name', 'technical_efficiency_number', 'type']
+        )
+        self.assertEqual(list(errors[1]['errors']), ['technical_efficiency_number'])
+
+    def test_parse_errors(self):
+        with self.assertRaisesMessage(batches.BatchError, 'Could not read the batch'):
+            batches.parse(b'[{', 'application/json')
+        with self.assertRaises(batches.BatchError) as raised:
+            batches.parse(b'{"imo": 9000001}', 'application/json')
+        self.assertEqual(str(raised.exception), 'Expected a JSON list of objects')
+
+    def test_cross_site_posts_rejected(self):
+        client = Client(enforce_csrf_checks=True)
+        response = client.post('/emissions/batch', b'[]', content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        # A form can post text/plain without a preflight
+        response = self.client.post('/emissions/batch', b'[{"imo": "9000001", "action": "delete"}]', content_type='text/plain')
+        self.assertEqual(response.status_code, 415)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SearchQueryTest(SimpleTestCase):
+    def test_digit_range(self):
+        self.assertEqual(search.digit_range('985', search.IMO_DIGITS), (9850000, 9859999))
+        self.assertEqual(search.digit_range('9855549', search.IMO_DIGITS), (9855549, 9855549))
+        self.assertIsNone(search.digit_range('98555490', search.IMO_DIGITS))
+        self.assertIsNone(search.digit_range('98A', search.IMO_DIGITS))
+
+    def test_short_query_is_not_run(self):
+        self.assertEqual(search.search(None, ' m '), [])
+        self.assertEqual(search.like_prefix('50%_OFF'), '50\\%\\_OFF%')
+
+
+class ApiConditionalGetTest(SimpleTestCase):
+    def setUp(self):
+        fake_tag_versions(self)
+
+    def test_not_modified_without_query(self):
+        # SimpleTestCase fails on any query, so a 304 must come from the cache only
+        etag = api_etag(RequestFactory().get('/', {'y_axis': 'eedi'}), 'built_year_efficiency')
+        response = self.client.get(
+            '/api/v1/built_year_efficiency', {'y_axis': 'eedi'}, HTTP_IF_NONE_MATCH=f'"{etag}"'
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], f'"{etag}"')
+
+        caching.bump_data_version()
+        self.assertNotEqual(api_etag(RequestFactory().get('/'), 'built_year_efficiency'), etag)
+
+
+class ConcurrentQueryTest(SimpleTestCase):
+    @mock.patch.object(concurrency, 'connections', mock.MagicMock())
+    def test_queries_run_at_once(self):
+        # Each query waits for the other one, so they would time out one after the other
+        barrier = threading.Barrier(2, timeout=5)
+
+        def query(cursor, value):
+            barrier.wait()
+            return value
+
+        async def both():
+            return await asyncio.gather(concurrency.query(query, 1), concurrency.query(query, 2))
+
+        self.assertEqual(async_to_sync(both)(), [1, 2])
+
+
+class FigureArraysTest(SimpleTestCase):
+    def test_encode_arrays(self):
+        figure = encode_arrays({'data': [{
+            'x': np.array(['A', 'B'], dtype=object),
+            'y': np.array([1.5, np.nan]),
+            'size': np.array([1, 2], dtype=np.int64),
+        }]})
+        trace = figure['data'][0]
+        self.assertEqual(trace['x'], ['A', 'B'])
+        self.assertEqual(trace['y']['dtype'], 'f8')
+        np.testing.assert_array_equal(
+            np.frombuffer(base64.b64decode(trace['y']['bdata']), '<f8'), [1.5, np.nan]
+        )
+        self.assertEqual(trace['size']['dtype'], 'i4')
+
+
+class ComplianceTest(SimpleTestCase):
+    def test_evaluate(self):
+        ships = pd.DataFrame({
+            'ship_type': ['Bulk carrier', 'Bulk carrier', 'Container ship', 'Bulk carrier', 'Unknown'],
+            'dwt': [50000, 50000, 100000, 50000, 50000],
+            'year_built': [2021, 2021, 2016, 2010, 2021],
+            'attained_eedi': [3.0, 6.0, 10.0, 3.0, 3.0],
+        })
+        results = evaluate(ships)
+
+        # Bulk carrier: 961.79 * 50000 ^ -0.477, phase 2 reduces by 20 %
+        reference = 961.79 * 50000 ** -0.477
+        self.assertAlmostEqual(results['reference_eedi'][0], reference)
+        self.assertAlmostEqual(results['required_eedi'][0], reference * 0.8)
+        self.assertEqual(list(results['phase']), [2, 2, 1, -1, 2])
+        self.assertEqual(list(results['compliant']), [True, False, True, None, None])
+        self.assertEqual(results['highest_phase_met'][0], 3)
+        self.assertEqual(results['highest_phase_met'][1], -1)
+
+
+class FleetTest(SimpleTestCase):
+    def test_deterministic_by_seed(self):
+        def generate(seed):
+            generator = fleet.FleetGenerator(None, scale=0.5, seed=seed, years=2)
+            drawn = generator.draws(0)
+            facts = [generator.facts(drawn, 0, year) for year in range(2)]
+            return generator.ships(drawn, 0), facts
+
+        ships, facts = generate(1)
+        same_ships, same_facts = generate(1)
+        for col in ships:
+            np.testing.assert_array_equal(ships[col], same_ships[col])
+        np.testing.assert_array_equal(facts[1]['eedi'], same_facts[1]['eedi'])
+        self.assertFalse(np.array_equal(facts[0]['eedi'], generate(2)[1][0]['eedi']))
+
+        # One DoC per ship and year, of ships that exist
+        keys = pd.DataFrame({
+            'imo': np.concatenate([year['imo'] for year in facts]),
+            'issue_date_key': np.concatenate([year['issue_date_key'] for year in facts]),
+        })
+        self.assertFalse(keys.duplicated().any())
+        self.assertTrue(np.isin(facts[0]['ship_key'], ships['ship_key']).all())
+        np.testing.assert_array_equal(fleet.date_keys(fleet.key_dates(facts[1]['issue_date_key'])),
+                                      facts[1]['issue_date_key'])
+
+    def test_copy_binary(self):
+        cursor = mock.Mock()
+        fleet.copy_binary(cursor, 'ships', {
+            'key': np.array([1, 2]),
+            'eedi': np.array([np.nan, 2.5]),
+            'name': fleet.numbered(fleet.encode(['AB', 'Ö']), [0, 12]),
+        }, {'key': '>i8', 'eedi': '>f4', 'name': 'text'})
+
+        sql, data = cursor.copy_expert.call_args[0]
+        self.assertEqual(sql, 'COPY ships (key, eedi, name) FROM STDIN WITH (FORMAT binary)')
+        self.assertEqual(data.read(), (
+            fleet.COPY_HEADER
+            + b'\x00\x03' + b'\x00\x00\x00\x08' + (1).to_bytes(8, 'big') + b'\xff\xff\xff\xff'
+            + b'\x00\x00\x00\x02AB'
+            + b'\x00\x03' + b'\x00\x00\x00\x08' + (2).to_bytes(8, 'big') + b'\x00\x00\x00\x04@ \x00\x00'
+            + b'\x00\x00\x00\x05' + 'Ö 12'.encode()
+            + fleet.COPY_TRAILER
+        ))
+
+
+class BenchmarkRegressionTest(SimpleTestCase):
+    def test_regressions(self):
+        baseline = [
+            {'scale': 1.0, 'view': 'emissions', 'cache': 'cold', 'p50_ms': 10.0, 'queries': 3, 'bytes': 1000},
+            {'scale': 1.0, 'view': 'visual_view', 'cache': 'cold', 'p50_ms': 0.2, 'queries': 1, 'bytes': 1000},
+        ]
+        results = [
+            {'scale': 1.0, 'view': 'emissions', 'cache': 'cold', 'p50_ms': 11.9, 'queries': 4, 'bytes': 1300},
+            # Over the tolerance, but by less than MIN_REGRESSION_MS
+            {'scale': 1.0, 'view': 'visual_view', 'cache': 'cold', 'p50_ms': 0.9, 'queries': 1, 'bytes': 1000},
+            {'scale': 10.0, 'view': 'emissions', 'cache': 'cold', 'p50_ms': 50.0, 'queries': 9, 'bytes': 9000},
+        ]
+        found = benchmarks.regressions(benchmarks.SUITES['views'], baseline, results, tolerance=0.2)
+        self.assertEqual([(row['view'], row['metric']) for row in found],
+                         [('emissions', 'queries'), ('emissions', 'bytes')])
+
+
+class PerfTest(SimpleTestCase):
+    def setUp(self):
+        perf.registry.clear()
+
+    def test_unsampled(self):
+        response = self.client.get('/')
+        self.assertNotIn('Server-Timing', response)
+        self.assertIn(
+            'maritime_requests_total{view="index",method="GET",status="200"} 1',
+            perf.registry.exposition()
+        )
+        self.client.generic('BREW', '/')
+        self.assertIn('method="other"', perf.registry.exposition())
+        self.assertNotIn('BREW', perf.registry.exposition())
+
+    @override_settings(PERF_SAMPLE_RATE=1)
+    def test_sampled(self):
+        response = self.client.get('/')
+        self.assertRegex(response['Server-Timing'], r'^db;dur=0\.0;desc="0 queries", template;dur=[\d.]+, total;')
+
+        metrics = self.client.get('/metrics').content.decode()
+        self.assertIn('maritime_request_template_seconds_count{view="index"} 1', metrics)
+        self.assertIn(f'maritime_response_bytes_sum{{view="index"}} {len(response.content)}', metrics)
+
+    def test_timed(self):
+        figure = perf.timed('figure')(lambda: 'figure')
+        self.assertEqual(figure(), 'figure')
+        with perf.recording() as recorder:
+            with perf.recording() as nested:
+                figure()
+        self.assertIs(nested, recorder)
+        self.assertEqual(list(recorder.timings), ['figure'])
+
+
+class MaterializedViewsScriptTest(SimpleTestCase):
+    def test_eda_script_up_to_date(self):
+        with open(os.path.join(settings.BASE_DIR, 'eda', 'create_materialized_views.sql')) as f:
+            script = f.read()
+        self.assertEqual(script, analytics.create_materialized_views_script())
+        for name in analytics.MATERIALIZED_VIEWS:
+            self.assertIn(f'CREATE MATERIALIZED VIEW IF NOT EXISTS {name} AS', script)
+
+
+class OlapTest(SimpleTestCase):
+    def engine(self):
+        f4 = np.float32
+        facts = {
+            # The last fact has no ship, the one before no verifier
+            'ship_key': np.array([1, 1, 2, 3, 3, 9]),
+            'verifier_key': np.array([10, 11, 10, 11, -1, 10]),
+            'month': np.array([1, 1, 1, 2, 2, 2], dtype=np.int16),
+            'year': np.array([2020, 2021, 2020, 2021, -1, 2020], dtype=np.int16),
+            'eedi': np.array([2, 4, 3, np.nan, 5, 1], dtype=f4),
+            'fuel_consumption': np.array([10, 20, 30, 40, 50, 60], dtype=f4),
+            **{name: np.array([1, 2, 3, 4, 5, 6], dtype=f4) for name in ['sea_time', 'co2_distance', 'co2_transport']},
+        }
+        ships = {
+            'ship_key': np.array([3, 2, 1]),
+            'ship_type': np.array([1, 0, 0], dtype=np.int32),
+            'engine_type': np.array([0, 1, 0], dtype=np.int32),
+            'year_built': np.array([2001, 2000, 2000], dtype=np.int32),
+            **{name: np.array([7, 8, 9], dtype=f4) for name in ['speed', 'length', 'width', 'tonnage']},
+        }
+        verifiers = {'verifier_key': np.array([10, 11]), 'verifier_name': np.array([1, 0], dtype=np.int32)}
+        emissions = {
+            'type': np.array([1, 0, 1], dtype=np.int32), 'value': np.array([1.5, 2, 3.5], dtype=f4),
+            'year': np.array([2020, 2020, 2021], dtype=np.int16),
+        }
+        dictionaries = {
+            'ship_type': ['Bulk carrier', 'Tanker'], 'engine_type': ['Diesel', 'LNG'],
+            'verifier_name': ['DNV', 'Lloyd'], 'type': ['Bulk carrier', 'Tanker'],
+        }
+        return olap.Engine(facts, ships, verifiers, emissions, dictionaries)
+
+    def test_fuel_performance(self):
+        columns = self.engine().fuel_performance('f.eedi')
+        self.assertEqual(list(columns['label']), [
+            'Grand Total', 'Subtotal Tanker', 'Tanker Diesel',
+            'Subtotal Bulk carrier', 'Bulk carrier LNG', 'Bulk carrier Diesel',
+        ])
+        np.testing.assert_array_equal(columns['metric'], [3.5, 5, 5, 3, 3, 3])
+        np.testing.assert_array_equal(columns['fuelconsumption'], [30, 45, 45, 20, 30, 15])
+        np.testing.assert_allclose(columns['scaled_count'], np.log([5, 2, 2, 3, 1, 2]))
+
+    def test_verifier_ranking_and_percentile(self):
+        engine = self.engine()
+        columns = engine.verifier_ranking()
+        self.assertEqual(list(columns['verifier_name']), ['DNV', 'DNV', 'Lloyd', 'Lloyd'])
+        np.testing.assert_array_equal(columns['month_actual'], [1, 2, 1, 2])
+        np.testing.assert_array_equal(columns['avg_eedi'], [4, np.nan, 2.5, 1])
+        np.testing.assert_array_equal(columns['rank'], [2, 2, 1, 1])
+
+        columns = engine.percentile('fuel_consumption')
+        np.testing.assert_array_equal(columns['year_built'], [2000, 2001])
+        np.testing.assert_array_equal(columns['percentile_25'], [15, 42.5])
+        np.testing.assert_array_equal(columns['percentile_75'], [25, 47.5])
+
+    def test_filters(self):
+        engine = self.engine()
+        columns = engine.chart_columns('fuel_performance', 'f.eedi', {'ship_type': ['Tanker']})
+        self.assertEqual(list(columns['label']), ['Grand Total', 'Subtotal Tanker', 'Tanker Diesel'])
+        np.testing.assert_array_equal(columns['metric'], [5, 5, 5])
+
+        # Every verifier ticked selects the facts with one
+        self.assertEqual(
+            str(engine.chart_columns('verifiers_ranking', filters={'verifier': ['DNV', 'Lloyd']})),
+            str(engine.verifier_ranking()),
+        )
+
+        # Years built without a selected fact have no row
+        columns = engine.chart_columns('built_year_efficiency', 'fuel_consumption', {'year': ['2021']})
+        np.testing.assert_array_equal(columns['year_built'], [2000, 2001])
+        np.testing.assert_array_equal(columns['percentile_25'], [20, 40])
+        columns = engine.chart_columns(
+            'built_year_efficiency', 'fuel_consumption', {'year': ['2021'], 'ship_type': ['Bulk carrier']}
+        )
+        np.testing.assert_array_equal(columns['year_built'], [2000])
+
+        columns = engine.chart_columns('visual', filters={'year': ['2021']})
+        self.assertEqual(list(columns['type']), ['Tanker'])
+        np.testing.assert_array_equal(columns['avg'], [3.5])
+        self.assertEqual(len(engine.chart_columns('fuel_performance', 'f.eedi', {'year': ['1999']})['label']), 0)
+
+    @override_settings(ANALYTICS_IN_MEMORY=False)
+    def test_filters_without_engine(self):
+        filters = {'year': ['2021'], 'verifier': ['DNV', 'Lloyd']}
+        cursor = mock.Mock()
+        with mock.patch.object(views, 'query_columns') as query_columns, \
+                mock.patch.object(olap, 'chart_columns') as engine_columns:
+            views.chart_columns(cursor, 'verifiers_ranking', filters=filters)
+        engine_columns.assert_not_called()
+        sql, params = query_columns.call_args[0][1:]
+        self.assertIn(analytics.FACT_FILTER_CONDITIONS['year'], sql)
+        self.assertIn(analytics.FACT_FILTER_CONDITIONS['verifier'], sql)
+        self.assertNotIn(analytics.matview_name('verifier_ranking'), sql)
+        self.assertEqual(params, [['2021'], ['DNV', 'Lloyd']])
+
+        sql, params = analytics.filtered_chart_query('visual', {'ship_type': ['Tanker']})
+        self.assertIn('WHERE type = ANY(%s)', sql)
+        self.assertEqual(params, [['Tanker']])
+
+    @mock.patch.object(olap, 'snapshot', mock.MagicMock())
+    def test_reloads(self):
+        versions = {table: 1 for table in analytics.STAR_SCHEMA_TABLES + [olap.EMISSION_TABLE]}
+        loaded = self.engine()
+        emissions = {'type': np.array([0], dtype=np.int32), 'value': np.array([5], dtype=np.float32), 'year': np.array([2021], dtype=np.int16)}
+        with mock.patch.object(querycache, 'current_versions', lambda tags: {tag: versions[tag] for tag in tags}), \
+                mock.patch.object(olap.Engine, 'load', return_value=loaded) as load, \
+                mock.patch.object(olap, 'load_emissions', return_value=(emissions, ['Tanker'])) as load_emissions, \
+                mock.patch.object(olap, '_engine', None):
+            engine = olap.engine(None)
+            self.assertEqual(load.call_count, 1)
+            loaded.version, loaded.emission_version = load.call_args[0][1:]
+            self.assertIs(olap.engine(None), engine)
+
+            # A form write only reloads co2emission_reduced
+            versions[olap.EMISSION_TABLE] += 1
+            engine = olap.engine(None)
+            self.assertEqual((load.call_count, load_emissions.call_count), (1, 1))
+            self.assertEqual(engine.chart_columns('visual')['type'].tolist(), ['Tanker'])
+            self.assertIs(engine.fact_bitmaps, loaded.fact_bitmaps)
+
+            versions['fact_table'] += 1
+            olap.engine(None)
+            self.assertEqual(load.call_count, 2)
+
+    def test_round_numeric(self):
+        np.testing.assert_array_equal(olap.round_numeric([0.125, -0.125, 2.675, np.nan]), [0.13, -0.13, 2.68, np.nan])
+
+    def test_copy_columns(self):
+        types = {'key': '>i8', 'value': '>f4'}
+        rows = np.zeros(3, dtype=[('count', '>i2'), ('length0', '>i4'), ('key', '>i8'), ('length1', '>i4'), ('value', '>f4')])
+        rows['count'], rows['length0'], rows['length1'] = 2, 8, 4
+        rows['key'], rows['value'] = [1, 2, 3], [0.5, np.nan, 2]
+        data = fleet.COPY_HEADER + rows.tobytes() + fleet.COPY_TRAILER
+        cursor = mock.Mock()
+        # Chunks that split the header and the rows
+        cursor.copy_expert.side_effect = lambda sql, target: [target.write(data[i:i + 7]) for i in range(0, len(data), 7)]
+        columns = olap.copy_columns(cursor, 't', {name: (name, pg_type) for name, pg_type in types.items()})
+        np.testing.assert_array_equal(columns['key'], [1, 2, 3])
+        np.testing.assert_array_equal(columns['value'], [0.5, np.nan, 2])
+
+
+class QuantileSketchTest(SimpleTestCase):
+    def test_quantiles_within_relative_accuracy(self):
+        rng = np.random.default_rng(0)
+        values = np.concatenate([rng.lognormal(2, 1.5, 5000), -rng.lognormal(0, 1, 500)])
+        qs = [0, 0.01, 0.25, 0.5, 0.75, 0.99, 1]
+        # No quantile falls between a negative and a positive value, where the bound does not hold
+        exact = np.percentile(values, np.array(qs) * 100)
+        estimates = sketches.quantiles(*sketches.sketch(values), qs)
+        np.testing.assert_array_less(np.abs(estimates - exact), sketches.RELATIVE_ACCURACY * np.abs(exact) + 1e-12)
+        # Keys sort like the values, with those near zero in bucket 0
+        keys = sketches.bucket_keys([-1, -1e-12, 0, 1e-12, 1e-9, 1])
+        np.testing.assert_array_equal(keys[1:4], [0, 0, 0])
+        self.assertTrue(keys[0] < 0 < keys[4] < keys[5])
+
+    def test_merge(self):
+        rng = np.random.default_rng(1)
+        groups = [rng.gamma(2, 10, size) for size in (1, 10, 1000)]
+        keys, counts = sketches.merge(*(sketches.sketch(group) for group in groups))
+        expected_keys, expected_counts = sketches.sketch(np.concatenate(groups + [[np.nan]]))
+        np.testing.assert_array_equal(keys, expected_keys)
+        np.testing.assert_array_equal(counts, expected_counts)
+
+    def test_quantile_columns(self):
+        keys, counts = sketches.sketch([1, 2, 3, 4])
+        columns = sketches.quantile_columns({
+            'year_built': np.array([2000] * len(keys) + [2001]),
+            'bucket': np.append(keys, sketches.bucket_keys([5])),
+            'count': np.append(counts, 3),
+        }, [0.5, 1])
+        np.testing.assert_array_equal(columns['year_built'], [2000, 2001])
+        np.testing.assert_array_equal(columns['count'], [4, 3])
+        np.testing.assert_allclose(columns['percentile_50'], [2.5, 5], rtol=sketches.RELATIVE_ACCURACY)
+        np.testing.assert_allclose(columns['percentile_100'], [4, 5], rtol=sketches.RELATIVE_ACCURACY)
+        self.assertTrue(np.isnan(sketches.quantiles([], [], [0.5])).all())
+
+
+class VersionedCursor:
+    """Answers the queries of app.querycache from tag versions and counts the others"""
+    def __init__(self, versions):
+        self.versions = versions
+        self.queries = 0
+
+    def execute(self, sql, params=None):
+        if querycache.VERSIONS_TABLE in sql:
+            self.description = [('tag',), ('version',)]
+            self.rows = [(tag, self.versions[tag]) for tag in params[0] if tag in self.versions]
+        else:
+            self.queries += 1
+            self.description = [('imo',), ('type',)]
+            self.rows = [(9000001, f'Type {self.queries}')]
+
+    def fetchall(self):
+        return self.rows
+
+
+@override_settings(CACHES=LOCMEM_CACHES, QUERY_CACHE_LISTEN=False)
+class QueryCacheTest(SimpleTestCase):
+    def test_tables_read(self):
+        sql = 'SELECT * FROM fact_table f JOIN ship_dimension s USING (ship_key) JOIN type_summary_old t USING (x)'
+        self.assertEqual(querycache.tables_read(sql), ['fact_table', 'ship_dimension'])
+        self.assertEqual(
+            querycache.cache_key('SELECT 1\n  FROM d_date', [1], {'d_date': 2}),
+            querycache.cache_key(' SELECT 1 FROM d_date ', [1], {'d_date': 2}),
+        )
+
+    def test_cached_until_table_written(self):
+        caches[querycache.QUERY_CACHE].clear()
+        cursor = VersionedCursor({'co2emission_reduced': 3})
+        sql = 'SELECT imo, type FROM co2emission_reduced WHERE imo = %s'
+        first = querycache.fetchall(cursor, sql, [9000001])
+        self.assertEqual(querycache.fetchall(cursor, sql, [9000001]), first)
+        self.assertEqual(first[0].type, 'Type 1')
+        self.assertEqual(cursor.queries, 1)
+
+        cursor.versions['type_summary'] = 7
+        querycache.fetchall(cursor, sql, [9000001])
+        self.assertEqual(cursor.queries, 1)
+        cursor.versions['co2emission_reduced'] = 4
+        self.assertEqual(querycache.fetchall(cursor, sql, [9000001])[0].type, 'Type 2')
+
+        # Queries of no tagged table always run
+        querycache.fetchall(cursor, 'SELECT imo, type FROM app_greeting')
+        querycache.fetchall(cursor, 'SELECT imo, type FROM app_greeting')
+        self.assertEqual(cursor.queries, 4)
+
+        # Nor those in a transaction, which may roll back the versions it read
+        with mock.patch.object(connections['default'], 'in_atomic_block', True):
+            cursor.versions['co2emission_reduced'] = 5
+            self.assertEqual(querycache.fetchall(cursor, sql, [9000001])[0].type, 'Type 5')
+        self.assertEqual(querycache.fetchall(cursor, sql, [9000001])[0].type, 'Type 6')
+        self.assertEqual(cursor.queries, 6)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CoalescingTest(SimpleTestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.versions = fake_tag_versions(self)
+        self.queries = 0
+        self.lock = threading.Lock()
+        for patch in [
+            mock.patch.object(views, 'connections', mock.MagicMock()),
+            mock.patch.object(views, 'chart_columns', self.chart_columns),
+            mock.patch.object(views, 'cached_chart_filter_values', return_value={}),
+            mock.patch.object(views, 'render', lambda request, template, context: HttpResponse(str(context['graphs']))),
+        ]:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def chart_columns(self, cursor, view, y_axis=None, filters=None):
+        with self.lock:
+            self.queries += 1
+        time.sleep(0.2)
+        return {'verifier_name': ['A'], 'month_actual': [1], 'rank': [self.queries]}
+
+    def get(self):
+        request = RequestFactory().get('/verifiers')
+        request.user = AnonymousUser()
+        return views.extended_view_graph2(request)
+
+    def concurrent_gets(self, n):
+        with ThreadPoolExecutor(max_workers=n) as pool:
+            return list(pool.map(lambda _: self.get(), range(n)))
+
+    def test_cold_requests_query_once(self):
+        responses = self.concurrent_gets(8)
+        self.assertEqual(self.queries, 1)
+        self.assertEqual(len({response.content for response in responses}), 1)
+        self.assertFalse(any(response.has_header('Warning') for response in responses))
+
+    def test_stale_while_revalidate(self):
+        first = self.concurrent_gets(1)[0]
+        caching.bump_data_version()
+        responses = self.concurrent_gets(4)
+        # Served the previous figures while one refresh runs in the background
+        self.assertEqual({response.content for response in responses}, {first.content})
+        self.assertTrue(all(response['Warning'].startswith('110') for response in responses))
+        deadline = time.monotonic() + 5
+        fresh = self.get()
+        while fresh.has_header('Warning') and time.monotonic() < deadline:
+            time.sleep(0.05)
+            fresh = self.get()
+        self.assertFalse(fresh.has_header('Warning'))
+        self.assertNotEqual(fresh.content, first.content)
+        self.assertEqual(self.queries, 2)
+
+    def test_failed_build_is_retried(self):
+        calls = []
+
+        def build():
+            calls.append(1)
+            if len(calls) == 1:
+                raise ValueError
+            return 'value'
+
+        with self.assertRaises(ValueError):
+            caching.cached_value('coalescing', {}, build)
+        self.assertEqual(caching.cached_value('coalescing', {}, build), 'value')
+
+    def test_expired_lock_kept(self):
+        key = caching.params_key('coalescing', {})
+
+        def build():
+            # The lock expired during the build and another caller took it
+            caches['default'].set(f'{key}-LOCK', 'other', timeout=caching.LOCK_SEC)
+            return 'value'
+
+        self.assertEqual(caching.cached_value('coalescing', {}, build), 'value')
+        self.assertEqual(caches['default'].get(f'{key}-LOCK'), 'other')
+
+    def test_data_version_of_tags(self):
+        version = caching.get_data_version()
+        # A write to a table, notified by its trigger
+        self.versions['fact_table'] = 3
+        self.assertEqual(caching.get_data_version(), version + 3)
+        self.assertEqual(caching.bump_data_version(), version + 4)
+        self.assertEqual(self.versions[caching.DATA_TAG], 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class QueryCacheListenTest(TransactionTestCase):
+    def test_write_notifies_listener(self):
+        listener = querycache.listener()
+        self.assertTrue(listener.connected.wait(10))
+        sql = 'SELECT imo, ship_name FROM co2emission_reduced ORDER BY imo'
+        with connections['default'].cursor() as cursor:
+            self.assertEqual(querycache.fetchall(cursor, sql), [])
+            before = querycache.tag_versions(cursor, ['co2emission_reduced'])
+            cursor.execute('''
+                INSERT INTO co2emission_reduced VALUES (9000001, 'MARELLA DREAM', 'Passenger ship', '2021-01-01', '2022-01-01', 10)
+            ''')
+            for _ in range(100):
+                if querycache.tag_versions(cursor, ['co2emission_reduced']) != before:
+                    break
+                time.sleep(0.05)
+            self.assertEqual([row.ship_name for row in querycache.fetchall(cursor, sql)], ['MARELLA DREAM'])
+
+
+class FakeConnection:
+    """Stands in for a psycopg2 connection in the pool tests"""
+    closed = 0
+    broken = False
+
+    def cursor(self):
+        if self.broken:
+            raise psycopg2.OperationalError('server closed the connection')
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, sql):
+        pass
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class ConnectionPoolTest(SimpleTestCase):
+    def setUp(self):
+        connect = pool.connect
+        pool.connect = lambda conn_params: FakeConnection()
+        self.addCleanup(setattr, pool, 'connect', connect)
+        self.pool = pool.ConnectionPool({}, max_size=2, timeout=0.01)
+
+    def test_reuse(self):
+        connection = self.pool.getconn()
+        self.pool.putconn(connection)
+        self.assertIs(self.pool.getconn(), connection)
+        self.assertEqual(self.pool.stats, {'opened': 1, 'reused': 1, 'discarded': 0})
+
+    def test_max_size(self):
+        self.pool.getconn()
+        self.pool.getconn()
+        with self.assertRaises(psycopg2.OperationalError):
+            self.pool.getconn()
+
+    def test_recycle(self):
+        errored = self.pool.getconn()
+        self.pool.putconn(errored, discard=True)
+        self.assertTrue(errored.closed)
+
+        broken = self.pool.getconn()
+        self.pool.putconn(broken)
+        broken.broken = True
+        self.assertIsNot(self.pool.getconn(), broken)
+        self.assertEqual(self.pool.stats, {'opened': 3, 'reused': 0, 'discarded': 2})
+
+
+class TypeSummaryTest(TestCase):
+    def live_group_by(self):
+        with connections['default'].cursor() as cursor:
+            cursor.execute('''
+                SELECT type, count(imo), min(technical_efficiency_number),
+                    avg(technical_efficiency_number), max(technical_efficiency_number)
+                FROM co2emission_reduced
+                GROUP BY type
+                ORDER BY type
+            ''')
+            return cursor.fetchall()
+
+    def summary(self):
+        with connections['default'].cursor() as cursor:
+            cursor.execute(f'SELECT {SUMMARY_COLUMNS} FROM {SUMMARY_TABLE} ORDER BY type')
+            return cursor.fetchall()
+
+    def assertSummaryMatches(self):
+        live, summary = self.live_group_by(), self.summary()
+        self.assertEqual([row[:2] for row in live], [row[:2] for row in summary])
+        for live_row, summary_row in zip(live, summary):
+            for live_val, summary_val in zip(live_row[2:], summary_row[2:]):
+                self.assertAlmostEqual(live_val, summary_val, places=2)
+
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_matches_group_by_after_random_writes(self):
+        rng = random.Random(5110)
+        types = ['Bulk carrier', 'Tanker', 'Container ship', 'Ro-ro ship']
+        # The test database has no ship_dimension to read the choices from
+        dimensions.get_values('ship_type')
+        dimensions.add_values('ship_type', types)
+        imos = []
+        for _ in range(300):
+            action = rng.choice(['insert', 'insert', 'update', 'delete'])
+            if action != 'insert' and not imos:
+                continue
+            imo = rng.choice(imos) if action != 'insert' else rng.randint(1111111, 9999999)
+            if action == 'delete':
+                delete_values(imo)
+                imos.remove(imo)
+                continue
+            if action == 'insert' and imo in imos:
+                continue
+            data = {
+                'imo': imo,
+                'ship_name': f'SHIP {imo}',
+                'type': rng.choice(types),
+                'technical_efficiency_number': f'{rng.uniform(1, 400):.2f}',
+                'issue': '2021-01-01',
+                'expiry': '2022-06-30',
+            }
+            success, msg = insert_update_values(ImoForm(data), data, action, imo)
+            self.assertTrue(success, msg)
+            if action == 'insert':
+                imos.append(imo)
+            self.assertSummaryMatches()
+        self.assertSummaryMatches()
+
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_bounds_removed(self):
+        # Values that a REAL column does not hold exactly
+        types = ['Bulk carrier', 'Tanker']
+        dimensions.get_values('ship_type')
+        dimensions.add_values('ship_type', types)
+        rows = [(1111111, 'Bulk carrier', '2.3'), (1111112, 'Bulk carrier', '5'), (1111113, 'Tanker', '0.05'), (1111114, 'Tanker', '0.1')]
+        for imo, ship_type, value in rows:
+            data = {
+                'imo': imo,
+                'ship_name': f'SHIP {imo}',
+                'type': ship_type,
+                'technical_efficiency_number': value,
+                'issue': '2021-01-01',
+                'expiry': '2022-06-30',
+            }
+            success, msg = insert_update_values(ImoForm(data), data, 'insert', imo)
+            self.assertTrue(success, msg)
+        delete_values(1111111)
+        delete_values(1111114)
+        for row, expected in zip(self.summary(), [5, 0.05]):
+            self.assertAlmostEqual(row[2], expected, places=6)
+            self.assertAlmostEqual(row[4], expected, places=6)
+        self.assertSummaryMatches()
+
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_matches_group_by_after_batches(self):
+        rng = random.Random(5110)
+        types = ['Bulk carrier', 'Tanker', 'Container ship', 'Ro-ro ship']
+        dimensions.get_values('ship_type')
+        dimensions.add_values('ship_type', types)
+        imos = set()
+        for _ in range(10):
+            rows = [{'imo': imo, 'action': 'delete'} for imo in rng.sample(sorted(imos), len(imos) // 4)]
+            imos.difference_update(row['imo'] for row in rows)
+            for imo in rng.sample(range(1111111, 9999999), 50) + rng.sample(sorted(imos), len(imos) // 4):
+                rows.append({
+                    'imo': imo,
+                    'ship_name': f'SHIP {imo}',
+                    'type': rng.choice(types),
+                    'technical_efficiency_number': f'{rng.uniform(1, 400):.2f}',
+                    'issue': '2021-01-01',
+                    'expiry': '2022-06-30',
+                })
+                imos.add(imo)
+            response = self.client.post('/emissions/batch', json.dumps(rows), content_type='application/json')
+            self.assertEqual(response.json()['errors'], [])
+            self.assertSummaryMatches()
+
+
+class ExportTest(TestCase):
+    def insert_rows(self, count):
+        with connections['default'].cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO co2emission_reduced
+                SELECT 1000000 + i, 'SHIP ' || i, 'Bulk carrier', DATE '2021-01-01', DATE '2022-06-30', i % 400
+                FROM generate_series((SELECT COUNT(*) FROM co2emission_reduced), %s - 1) i;
+            ''', [count])
+
+    def export_peak(self, url):
+        """Streams an export and returns its size and the peak of traced memory"""
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        size = 0
+        tracemalloc.start()
+        for chunk in response.streaming_content:
+            size += len(chunk)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return size, peak
+
+    def test_memory_is_flat(self):
+        import pyarrow.parquet  # noqa: F401, imported before measuring
+        urls = [
+            f'/emissions/export?format={file_format}&order_by=technical_efficiency_number'
+            for file_format in ('csv', 'parquet')
+        ]
+        self.insert_rows(100000)
+        small = [self.export_peak(url) for url in urls]
+        self.insert_rows(1000000)
+        for url, (small_size, small_peak) in zip(urls, small):
+            size, peak = self.export_peak(url)
+            self.assertGreater(size, 5 * small_size)
+            self.assertLess(peak, small_peak * 1.5 + 1024 * 1024)
+
+
+class ApiTest(TestCase):
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_columns_and_conditional_get(self):
+        with connections['default'].cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO co2emission_reduced VALUES
+                    (9000001, 'SHIP 1', 'Tanker', '2021-01-01', '2022-06-30', 2),
+                    (9000002, 'SHIP 2', 'Tanker', '2021-01-01', '2022-06-30', 4);
+            ''')
+            aggregates.rebuild(cursor)
+        caching.bump_data_version()
+
+        response = self.client.get('/api/v1/visual')
+        self.assertEqual(response.json()['columns'], {
+            'type': ['Tanker'], 'count': [2], 'min': [2.0], 'avg': [3.0], 'max': [4.0],
+        })
+        self.assertEqual(
+            self.client.get('/api/v1/visual', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304
+        )
+        self.assertEqual(
+            self.client.get('/api/v1/visual', HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304
+        )
+
+
+class SearchTest(TestCase):
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_ranking(self):
+        with connections['default'].cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO co2emission_reduced VALUES
+                    (9000001, 'MARELLA DREAM', 'Passenger ship', '2021-01-01', '2022-06-30', 2),
+                    (9000002, 'MARELLA DISCOVERY', 'Passenger ship', '2021-01-01', '2022-06-30', 4),
+                    (9000003, 'AMARELLA', 'Ro-pax ship', '2021-01-01', '2022-06-30', 4),
+                    (9100004, 'TYCHO BRAHE', 'Ro-pax ship', '2021-01-01', '2022-06-30', 4);
+                INSERT INTO ship_identifiers VALUES (9100004, 1, '1XWC', 261992716);
+            ''')
+
+        def imos(query):
+            return [ship['imo'] for ship in self.client.get('/search/', {'q': query}).json()['results']]
+
+        # Prefix matches first, then similar names
+        found = imos('marella d')
+        self.assertEqual(sorted(found[:2]), [9000001, 9000002])
+        self.assertEqual(found[2:], [9000003])
+        self.assertEqual(imos('mrella dream')[0], 9000001)
+        self.assertEqual(imos('91'), [9100004])
+        self.assertEqual(imos('1xw'), [9100004])
+        self.assertEqual(imos('2619927'), [9100004])
+
+
+class QueryPlanTest(TestCase):
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_emissions_pages_use_indexes(self):
+        with connections['default'].cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO co2emission_reduced
+                SELECT 9000000 + i, 'SHIP ' || i, 'Type ' || i % 20, DATE '2021-01-01' + i % 365,
+                    DATE '2022-01-01' + i % 365, i % 50
+                FROM generate_series(1, 5000) AS i;
+                ANALYZE co2emission_reduced;
+            ''')
+            paths = [path for path in plans.page_paths(cursor) if path.startswith('/emissions/')]
+            results = plans.check(cursor, paths, min_rows=1000)
+
+        self.assertEqual(len({row['path'] for row in results}), len(paths))
+        self.assertEqual([row for row in results if row['seq_scans']], [])
@@ -1,12 +1,207 @@
+import base64
+import csv
+import io
+import json
 from collections import namedtuple
+from contextlib import contextmanager
+from datetime import date
+from decimal import Decimal
+from functools import lru_cache
+
+import numpy as np
+import psycopg2.extensions
+from django.db import connections
+
+FETCH_SIZE = 2000
+
+
+@lru_cache(maxsize=256)
+def row_type(columns):
+    """Returns the namedtuple class of a tuple of column names, built once per signature"""
+    return namedtuple('Result', columns)
+
+
+def cursor_row_type(cursor):
+    return row_type(tuple(col[0] for col in cursor.description))
 
 
 def namedtuplefetchall(cursor):
     "Return all rows from a cursor as a namedtuple"
-    nt_result = namedtuple('Result', [col[0] for col in cursor.description])
-    return [nt_result(*row) for row in cursor.fetchall()]
+    make = cursor_row_type(cursor)._make
+    return [make(row) for row in cursor.fetchall()]
+
+
+def namedtupleiter(cursor, size=FETCH_SIZE):
+    """Yields the rows of a cursor as namedtuples, fetching size rows at a time"""
+    make = cursor_row_type(cursor)._make
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield from map(make, rows)
+
+
+@contextmanager
+def streaming_cursor(alias='default'):
+    """
+    A server-side cursor, which sends the rows of a query as they are fetched
+    instead of all at once. Use it with namedtupleiter for large results.
+    """
+    with connections[alias].chunked_cursor() as cursor:
+        yield cursor
+
+
+def _column_array(values, dtype=None):
+    if dtype is not None:
+        return np.array(values, dtype=dtype)
+    sample = next((val for val in values if val is not None), None)
+    if isinstance(sample, bool):
+        return np.array(values, dtype=object)
+    if isinstance(sample, int) and None not in values:
+        return np.array(values, dtype=np.int64)
+    if isinstance(sample, (int, float, Decimal)):
+        # NUMERIC comes back as Decimal and NULL as None, both become float
+        return np.array(values, dtype=float)
+    return np.array(values, dtype=object)
+
+
+def fetch_columns(cursor, dtypes=None, size=FETCH_SIZE):
+    """
+    Returns all rows of a cursor as a dict of column name -> NumPy array,
+    transposing batches of size rows so that no list of all rows is built.
+    Integer columns become int64, float and NUMERIC columns float64 with NULL
+    as NaN, anything else an object array, unless a dtype is given in dtypes.
+    """
+    dtypes = dtypes or {}
+    names = [col[0] for col in cursor.description]
+    columns = [[] for _ in names]
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        for column, values in zip(columns, zip(*rows)):
+            column.extend(values)
+    return {
+        name: _column_array(values, dtypes.get(name)) for name, values in zip(names, columns)
+    }
+
+
+def column_values(array):
+    """Returns a column of fetch_columns as a JSON-ready list, with NaN as None"""
+    if array.dtype.kind == 'f':
+        return [None if np.isnan(val) else val for val in array.tolist()]
+    return array.tolist()
+
+
+# Casts NUMERIC straight to float instead of through Decimal
+NUMERIC_AS_FLOAT = psycopg2.extensions.new_type(
+    psycopg2.extensions.DECIMAL.values, 'NUMERIC_AS_FLOAT',
+    lambda value, cursor: None if value is None else float(value)
+)
+
+
+def query_columns(cursor, sql, params=None, dtypes=None):
+    """Runs a query and returns its result as fetch_columns does, NUMERIC as float"""
+    # Registered on the psycopg2 cursor under Django's wrapper only
+    psycopg2.extensions.register_type(NUMERIC_AS_FLOAT, getattr(cursor, 'cursor', cursor))
+    cursor.execute(sql, params)
+    return fetch_columns(cursor, dtypes)
 
 
 def clamp(value, minimum, maximum):
     """Clamp a value between a minimum and maximum value"""
     return max(minimum, min(value, maximum))
+
+
+def encode_cursor(values, page):
+    """Encode the sort key of a row and its page number into an opaque token"""
+    values = [val.isoformat() if isinstance(val, date) else val for val in values]
+    payload = json.dumps({'v': values, 'p': page}, separators=(',', ':'), default=float)
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """
+    Decode a token made by encode_cursor, and returns a tuple of the sort key
+    values and the page number, or None if the token is malformed.
+    """
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return list(payload['v']), int(payload['p'])
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+def when_table_exists(table, statements):
+    """
+    Wraps SQL statements so that they only run if the table exists. The
+    emissions and star-schema tables were created outside of migrations (see
+    create_co2_table.sql and eda/) until 0008_star_schema, so the migrations
+    before it cannot count on them.
+    """
+    body = '\n'.join(f"EXECUTE {quote_literal(statement)};" for statement in statements)
+    return f'''
+        DO $$
+        BEGIN
+            IF to_regclass('{table}') IS NOT NULL THEN
+                {body}
+            END IF;
+        END
+        $$;
+    '''
+
+
+def quote_literal(value):
+    """Quotes a string as a PostgreSQL literal"""
+    return "'" + value.replace("'", "''") + "'"
+
+
+class IteratorFile(io.TextIOBase):
+    """
+    Read-only file over an iterator of strings, so that COPY FROM STDIN can
+    stream its input without it ever being held in memory as a whole.
+    """
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._buffer = ''
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        chunks, length = [self._buffer], len(self._buffer)
+        while size < 0 or length < size:
+            try:
+                line = next(self._lines)
+            except StopIteration:
+                break
+            chunks.append(line)
+            length += len(line)
+        data = ''.join(chunks)
+        if size < 0:
+            self._buffer = ''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+
+class _LineBuffer:
+    """Write target of csv.writer that just keeps the last written line"""
+
+    def write(self, line):
+        self.line = line
+
+
+_csv_buffer = _LineBuffer()
+_csv_writer = csv.writer(_csv_buffer, lineterminator='\n')
+
+
+def csv_line(values):
+    """
+    Formats values as one line of CSV for COPY ... WITH (FORMAT csv), where
+    None becomes an unquoted empty field, i.e. NULL. Not thread safe.
+    """
+    _csv_writer.writerow(values)
+    return _csv_buffer.line
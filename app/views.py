@@ -1,16 +1,27 @@
+import asyncio
+from datetime import date
+
 from django.shortcuts import render
-from django.db import connections
+from django.db import connections, transaction
 from django.shortcuts import redirect
-from django.http import Http404
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_POST
 from django.db.utils import IntegrityError
-from plotly.offline import plot
+from django.core.cache import cache
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
 import plotly.graph_objects as go
 import plotly.express as px
 
-from app.utils import namedtuplefetchall, clamp
+from app import aggregates, analytics, batches, caching, concurrency, dimensions, exports, olap, perf, querycache, search, sketches
+from app.figures import figure_div
+from app.utils import namedtuplefetchall, clamp, column_values, encode_cursor, decode_cursor, query_columns
 from app.forms import ImoForm
 
+API_VERSION = 'v1'
 PAGE_SIZE = 20
+COUNT_CACHE_SEC = 5 * 60
 COLUMNS = [
     'imo',
     'ship_name',
@@ -19,6 +30,15 @@ COLUMNS = [
     'issue',
     'expiry'
 ]
+# Types of the sort key values of the page tokens, by column
+KEY_TYPES = {
+    'imo': int,
+    'ship_name': str,
+    'type': str,
+    'technical_efficiency_number': float,
+    'issue': date,
+    'expiry': date,
+}
 VERIFIER_COLUMNS = [
     'verifier_number',
     'verifier_name',
@@ -45,27 +65,122 @@ def db(request):
     return render(request, 'db.html', context)
 
 
+def approximate_count(cursor, table):
+    """
+    Returns an estimate of the number of rows in a table from the planner
+    statistics, cached for a short while so it costs nothing per page view.
+    Falls back to an exact count if the table was never analyzed.
+    """
+    count_key = f'{table}-COUNT'
+    count = cache.get(count_key)
+    if count is not None:
+        return count
+
+    cursor.execute('SELECT reltuples::BIGINT FROM pg_class WHERE oid = %s::regclass', [table])
+    count = cursor.fetchone()[0]
+    if count is None or count <= 0:
+        cursor.execute(f'SELECT COUNT(*) FROM {table}')
+        count = cursor.fetchone()[0]
+
+    cache.set(count_key, count, timeout=COUNT_CACHE_SEC)
+    return count
+
+
+def keyset_page(cursor, order_by, after=None, before=None):
+    """
+    Fetches one page of co2emission_reduced ordered by (order_by, imo),
+    starting after or ending before the given sort key. Uses the matching
+    composite index so that any page costs the same as the first one.
+    Returns a tuple of the rows and whether more rows exist in the
+    direction of travel.
+    """
+    key_cols = ['imo'] if order_by == 'imo' else [order_by, 'imo']
+    key = f'({", ".join(key_cols)})'
+    placeholders = f'({", ".join(["%s"] * len(key_cols))})'
+
+    where, params, direction = '', [], 'ASC'
+    if after is not None:
+        where, params = f'WHERE {key} > {placeholders}', after
+    elif before is not None:
+        where, params, direction = f'WHERE {key} < {placeholders}', before, 'DESC'
+
+    rows = querycache.fetchall(cursor, f'''
+        SELECT {", ".join(COLUMNS)}
+        FROM co2emission_reduced
+        {where}
+        ORDER BY {", ".join(f"{col} {direction}" for col in key_cols)}
+        LIMIT %s
+    ''', [*params, PAGE_SIZE + 1])
+
+    has_more = len(rows) > PAGE_SIZE
+    rows = rows[:PAGE_SIZE]
+    if direction == 'DESC':
+        rows.reverse()
+    return rows, has_more
+
+
+def token_key(token, key_cols):
+    """
+    The sort key values and page of a decoded page token, parsed for the
+    types of key_cols, or None if they do not fit, as for a token of another
+    order or a tampered one
+    """
+    if token is None or len(token[0]) != len(key_cols):
+        return None
+    values = []
+    for col, value in zip(key_cols, token[0]):
+        value_type = KEY_TYPES[col]
+        if value_type is date and isinstance(value, str):
+            try:
+                value = date.fromisoformat(value)
+            except ValueError:
+                return None
+        elif value_type is float and isinstance(value, int):
+            value = float(value)
+        if not isinstance(value, value_type) or isinstance(value, bool):
+            return None
+        values.append(value)
+    return values, token[1]
+
+
 def emissions(request, page=1):
     """Shows the emissions table page"""
+    if page != 1:
+        # Numbered pages are only kept for old links, which now start at the
+        # first keyset page rather than cost an OFFSET scan of every
+        # preceding row
+        query = request.GET.urlencode()
+        return redirect(f'/emissions/?{query}' if query else '/emissions/')
+
     msg = None
     order_by = request.GET.get('order_by', '')
     order_by = order_by if order_by in COLUMNS else 'imo'
+    key_cols = ['imo'] if order_by == 'imo' else [order_by, 'imo']
+    after = token_key(decode_cursor(request.GET.get('after', '')), key_cols)
+    before = token_key(decode_cursor(request.GET.get('before', '')), key_cols)
 
     with connections['default'].cursor() as cursor:
-        cursor.execute('SELECT COUNT(*) FROM co2emission_reduced')
-        count = cursor.fetchone()[0]
-        num_pages = (count - 1) // PAGE_SIZE + 1
-        page = clamp(page, 1, num_pages)
+        count = approximate_count(cursor, 'co2emission_reduced')
+        num_pages = max((count - 1) // PAGE_SIZE + 1, 1)
+
+        # The page number only travels along in the token
+        if after:
+            rows, has_next = keyset_page(cursor, order_by, after=after[0])
+            page, has_prev = after[1] + 1, True
+        elif before:
+            rows, has_prev = keyset_page(cursor, order_by, before=before[0])
+            page = max(before[1] - 1, 2) if has_prev else 1
+            has_next = True
+        else:
+            rows, has_next = keyset_page(cursor, order_by)
+            has_prev = False
 
-        offset = (page - 1) * PAGE_SIZE
-        cursor.execute(f'''
-            SELECT {", ".join(COLUMNS)}
-            FROM co2emission_reduced
-            ORDER BY {order_by}
-            OFFSET %s
-            LIMIT %s
-        ''', [offset, PAGE_SIZE])
-        rows = namedtuplefetchall(cursor)
+    num_pages = max(num_pages, page)
+    prev_cursor = next_cursor = None
+    if rows and has_prev:
+        prev_cursor = encode_cursor([getattr(rows[0], col) for col in key_cols], page)
+    if rows and has_next:
+        next_cursor = encode_cursor([getattr(rows[-1], col) for col in key_cols], page)
 
     imo_deleted = request.GET.get('deleted', False)
     if imo_deleted:
@@ -76,12 +191,53 @@ def emissions(request, page=1):
         'page': page,
         'rows': rows,
         'num_pages': num_pages,
+        'prev_cursor': prev_cursor,
+        'next_cursor': next_cursor,
         'msg': msg,
         'order_by': order_by
     }
     return render(request, 'emissions.html', context)
 
 
+def export_response(request, name, sql, params=None):
+    """Streams the result of a query in the format given by the format parameter"""
+    file_format = request.GET.get('format', 'csv')
+    if file_format not in exports.EXPORT_FORMATS:
+        return HttpResponseBadRequest(f'Unknown export format {file_format}')
+    if file_format != 'csv' and not exports.pyarrow_installed():
+        return HttpResponseBadRequest(f'The {file_format} export needs pyarrow to be installed')
+
+    content_type, extension = exports.EXPORT_FORMATS[file_format]
+    response = StreamingHttpResponse(exports.stream(file_format, sql, params), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{name}.{extension}"'
+    return response
+
+
+def emissions_export(request):
+    """Exports the whole emissions table, in the order of the order_by parameter"""
+    order_by = request.GET.get('order_by', '')
+    order_by = order_by if order_by in COLUMNS else 'imo'
+    key_cols = ['imo'] if order_by == 'imo' else [order_by, 'imo']
+    sql = f'''
+        SELECT {", ".join(COLUMNS)}
+        FROM co2emission_reduced
+        ORDER BY {", ".join(key_cols)}
+    '''
+    return export_response(request, 'emissions', sql)
+
+
+def emissions_written(added=(), emptied=()):
+    """
+    Runs after a write to co2emission_reduced commits, with the (type, value)
+    rows added and the types that no longer have any ship.
+    """
+    caching.bump_data_version()
+    dimensions.add_values('ship_type', [ship_type for ship_type, _ in added])
+    if emptied:
+        # The type may still be in ship_dimension, so it is read again
+        dimensions.invalidate('ship_type')
+
+
 def insert_update_values(form, post, action, imo):
     """
     Inserts or updates database based on values in form and action to take,
@@ -98,23 +254,73 @@ def insert_update_values(form, post, action, imo):
     if action == 'update':
         # Remove imo from updated fields
         cols, values = cols[1:], values[1:]
-        with connections['default'].cursor() as cursor:
+        with transaction.atomic(), connections['default'].cursor() as cursor:
+            cursor.execute('''
+                SELECT type, technical_efficiency_number
+                FROM co2emission_reduced
+                WHERE imo = %s
+                FOR UPDATE;
+            ''', [imo])
+            removed = cursor.fetchall()
             cursor.execute(f'''
                 UPDATE co2emission_reduced
                 SET {", ".join(f"{col} = %s" for col in cols)}
-                WHERE imo = %s;
+                WHERE imo = %s
+                RETURNING type, technical_efficiency_number;
             ''', [*values, imo])
+            added = cursor.fetchall()
+            emptied = aggregates.apply_changes(cursor, removed=removed, added=added)
+            transaction.on_commit(lambda: emissions_written(added, emptied))
         return True, '✔ IMO updated successfully'
 
     # Else insert
-    with connections['default'].cursor() as cursor:
+    with transaction.atomic(), connections['default'].cursor() as cursor:
         cursor.execute(f'''
             INSERT INTO co2emission_reduced ({", ".join(cols)})
-            VALUES ({", ".join(["%s"] * len(cols))});
+            VALUES ({", ".join(["%s"] * len(cols))})
+            RETURNING type, technical_efficiency_number;
         ''', values)
+        added = cursor.fetchall()
+        aggregates.apply_changes(cursor, added=added)
+        transaction.on_commit(lambda: emissions_written(added))
     return True, '✔ IMO inserted successfully'
 
 
+def delete_values(imo):
+    """Deletes an IMO from the database"""
+    with transaction.atomic(), connections['default'].cursor() as cursor:
+        cursor.execute('''
+            DELETE FROM co2emission_reduced
+            WHERE imo = %s
+            RETURNING type, technical_efficiency_number;
+        ''', [imo])
+        emptied = aggregates.apply_changes(cursor, removed=cursor.fetchall())
+        transaction.on_commit(lambda: emissions_written(emptied=emptied))
+
+
+@require_POST
+def emissions_batch(request):
+    """
+    Upserts and deletes many IMOs in one transaction, from a JSON list of
+    rows (Content-Type: application/json) or a CSV body (text/csv). Invalid
+    rows are skipped and returned with their errors, the valid ones are
+    applied. Like the form, it requires the CSRF token (the csrftoken cookie
+    sent back in the X-CSRFToken header).
+    """
+    if request.content_type not in batches.CONTENT_TYPES:
+        return JsonResponse({'error': f'Expected one of {", ".join(batches.CONTENT_TYPES)}'}, status=415)
+    try:
+        frame = batches.parse(request.body, request.content_type)
+    except batches.BatchError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    upserts, deletes, errors = batches.validate(frame)
+    with transaction.atomic(), connections['default'].cursor() as cursor:
+        counts, added, emptied = batches.apply(cursor, upserts, deletes)
+        transaction.on_commit(lambda: emissions_written(added, emptied))
+    return JsonResponse({**counts, 'errors': errors})
+
+
 def emission_detail(request, imo=None):
     """Shows the form where the user can insert or update an IMO"""
     success, form, msg, initial_values = False, None, None, {}
@@ -137,8 +343,7 @@ def emission_detail(request, imo=None):
         action = request.POST.get('action', None)
 
         if action == 'delete':
-            with connections['default'].cursor() as cursor:
-                cursor.execute('DELETE FROM co2emission_reduced WHERE imo = %s;', [imo])
+            delete_values(imo)
             return redirect(f'/emissions?deleted={imo}')
         try:
             success, msg = insert_update_values(form, request.POST, action, imo)
@@ -150,9 +355,9 @@ def emission_detail(request, imo=None):
             success, msg = False, f'Some unhandled error occured: {e}'
     elif imo:  # GET request and imo is set
         with connections['default'].cursor() as cursor:
-            cursor.execute('SELECT * FROM co2emission_reduced WHERE imo = %s', [imo])
+            rows = querycache.fetchall(cursor, 'SELECT * FROM co2emission_reduced WHERE imo = %s', [imo])
             try:
-                initial_values = namedtuplefetchall(cursor)[0]._asdict()
+                initial_values = rows[0]._asdict()
             except IndexError:
                 raise Http404(f'IMO {imo} not found')
 
@@ -177,28 +382,48 @@ def emission_detail(request, imo=None):
     }
     return render(request, 'emission_detail.html', context)
 
-def aggregation(request, page=1):
-    """Shows the aggregation table page"""
+def ship_search(request):
+    """Returns the ships matching the q parameter as JSON, for typeahead"""
+    try:
+        limit = clamp(int(request.GET.get('limit', search.SEARCH_LIMIT)), 1, search.SEARCH_MAX_LIMIT)
+    except ValueError:
+        return HttpResponseBadRequest('limit must be a number')
+    results = search.cached_search(request.GET.get('q', ''), limit)
+    return JsonResponse({'query': request.GET.get('q', ''), 'results': [
+        {**result, 'url': f'/emissions/imo/{result["imo"]}'} for result in results
+    ]})
+
+
+def count_summary_rows(cursor):
+    return querycache.fetchall(cursor, f'SELECT COUNT(*) FROM {aggregates.SUMMARY_TABLE};')[0][0]
+
+
+def summary_page(cursor, page):
+    offset = (page - 1) * PAGE_SIZE
+    return querycache.fetchall(cursor, f'''
+        SELECT {aggregates.SUMMARY_COLUMNS}
+        FROM {aggregates.SUMMARY_TABLE}
+        ORDER BY type
+        OFFSET %s
+        LIMIT %s
+    ''', [max(offset, 0), PAGE_SIZE])
+
+
+async def aggregation(request, page=1):
+    """Shows the aggregation table page, counting and fetching the page at once"""
     msg = None
     order_by = request.GET.get('order_by', '')
     order_by = order_by if order_by in COLUMNS else 'imo'
-    
-    with connections['default'].cursor() as cursor:
-        cursor.execute('SELECT count(distinct(type)) FROM co2emission_reduced;')
-        count = cursor.fetchone()[0]
-        num_pages = (count - 1) // PAGE_SIZE + 1
-        page = clamp(page, 1, num_pages)
 
-        offset = (page - 1) * PAGE_SIZE
-        cursor.execute(f'''
-            SELECT type, count(imo), min(technical_efficiency_number), avg(technical_efficiency_number), max(technical_efficiency_number)
-            FROM co2emission_reduced
-            GROUP BY type
-            ORDER BY type
-            OFFSET %s
-            LIMIT %s
-        ''', [offset, PAGE_SIZE])
-        rows = namedtuplefetchall(cursor)
+    count, rows = await asyncio.gather(
+        concurrency.query(count_summary_rows),
+        concurrency.query(summary_page, page),
+    )
+    num_pages = (count - 1) // PAGE_SIZE + 1
+    if clamp(page, 1, num_pages) != page:
+        # Only out of range page numbers need a second round trip
+        page = clamp(page, 1, num_pages)
+        rows = await concurrency.query(summary_page, page)
 
     imo_deleted = request.GET.get('deleted', False)
     if imo_deleted:
@@ -214,6 +439,92 @@ def aggregation(request, page=1):
     }
     return render(request, 'aggregation.html', context)
 
+def compliance(request, page=1):
+    """Shows the vessels that do not meet the required EEDI of their phase"""
+    with connections['default'].cursor() as cursor:
+        count = querycache.fetchall(cursor, 'SELECT COUNT(*) FROM eedi_compliance WHERE NOT compliant;')[0][0]
+        num_pages = max((count - 1) // PAGE_SIZE + 1, 1)
+        page = clamp(page, 1, num_pages)
+
+        offset = (page - 1) * PAGE_SIZE
+        rows = querycache.fetchall(cursor, '''
+            SELECT imo, ship_type, dwt, year_built, phase, attained_eedi,
+                ROUND(required_eedi::NUMERIC, 2) AS required_eedi,
+                ROUND(ratio::NUMERIC, 2) AS ratio, highest_phase_met
+            FROM eedi_compliance
+            WHERE NOT compliant
+            ORDER BY ratio DESC, imo
+            OFFSET %s
+            LIMIT %s
+        ''', [offset, PAGE_SIZE])
+
+    context = {
+        'nbar': 'compliance',
+        'page': page,
+        'rows': rows,
+        'count': count,
+        'num_pages': num_pages,
+    }
+    return render(request, 'compliance.html', context)
+
+# Checkbox filters of the chart pages, query parameter -> label. The visual
+# page summarizes co2emission_reduced, which has no engine or verifier.
+CHART_FILTERS = {
+    'year': 'Issue Year',
+    'ship_type': 'Ship Type',
+    'engine_type': 'Engine Type',
+    'verifier': 'Verifier',
+}
+
+
+def chart_filter_names(view):
+    return olap.EMISSION_FILTERS if view == 'visual' else olap.FACT_FILTERS
+
+
+def chart_filters(request, view):
+    """The values of the filters of a chart page ticked in a request"""
+    return {
+        name: sorted(set(request.GET.getlist(name)))
+        for name in chart_filter_names(view) if request.GET.getlist(name)
+    }
+
+
+def chart_filter_values(cursor, view):
+    """The values of the filters of a chart page, as {name: [values]}"""
+    cursor.execute(analytics.EMISSION_FILTERS_QUERY if view == 'visual' else analytics.fact_filters_query())
+    values = {}
+    for name, value in cursor.fetchall():
+        values.setdefault(name, []).append(value)
+    return values
+
+
+def cached_chart_filter_values(view):
+    def build():
+        with connections['default'].cursor() as cursor:
+            return chart_filter_values(cursor, view)
+    return caching.cached_value('chart-filters', {'view': view}, build)
+
+
+def filter_checkboxes(request, view, values):
+    """The filter checkboxes of a chart page, with those of the request checked"""
+    checkboxes = [
+        {
+            'id': name,
+            'label': CHART_FILTERS[name],
+            'options': [{'value': value, 'label': value} for value in values.get(name, [])],
+        }
+        for name in chart_filter_names(view)
+    ]
+    return create_checkboxes(request.GET, checkboxes)
+
+
+def stale_response(response, stale):
+    """Marks a response built from figures of an earlier data version"""
+    if stale:
+        response['Warning'] = '110 - "Response is Stale"'
+    return response
+
+
 def create_checkboxes(params, checkboxes):
 
     for checkbox in checkboxes:
@@ -225,23 +536,9 @@ def create_checkboxes(params, checkboxes):
 
     return checkboxes
 
-def visual_view(request):
-    """ 
-    Displaying graph with plotly
-    """
-    with connections['default'].cursor() as cursor:
-        query = 'SELECT type, count(imo), min(technical_efficiency_number), avg(technical_efficiency_number), max(technical_efficiency_number) FROM co2emission_reduced GROUP BY type ORDER BY type;'
-        cursor.execute(query)
-        records = cursor.fetchall()
-
-        dict_df = {'type':[],'count':[], 'min': [], 'avg':[], 'max':[]}
-        for rows in records:
-            dict_df['type'].append(rows[0])
-            dict_df['count'].append(rows[1])
-            dict_df['min'].append(rows[2])
-            dict_df['avg'].append(rows[3])
-            dict_df['max'].append(rows[4])
-    
+@perf.timed('figure')
+def visual_figures(dict_df):
+    """Returns the five figures of the visual page for the type summary columns"""
     # Setting layout of the figure.
     bar_layout = {
         'title': 'Max, Min and Average EEDI per Ship Type',
@@ -285,123 +582,100 @@ def visual_view(request):
     box_graphs1 = go.Figure(data=[go.Box(x=dict_df['min'], name='Min EEDI', marker_color = 'royalblue')], layout = box_layout1)
     box_graphs2 = go.Figure(data=[go.Box(x=dict_df['avg'], name='Average EEDI', marker_color = 'lightseagreen')], layout = box_layout2)
 
-    # Getting HTML needed to render the plot.
-    bar_div = plot({'data': bar_graphs, 'layout': bar_layout}, output_type='div')
-    pie_div = plot({'data': pie_graphs, 'layout': pie_layout}, output_type='div')
-    box_div = plot({'data': box_graphs, 'layout': box_layout}, output_type='div')
-    box_div1 = plot({'data': box_graphs1, 'layout': box_layout1}, output_type='div')
-    box_div2 = plot({'data': box_graphs2, 'layout': box_layout2}, output_type='div')
-
-    checkbox = [
-        {
-            'id': 'year',
-            'label': 'Year',
-            'options': [
-                {
-                    'value': '2020',
-                    'label': '2020',
-                    'checked': True
-                },
-                {
-                    'value': '2021',
-                    'label': '2021',
-                    'checked': True
-                }
-            ]
-        },
-        {
-            'id': 'century',
-            'label': 'Century',
-            'options': [
-                {
-                    'value': '19',
-                    'label': '19',
-                    'checked': True
-                },
-                {
-                    'value': '20',
-                    'label': '20',
-                    'checked': False
-                },
-                {
-                    'value': '20',
-                    'label': '20',
-                    'checked': True
-                }
-            ]
-        },
+    return [
+        {'data': bar_graphs, 'layout': bar_layout},
+        {'data': pie_graphs, 'layout': pie_layout},
+        {'data': box_graphs, 'layout': box_layout},
+        {'data': box_graphs1, 'layout': box_layout1},
+        {'data': box_graphs2, 'layout': box_layout2},
     ]
 
+async def visual_view(request):
+    """ 
+    Displaying graph with plotly, the figures being rendered at once
+    """
+    filters = chart_filters(request, 'visual')
+
+    async def build_graphs():
+        dict_df = await concurrency.query(chart_columns, 'visual', None, filters)
+        figures = await concurrency.render(visual_figures, dict_df)
+
+        # Getting HTML needed to render the plot.
+        return list(await asyncio.gather(*[concurrency.render(figure_div, figure) for figure in figures]))
+
+    graphs = await caching.acached_render('visual_view', {'filters': filters}, build_graphs)
+    values = await caching.acached_value(
+        'chart-filters', {'view': 'visual'}, lambda: concurrency.query(chart_filter_values, 'visual')
+    )
+
     # Setting context
     context={
-        'graphs': [
-            bar_div,
-            pie_div,
-            box_div,
-            box_div1,
-            box_div2
-        ],
-        'checkboxes': create_checkboxes(request.GET, checkbox)
+        'graphs': graphs,
+        'checkboxes': filter_checkboxes(request, 'visual', values),
     }
 
     return render(request, 'visual.html', context)
 
-def extended_view(request):
-    """ 
-    Displaying graph with plotly
-    """
-    # get params request.
-    request_dict = request.GET
-    print(request_dict)
-    if request_dict != {}:
-        y_axis = request_dict['y_axis']
-        query = "SELECT s.ship_type, s.engine_type, ROUND(AVG({})::NUMERIC,2) as metric, ROUND(AVG(f.fuel_consumption)::NUMERIC,2) as fuelconsumption,LN(COUNT(*)) as scaled_count, (CASE  WHEN s.ship_type ISNULL AND s.engine_type ISNULL THEN 'Grand Total' WHEN s.engine_type ISNULL THEN 'Subtotal'||' '||s.ship_type ELSE s.ship_type|| ' ' || s.engine_type END) as label FROM fact_table f, ship_dimension s WHERE f.ship_key = s.ship_key GROUP BY ROLLUP(s.ship_type, s.engine_type) ORDER BY s.ship_type DESC, s.engine_type DESC".format(y_axis)
-    else:
-        size = 'Ln(count) of Ships'
-        y_axis = 'f.eedi'
-        x_axis = 'Average Fuel Consumption'
-        query = "SELECT s.ship_type, s.engine_type, ROUND(AVG(f.eedi)::NUMERIC,2) as metric, ROUND(AVG(f.fuel_consumption)::NUMERIC,2) as fuelconsumption,LN(COUNT(*)) as scaled_count, (CASE  WHEN s.ship_type ISNULL AND s.engine_type ISNULL THEN 'Grand Total' WHEN s.engine_type ISNULL THEN 'Subtotal'||' '||s.ship_type ELSE s.ship_type|| ' ' || s.engine_type END) as label FROM fact_table f, ship_dimension s WHERE f.ship_key = s.ship_key GROUP BY ROLLUP(s.ship_type, s.engine_type) ORDER BY s.ship_type DESC, s.engine_type DESC"
+@perf.timed('figure')
+def fuel_performance_figure(columns, y_axis):
+    """Returns the bubble chart of the fuel performance page"""
+    y_axis_title = analytics.FUEL_PERFORMANCE_METRICS
+    dict_df = {
+        'size': columns['scaled_count'],
+        'y_axis': columns['metric'],
+        'x_axis': columns['fuelconsumption'],
+        'label': columns['label'],
+    }
 
-    with connections['default'].cursor() as cursor:
-        cursor.execute(query)
-        records = cursor.fetchall()
-
-        dict_df = {'size':[],'y_axis':[], 'x_axis': [], 'label': []}
-        for rows in records:
-            dict_df['y_axis'].append(rows[2])
-            dict_df['x_axis'].append(rows[3])
-            dict_df['size'].append(rows[4])
-            dict_df['label'].append(rows[5])
-    
     # Setting layout of the figure.
     bubble_layout = {
         'height': 700,
         'width': 1000,
     }
 
-    y_axis_title = {'f.eedi': 'EEDI', 's.tonnage' : "Ship Tonnage Capacity", 's.width': 'Ship Width', 's.length': 'Ship Length', 's.speed': 'Ship Speed', 's.engine_type': 'Ship Engine Type', 'f.sea_time': 'Sea Time', 'f.co2_distance': 'CO2 Distance', 'f.co2_transport':'CO2 Transport'}
-
     # List of graph objects for figure.
     graph_title = 'Average fuel consumption vs {} per Ship Type and Ship Engine (with Subtotal for each Type and Engine)'.format(y_axis_title[y_axis])
     bubble_div = px.scatter(x=dict_df['x_axis'], y=dict_df['y_axis'], size=dict_df['size'], color=dict_df['label'], labels={'x':'Average fuel consumption', 'y':y_axis_title[y_axis], 'color':'Value of Bubbles'}, title=graph_title, log_x=True, size_max=60)
+    return {'data': bubble_div, 'layout': bubble_layout}
+
+def extended_view(request):
+    """ 
+    Displaying graph with plotly
+    """
+    # get params request.
+    request_dict = request.GET
+    y_axis = request_dict.get('y_axis', 'f.eedi')
+    y_axis = y_axis if y_axis in analytics.FUEL_PERFORMANCE_METRICS else 'f.eedi'
+
+    y_axis_title = analytics.FUEL_PERFORMANCE_METRICS
+
+    filters = chart_filters(request, 'fuel_performance')
+
+    def build_graphs():
+        with connections['default'].cursor() as cursor:
+            columns = chart_columns(cursor, 'fuel_performance', y_axis, filters)
 
-    # Getting HTML needed to render the plot.
-    bubble_graph = plot({'data': bubble_div, 'layout': bubble_layout}, output_type = 'div')
+        # Getting HTML needed to render the plot.
+        return [figure_div(fuel_performance_figure(columns, y_axis))]
+
+    graphs, stale = caching.revalidated_render('extended_view', {'y_axis': y_axis, 'filters': filters}, build_graphs)
 
     # Setting context
     context={
-        'graphs': [
-            bubble_graph
-        ],
+        'graphs': graphs,
+        'stale': stale,
         'selected_metrics': 'Current Selected Performance Metrics & Ship Features:',
         'chosen_metrics': y_axis_title[y_axis],
         'title': 'Fuel Consumption vs Performance Metrics/Ship Features of each Ship Type and Engine',
         'description': 'We compared fuel consumption of every ship type and engine with their features and different maritime performance metrics. This is so that we can understand if there are any correlations between different performance metrics or ship features with fuel consumption. Size of the bubbles are determined by natural logarithm of ship count, ensuring the relative importance by ship type is captured.',
         'interaction': 'To select different performance metrics or ship features, use the dropdown below. You can focus on the information of a particular ship type by hovering over the bubbles displayed.',
+        'checkboxes': filter_checkboxes(request, 'fuel_performance', cached_chart_filter_values('fuel_performance')),
         'dropdowns': [
             {
                 'id': 'y_axis',
                 'label': 'Performance Metrics & Ship Features',
+                # Kept when the page reloads for a filter
+                'selected': y_axis,
                 'options': [
                     {
                         'value': 'f.eedi',
@@ -423,10 +697,6 @@ def extended_view(request):
                         'value': 's.length',
                         'label': 'Length'
                     },
-                    {
-                        'value': 's.engine_type',
-                        'label': 'Engine Type'
-                    },
                     {
                         'value': 's.speed',
                         'label': 'Speed'
@@ -448,82 +718,60 @@ def extended_view(request):
         ]
     }
 
-    return render(request, 'visual.html', context)
+    return stale_response(render(request, 'visual.html', context), stale)
+
+@perf.timed('figure')
+def verifier_ranking_figure(columns):
+    """Returns the line chart of the verifiers ranking page"""
+    dict_df = {
+        'color': columns['verifier_name'],
+        'x_axis': columns['month_actual'],
+        'y_axis': columns['rank'],
+    }
+
+    # List of graph objects for figure.
+    graph_title = 'Longitudinal Tracking of Average EEDI for Accredited Vessels by Verifier'
+    line_div = px.line(x=dict_df['x_axis'], y=dict_df['y_axis'], color=dict_df['color'], labels={'x':'Issue Month', 'y':'Rank against other verifiers', 'color': 'Verifiers Name'}, title=graph_title)
+    return {'data': line_div}
 
 def extended_view_graph2(request):
     """ 
     Displaying graph with plotly
     """
-    
-    # get params request.
-    request_dict = request.GET
-    size = 'Count of Ships'
-    y_axis = 'Average EEDI'
-    x_axis = 'Average Fuel Consumption'
-    query = 'SELECT v.verifier_name, d.month_actual, ROUND(AVG(f.EEDI)::NUMERIC,2) as avg_eedi, RANK() OVER(PARTITION BY d.month_actual ORDER BY ROUND(AVG(f.EEDI)::NUMERIC,2) ASC) rank FROM fact_table f, verifiers v, d_date d WHERE f.issue_date_key = d.date_dim_id AND f.verifier_key = v.verifier_key AND f.verifier_key IN (SELECT DISTINCT verifier_key FROM verifiers) GROUP BY v.verifier_name, d.month_actual;'
-    
-    with connections['default'].cursor() as cursor:
-        cursor.execute(query)
-        records = cursor.fetchall()
+    filters = chart_filters(request, 'verifiers_ranking')
 
-        dict_df = {'color':[],'y_axis':[], 'x_axis': []}
-        for rows in records:
-            dict_df['color'].append(rows[0])
-            dict_df['x_axis'].append(rows[1])
-            dict_df['y_axis'].append(rows[3])
+    def build_graphs():
+        with connections['default'].cursor() as cursor:
+            columns = chart_columns(cursor, 'verifiers_ranking', None, filters)
 
-    # List of graph objects for figure.
-    graph_title = 'Longitudinal Tracking of Average EEDI for Accredited Vessels by Verifier'
-    line_div = px.line(x=dict_df['x_axis'], y=dict_df['y_axis'], color=dict_df['color'], labels={'x':'Issue Month', 'y':'Rank against other verifiers', 'color': 'Verifiers Name'}, title=graph_title)
+        # Getting HTML needed to render the plot.
+        return [figure_div(verifier_ranking_figure(columns))]
 
-    # Getting HTML needed to render the plot.
-    line_graph = plot({'data': line_div}, output_type = 'div')
+    graphs, stale = caching.revalidated_render('extended_view_graph2', {'filters': filters}, build_graphs)
 
     # Setting context
     context={
-        'graphs': [
-            line_graph
-        ],
+        'graphs': graphs,
+        'stale': stale,
         'selected_metrics': '',
         'chosen_metrics': '',
         'title': 'Ranking Verifiers based on EEDI',
         'description': 'We ranked verifiers based on the average EEDI of all their certified ships, tracked across post issuance months.',
         'interaction': 'Remove any verifier from the graph by clicking on their names. Reselect to add their rank back to the graph. Verifiers that are not selected will have a grey font instead of black.',
+        'checkboxes': filter_checkboxes(request, 'verifiers_ranking', cached_chart_filter_values('verifiers_ranking')),
     }
 
-    return render(request, 'visual.html', context)
+    return stale_response(render(request, 'visual.html', context), stale)
 
-def extended_view_graph3(request):
-    # get params request.
-    request_dict = request.GET
-    print(request_dict)
-    if request_dict != {}:
-        y_axis = request_dict['y_axis']
-        query = 'SELECT s.year_built, ROUND(PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY f.{} ASC)::NUMERIC,2) AS percentile_25, ROUND(PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY f.{} ASC)::NUMERIC,2) AS percentile_75 FROM fact_table f, ship_dimension s WHERE f.ship_key = s.ship_key GROUP BY s.year_built'.format(y_axis, y_axis)
-    else:
-        size = 'Count of Ships'
-        y_axis = 'Average EEDI'
-        x_axis = 'Average Fuel Consumption'
-        query = 'SELECT s.year_built, ROUND(PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY f.eedi ASC)::NUMERIC,2) AS percentile_25, ROUND(PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY f.eedi ASC)::NUMERIC,2) AS percentile_75 FROM fact_table f, ship_dimension s WHERE f.ship_key = s.ship_key GROUP BY s.year_built;'
-    
-    with connections['default'].cursor() as cursor:
-        cursor.execute(query)
-        records = cursor.fetchall()
-
-        dict_df = {'x_axis':[],'y_axis':[], 'y_axis1': []}
-        for rows in records:
-            dict_df['x_axis'].append(rows[0])
-            dict_df['y_axis'].append(rows[1])
-            dict_df['y_axis1'].append(rows[2])
-
-    if y_axis == 'fuel_consumption':
-        y_axis_title = 'Fuel Consumption'
-    elif y_axis == 'co2_distance':
-        y_axis_title = 'CO2 Distance'
-    elif y_axis == 'co2_transport':
-        y_axis_title = 'CO2 Transport'
-    else:
-        y_axis_title = 'EEDI'
+@perf.timed('figure')
+def percentile_figure(columns, y_axis):
+    """Returns the bar chart of the built year efficiency page"""
+    y_axis_title = analytics.PERCENTILE_METRICS[y_axis]
+    dict_df = {
+        'x_axis': columns['year_built'],
+        'y_axis': columns['percentile_25'],
+        'y_axis1': columns['percentile_75'],
+    }
 
     bar_layout = {
         'title': '25th and 75th Percentiles of {} for all ship based on year built'.format(y_axis_title),
@@ -537,21 +785,38 @@ def extended_view_graph3(request):
     graph_title = 'Percentile Bar Rank'
     bar_graphs = go.Figure(data =[go.Bar(x=dict_df['x_axis'], y=dict_df['y_axis'], name='25th Percentile'), go.Bar(x=dict_df['x_axis'], y=dict_df['y_axis1'], name='75th Percentile')], layout=bar_layout)
     bar_graphs.update_layout(barmode='group')
+    return {'data': bar_graphs, 'layout': bar_layout}
 
-    # Getting HTML needed to render the plot.
-    bar_div = plot({'data': bar_graphs, 'layout': bar_layout}, output_type='div')
+def extended_view_graph3(request):
+    # get params request.
+    request_dict = request.GET
+    y_axis = request_dict.get('y_axis', 'eedi')
+    y_axis = y_axis if y_axis in analytics.PERCENTILE_METRICS else 'eedi'
+
+    y_axis_title = analytics.PERCENTILE_METRICS[y_axis]
+
+    filters = chart_filters(request, 'built_year_efficiency')
+
+    def build_graphs():
+        with connections['default'].cursor() as cursor:
+            columns = chart_columns(cursor, 'built_year_efficiency', y_axis, filters)
+
+        # Getting HTML needed to render the plot.
+        return [figure_div(percentile_figure(columns, y_axis))]
+
+    graphs = caching.cached_render('extended_view_graph3', {'y_axis': y_axis, 'filters': filters}, build_graphs)
 
     # Setting context
     context={
-        'graphs': [
-            bar_div
-        ],
+        'graphs': graphs,
         'selected_metrics': 'Current Selected Efficiency Metrics:',
         'chosen_metrics': y_axis_title,
         'dropdowns': [
             {
                 'id': 'y_axis',
                 'label': 'Efficiency Metrics',
+                # Kept when the page reloads for a filter
+                'selected': y_axis,
                 'options': [
                     {
                         'value': 'eedi',
@@ -578,7 +843,175 @@ def extended_view_graph3(request):
         ],
         'title': 'Measuring Efficiency of Ships Built in Different Years',
         'description': 'We computed the 25th and 75th percentile values of various reported efficiency metrics, segmented across year of vessel build. Said metrics include: EEDI, C02 transport, CO2 distance and Fuel consumption.',
-        'interaction': 'To select different metrics, use the dropdown below. You can view both percentiles or focus on one percentile by hovering over the bars displayed.'
+        'interaction': 'To select different metrics, use the dropdown below. You can view both percentiles or focus on one percentile by hovering over the bars displayed.',
+        'checkboxes': filter_checkboxes(request, 'built_year_efficiency', cached_chart_filter_values('built_year_efficiency')),
+    }
+
+    return render(request, 'visual.html', context)
+
+
+async def dashboard(request):
+    """
+    Shows the charts of the three analytics pages together, their queries
+    and figures being run at once
+    """
+    async def chart(view, figure):
+        _, params = chart_query(view)
+        columns = await concurrency.query(chart_columns, view)
+        return await concurrency.render(lambda: figure_div(figure(columns, **params)))
+
+    async def build_graphs():
+        return list(await asyncio.gather(
+            chart('fuel_performance', fuel_performance_figure),
+            chart('verifiers_ranking', verifier_ranking_figure),
+            chart('built_year_efficiency', percentile_figure),
+        ))
+
+    graphs = await caching.acached_render('dashboard', {}, build_graphs)
+
+    context = {
+        'nbar': 'dashboard',
+        'graphs': graphs,
+        'title': 'Dashboard',
+        'description': 'Fuel consumption against EEDI, the ranking of verifiers and the efficiency of ships by year built, on one page.',
+        'interaction': 'Open the page of a chart from the menu to choose its metrics.',
     }
+    return render(request, 'visual.html', context)
+
+def chart_query(view, y_axis=None):
+    """
+    Returns the query behind a chart page and its parameters, with y_axis
+    replaced by the page's default if it is not one of its metrics.
+    """
+    if view == 'visual':
+        return f'SELECT {aggregates.SUMMARY_COLUMNS} FROM {aggregates.SUMMARY_TABLE} ORDER BY type', {}
+    if view == 'fuel_performance':
+        y_axis = y_axis if y_axis in analytics.FUEL_PERFORMANCE_METRICS else 'f.eedi'
+        return analytics.fuel_performance_query(y_axis), {'y_axis': y_axis}
+    if view == 'verifiers_ranking':
+        return analytics.verifier_ranking_query(), {}
+    if view == 'built_year_efficiency':
+        y_axis = y_axis if y_axis in analytics.PERCENTILE_METRICS else 'eedi'
+        return analytics.percentile_query(y_axis), {'y_axis': y_axis}
+    raise Http404('No such chart page')
+
+
+def chart_columns(cursor, view, y_axis=None, filters=None):
+    """
+    Returns the data behind a chart page as query_columns does, for the
+    rows matching filters (see chart_filters), from the in-memory engine of
+    app.olap if ANALYTICS_IN_MEMORY is set
+    """
+    sql, params = chart_query(view, y_axis)
+    if settings.ANALYTICS_IN_MEMORY:
+        return olap.chart_columns(cursor, view, filters=filters, **params)
+    if filters:
+        return query_columns(cursor, *analytics.filtered_chart_query(view, filters, **params))
+    return query_columns(cursor, sql)
+
+
+def analytics_export(request, view):
+    """Exports the data behind a chart page, honoring its y_axis parameter"""
+    sql, _ = chart_query(view, request.GET.get('y_axis'))
+    return export_response(request, view, sql)
+
+
+def api_etag(request, view):
+    """Changes with the data version, so it costs a cache lookup and no query"""
+    _, params = chart_query(view, request.GET.get('y_axis'))
+    return caching.params_key(f'API-{API_VERSION}-{view}', params)
+
+
+def api_last_modified(request, view=None):
+    return caching.get_data_modified()
 
-    return render(request, 'visual.html', context)
\ No newline at end of file
+
+@cache_control(no_cache=True)
+@condition(etag_func=api_etag, last_modified_func=api_last_modified)
+def api_chart(request, view):
+    """
+    Returns the data behind a chart page as columnar JSON, {column: [values]}.
+    Clients that send back the ETag or Last-Modified get a 304 while the
+    data version is unchanged.
+    """
+    _, params = chart_query(view, request.GET.get('y_axis'))
+
+    def build():
+        with connections['default'].cursor() as cursor:
+            columns = chart_columns(cursor, view, **params)
+        return {name: column_values(values) for name, values in columns.items()}
+
+    columns = caching.cached_value(f'API-{API_VERSION}-{view}', params, build)
+    return JsonResponse({'api_version': API_VERSION, 'view': view, **params, 'columns': columns})
+
+
+def metrics(request):
+    """
+    The request counters and histograms of this worker process (see
+    app.perf) in the Prometheus text format, for a bearer token of
+    PERF_METRICS_TOKEN if set
+    """
+    token = settings.PERF_METRICS_TOKEN
+    if token and not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponse(status=401)
+    return HttpResponse(perf.registry.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# Query parameter -> column of analytics.SKETCH_FILTERS
+QUANTILE_FILTERS = {'ship_type': 'ship_type', 'verifier': 'verifier_name', 'month': 'month_actual'}
+
+
+def quantile_params(request):
+    """
+    The metric, quantiles and filters of a quantiles API request, raising
+    ValueError for invalid ones
+    """
+    metric = request.GET.get('metric', 'eedi')
+    if metric not in analytics.PERCENTILE_METRICS:
+        raise ValueError(f'metric must be one of {", ".join(analytics.PERCENTILE_METRICS)}')
+    qs = sorted({float(q) for q in request.GET.getlist('q')}) or [0.25, 0.75]
+    if not all(0 <= q <= 1 for q in qs):
+        raise ValueError('q must be between 0 and 1')
+    if not all(month.isdigit() for month in request.GET.getlist('month')):
+        raise ValueError('month must be a number')
+    filters = {
+        column: sorted({int(value) if column == 'month_actual' else value for value in request.GET.getlist(name)})
+        for name, column in QUANTILE_FILTERS.items() if request.GET.getlist(name)
+    }
+    return {'metric': metric, 'q': qs, 'filters': filters}
+
+
+def api_quantiles_etag(request):
+    try:
+        return caching.params_key(f'API-{API_VERSION}-quantiles', quantile_params(request))
+    except ValueError:
+        return None
+
+
+@cache_control(no_cache=True)
+@condition(etag_func=api_quantiles_etag, last_modified_func=api_last_modified)
+def api_quantiles(request):
+    """
+    Returns quantiles q (repeated, 0.25 and 0.75 by default) of a metric per
+    year built as columnar JSON, for the facts of the ship types, verifiers
+    and months given (repeated, all by default). They come from the merged
+    sketches of app.sketches, within sketches.RELATIVE_ACCURACY of the exact
+    values.
+    """
+    try:
+        params = quantile_params(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    def build():
+        sql, query_params = analytics.quantile_sketch_query(params['metric'], params['filters'])
+        with connections['default'].cursor() as cursor:
+            columns = query_columns(cursor, sql, query_params)
+        columns = sketches.quantile_columns(columns, params['q'])
+        return {name: column_values(values) for name, values in columns.items()}
+
+    columns = caching.cached_value(f'API-{API_VERSION}-quantiles', params, build)
+    return JsonResponse({
+        'api_version': API_VERSION, **params,
+        'relative_accuracy': sketches.RELATIVE_ACCURACY, 'columns': columns,
+    })
@@ -0,0 +1,82 @@
+"""
+PostgreSQL backend with configurable connection reuse (settings.DB_CONN_MODE):
+
+- 'none': a new connection per request, Django's default behaviour.
+- 'persistent': each worker thread keeps its connection for CONN_MAX_AGE
+  seconds, checked with a SELECT 1 before its first use in a request.
+- 'pool': requests borrow a connection from a per-process pool (core.db.pool)
+  and return it at the end of the request.
+
+The pool options come from the POOL entry of the database settings.
+"""
+from django.db.backends.postgresql import base, creation
+
+from core.db.pool import close_pools, get_pool
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # Idle pooled connections would keep the test database from being dropped
+        close_pools()
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool_options = self.settings_dict.get('POOL')
+        self.health_checks = self.settings_dict.get('CONN_HEALTH_CHECKS', False)
+        self.health_check_done = False
+
+    def pool(self, conn_params):
+        key = (self.alias, tuple(sorted(conn_params.items())))
+        return get_pool(key, conn_params, **self.pool_options)
+
+    def get_new_connection(self, conn_params):
+        if not self.pool_options:
+            return super().get_new_connection(conn_params)
+
+        connection = self.pool(conn_params).getconn()
+        # Same as Django's get_new_connection, which does not work on borrowed connections
+        options = self.settings_dict['OPTIONS']
+        try:
+            self.isolation_level = options['isolation_level']
+        except KeyError:
+            self.isolation_level = connection.isolation_level
+        else:
+            if self.isolation_level != connection.isolation_level:
+                connection.set_session(isolation_level=self.isolation_level)
+        return connection
+
+    def connect(self):
+        super().connect()
+        # A new or pooled connection has just been checked
+        self.health_check_done = True
+
+    def _close(self):
+        if self.connection is None or not self.pool_options:
+            return super()._close()
+        with self.wrap_database_errors:
+            self.pool(self.get_connection_params()).putconn(
+                self.connection, discard=self.errors_occurred
+            )
+
+    def close_if_unusable_or_obsolete(self):
+        super().close_if_unusable_or_obsolete()
+        # Runs at the start and end of every request
+        self.health_check_done = False
+
+    def close_if_health_check_failed(self):
+        """Closes a persistent connection that stopped working since the last request"""
+        if (self.connection is None or not self.health_checks
+                or self.health_check_done or self.in_atomic_block):
+            return
+        if not self.is_usable():
+            self.close()
+        self.health_check_done = True
+
+    def _cursor(self, name=None):
+        self.close_if_health_check_failed()
+        return super()._cursor(name)
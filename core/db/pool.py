@@ -0,0 +1,154 @@
+"""
+Per-process pool of psycopg2 connections, used by the core.db backend when
+DB_CONN_MODE is 'pool'.
+
+Every gunicorn worker creates its own pools lazily on first use, so no
+connection is ever shared across a fork. A connection is health checked
+before it is handed out and discarded instead of reused when it errored, is
+not idle, or outlived its maximum age.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def connect(conn_params):
+    connection = psycopg2.connect(**conn_params)
+    # Same as Django's postgresql backend does for each new connection
+    psycopg2.extras.register_default_jsonb(conn_or_curs=connection, loads=lambda x: x)
+    return connection
+
+
+def is_usable(connection):
+    """Returns whether a connection is open and answers a SELECT 1"""
+    if connection.closed:
+        return False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+    except psycopg2.Error:
+        return False
+    return True
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of at most max_size connections. getconn() waits up to
+    timeout seconds for a free connection and raises OperationalError after.
+    """
+
+    def __init__(self, conn_params, min_size=0, max_size=10, timeout=10,
+                 max_age=None, health_checks=True):
+        self.conn_params = conn_params
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_age = max_age
+        self.health_checks = health_checks
+        self.pid = os.getpid()
+        self.stats = {'opened': 0, 'reused': 0, 'discarded': 0}
+
+        self._idle = deque()
+        self._opened_at = {}
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+
+    def _open(self):
+        connection = connect(self.conn_params)
+        with self._lock:
+            self._opened_at[connection] = time.monotonic()
+            self.stats['opened'] += 1
+        return connection
+
+    def _discard(self, connection):
+        with self._lock:
+            self._opened_at.pop(connection, None)
+            self.stats['discarded'] += 1
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    def _expired(self, connection):
+        if self.max_age is None:
+            return False
+        return time.monotonic() - self._opened_at.get(connection, 0) >= self.max_age
+
+    def getconn(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise psycopg2.OperationalError(
+                f'No free connection in the pool of {self.max_size} after {self.timeout}s'
+            )
+        try:
+            while True:
+                try:
+                    # Most recently used first, so that surplus connections age out
+                    connection = self._idle.pop()
+                except IndexError:
+                    return self._open()
+                if self._expired(connection) or (self.health_checks and not is_usable(connection)):
+                    self._discard(connection)
+                    continue
+                with self._lock:
+                    self.stats['reused'] += 1
+                return connection
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, connection, discard=False):
+        """Returns a connection to the pool, or closes it if it cannot be reused"""
+        try:
+            status = connection.get_transaction_status() if not connection.closed else None
+            if status in (
+                psycopg2.extensions.TRANSACTION_STATUS_INTRANS,
+                psycopg2.extensions.TRANSACTION_STATUS_INERROR,
+            ):
+                connection.rollback()
+                status = connection.get_transaction_status()
+            if (discard or status != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+                    or self._expired(connection)):
+                self._discard(connection)
+            else:
+                self._idle.append(connection)
+        except psycopg2.Error:
+            self._discard(connection)
+        finally:
+            self._slots.release()
+
+    def fill(self):
+        """Opens connections until min_size are idle"""
+        while len(self._idle) < self.min_size:
+            self._idle.append(self._open())
+
+    def close(self):
+        """Closes the idle connections, the ones in use are closed when returned"""
+        while self._idle:
+            self._discard(self._idle.pop())
+        self.max_age = 0
+
+
+def get_pool(key, conn_params, **options):
+    """Returns the pool of this process for a key, creating it on first use"""
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None or pool.pid != os.getpid():
+            pool = _pools[key] = ConnectionPool(conn_params, **options)
+            pool.fill()
+        return pool
+
+
+def close_pools():
+    """Closes every pool of this process, e.g. before a database is dropped"""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
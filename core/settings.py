@@ -1,5 +1,7 @@
 import os
+import tempfile
 from decouple import config
+from django.core.exceptions import ImproperlyConfigured
 import django_heroku
 
 
@@ -38,6 +40,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so that it times the whole request
+    'app.perf.PerfMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -51,7 +55,8 @@ ROOT_URLCONF = 'core.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Django's backend, timing renders for app.perf
+        'BACKEND': 'app.perf.DjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -60,6 +65,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'app.context_processors.plotly',
             ]
         },
     }
@@ -67,12 +73,50 @@ TEMPLATES = [
 
 DEFAULT_CACHE = 'django.core.cache.backends.locmem.LocMemCache'
 CACHES = {
+    # Figures and their build locks (app.caching)
     'default': {
         'BACKEND': config('CACHE_BACKEND', default=DEFAULT_CACHE),
-        'LOCATION': 'unique-snowflake'
-    }
+        'LOCATION': config('CACHE_LOCATION', default='unique-snowflake'),
+    },
+    # Query results of the pages (app.querycache), versioned by the tables
+    # they read, so a cache per process or a shared one both stay fresh
+    'queries': {
+        'BACKEND': config('QUERY_CACHE_BACKEND', default=DEFAULT_CACHE),
+        'LOCATION': 'queries',
+        'OPTIONS': {'MAX_ENTRIES': config('QUERY_CACHE_MAX_ENTRIES', default=5000, cast=int)},
+    },
+    # When the data version of the figure caches (app.caching) last changed,
+    # for Last-Modified, shared by the worker processes and the management
+    # commands that bump it
+    'versions': {
+        'BACKEND': config('VERSION_CACHE_BACKEND', default='django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': config('VERSION_CACHE_LOCATION', default=os.path.join(tempfile.gettempdir(), 'maritime-versions')),
+    },
+    # Distinct dimension values (app.dimensions), shared by the worker processes
+    'dimensions': {
+        'BACKEND': config('DIMENSIONS_CACHE_BACKEND', default='django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': config('DIMENSIONS_CACHE_LOCATION', default=os.path.join(tempfile.gettempdir(), 'maritime-dimensions')),
+    },
 }
 
+# Backends shared by the processes whose add is atomic, that the builds of
+# figures lock with so that concurrent requests in all workers build each
+# figure once. With more than one gunicorn worker (WEB_CONCURRENCY, which
+# gunicorn reads too) the default cache must be one of them.
+SHARED_CACHE_BACKENDS = [
+    'django.core.cache.backends.memcached.PyMemcacheCache',
+    'django.core.cache.backends.memcached.PyLibMCCache',
+    'django.core.cache.backends.memcached.MemcachedCache',
+    'django.core.cache.backends.db.DatabaseCache',
+    'django_redis.cache.RedisCache',
+]
+WEB_CONCURRENCY = config('WEB_CONCURRENCY', default=1, cast=int)
+if WEB_CONCURRENCY > 1 and CACHES['default']['BACKEND'] not in SHARED_CACHE_BACKENDS:
+    raise ImproperlyConfigured(
+        f'CACHE_BACKEND {CACHES["default"]["BACKEND"]} is not shared by the {WEB_CONCURRENCY} workers, '
+        f'use one of {", ".join(SHARED_CACHE_BACKENDS)}'
+    )
+
 WSGI_APPLICATION = 'core.wsgi.application'
 
 # Database
@@ -104,6 +148,44 @@ else:
         }
     }
 
+# Connection reuse of the core.db backend: 'none' opens a connection per
+# request, 'persistent' keeps one per worker thread for DB_CONN_MAX_AGE seconds
+# and 'pool' shares DB_POOL_MAX_SIZE connections per worker process
+DB_CONN_MODE = config('DB_CONN_MODE', default='persistent')
+DB_CONN_MAX_AGE = config('DB_CONN_MAX_AGE', default=600, cast=int)
+DB_CONN_HEALTH_CHECKS = config('DB_CONN_HEALTH_CHECKS', default=True, cast=bool)
+DB_POOL_MIN_SIZE = config('DB_POOL_MIN_SIZE', default=1, cast=int)
+DB_POOL_MAX_SIZE = config('DB_POOL_MAX_SIZE', default=10, cast=int)
+DB_POOL_TIMEOUT = config('DB_POOL_TIMEOUT', default=10, cast=float)
+
+# How long query results are cached (0 turns the cache off), and whether
+# each worker LISTENs for the writes to their tables rather than reading the
+# table versions before every cached query (see app.querycache)
+QUERY_CACHE_TIMEOUT = config('QUERY_CACHE_TIMEOUT', default=7 * 24 * 60 * 60, cast=int)
+QUERY_CACHE_LISTEN = config('QUERY_CACHE_LISTEN', default=True, cast=bool)
+
+# Threads per worker process that the async views run queries and render
+# figures on, each query thread holding at most one connection
+ASYNC_QUERY_THREADS = config('ASYNC_QUERY_THREADS', default=4, cast=int)
+ASYNC_RENDER_THREADS = config('ASYNC_RENDER_THREADS', default=4, cast=int)
+
+# Rows a sequential scan of a page query may read before check_plans fails
+PLAN_CHECK_MIN_ROWS = config('PLAN_CHECK_MIN_ROWS', default=10000, cast=int)
+
+# Read the analytics pages from their materialized views, refreshed with
+# `python manage.py refresh_analytics`
+ANALYTICS_USE_MATVIEWS = config('ANALYTICS_USE_MATVIEWS', default=True, cast=bool)
+# Answer the chart pages from the star schema loaded into the memory of each
+# worker process instead (see app.olap), reloaded when the star schema is
+# written to. Charts with ticked filters are otherwise read from the tables.
+ANALYTICS_IN_MEMORY = config('ANALYTICS_IN_MEMORY', default=False, cast=bool)
+
+# Share of requests whose queries, figure, serialization and template time
+# are recorded and sent as a Server-Timing header (see app.perf), 0 to 1
+PERF_SAMPLE_RATE = config('PERF_SAMPLE_RATE', default=0.0, cast=float)
+# Bearer token the /metrics scrape endpoint requires, if set
+PERF_METRICS_TOKEN = config('PERF_METRICS_TOKEN', default='')
+
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
 
@@ -137,4 +219,28 @@ USE_TZ = True
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 STATIC_URL = '/static/'
 
+STATICFILES_FINDERS = [
+    'django.contrib.staticfiles.finders.FileSystemFinder',
+    'django.contrib.staticfiles.finders.AppDirectoriesFinder',
+    'app.finders.PlotlyJsFinder',
+]
+
+# 'static' serves plotly.js once as a static file and sends figures as JSON,
+# 'inline' embeds plotly.js into every figure div
+PLOTLY_JS_MODE = config('PLOTLY_JS_MODE', default='static')
+
 django_heroku.settings(locals())
+
+# After django_heroku, which replaces DATABASES when DATABASE_URL is set
+DATABASES['default'].update({
+    'ENGINE': 'core.db',
+    'CONN_MAX_AGE': DB_CONN_MAX_AGE if DB_CONN_MODE == 'persistent' else 0,
+    'CONN_HEALTH_CHECKS': DB_CONN_HEALTH_CHECKS,
+    'POOL': {
+        'min_size': DB_POOL_MIN_SIZE,
+        'max_size': DB_POOL_MAX_SIZE,
+        'timeout': DB_POOL_TIMEOUT,
+        'max_age': DB_CONN_MAX_AGE,
+        'health_checks': DB_CONN_HEALTH_CHECKS,
+    } if DB_CONN_MODE == 'pool' else None,
+})
@@ -11,13 +11,29 @@ urlpatterns = [
     path('db/', app.views.db, name='db'),
     path('emissions/', app.views.emissions, name='emissions'),
     path('emissions/<int:page>', app.views.emissions, name='emissions'),
+    path('emissions/export', app.views.emissions_export, name='emissions_export'),
+    path('emissions/batch', app.views.emissions_batch, name='emissions_batch'),
     path('emissions/imo/', app.views.emission_detail, name='emission_detail'),
     path('emissions/imo/<int:imo>', app.views.emission_detail, name='emission_detail'),
+    path('search/', app.views.ship_search, name='ship_search'),
     path('aggregation/', app.views.aggregation, name='aggregation'),
     path('aggregation/<int:page>', app.views.aggregation, name='aggregation'),
+    path('compliance/', app.views.compliance, name='compliance'),
+    path('compliance/<int:page>', app.views.compliance, name='compliance'),
     path('visual/', app.views.visual_view, name='visual'),
+    path('dashboard/', app.views.dashboard, name='dashboard'),
     path('fuel_performance/', app.views.extended_view, name='extended_view'),
     path('verifiers_ranking/', app.views.extended_view_graph2, name='extended_view_graph2'),
     path('built_year_efficiency/', app.views.extended_view_graph3, name='extended_view_graph3'),
+    path('visual/export', app.views.analytics_export, {'view': 'visual'}, name='visual_export'),
+    path('fuel_performance/export', app.views.analytics_export, {'view': 'fuel_performance'}, name='extended_view_export'),
+    path('verifiers_ranking/export', app.views.analytics_export, {'view': 'verifiers_ranking'}, name='extended_view_graph2_export'),
+    path('built_year_efficiency/export', app.views.analytics_export, {'view': 'built_year_efficiency'}, name='extended_view_graph3_export'),
+    path('api/v1/visual', app.views.api_chart, {'view': 'visual'}, name='api_visual'),
+    path('api/v1/fuel_performance', app.views.api_chart, {'view': 'fuel_performance'}, name='api_fuel_performance'),
+    path('api/v1/verifiers_ranking', app.views.api_chart, {'view': 'verifiers_ranking'}, name='api_verifiers_ranking'),
+    path('api/v1/built_year_efficiency', app.views.api_chart, {'view': 'built_year_efficiency'}, name='api_built_year_efficiency'),
+    path('api/v1/quantiles', app.views.api_quantiles, name='api_quantiles'),
+    path('metrics', app.views.metrics, name='metrics'),
     path('admin/', admin.site.urls)
 ]
@@ -1,3 +1,6 @@
+-- Superseded by migration 0008_star_schema (see app/schema.py), which also adds
+-- the keys and indexes. Kept as the record of the original EDA setup.
+
 CREATE TABLE co2emission_reduced (
     imo BIGINT PRIMARY KEY,
     ship_name VARCHAR(64) NOT NULL,
@@ -5,4 +8,14 @@ CREATE TABLE co2emission_reduced (
     issue date NOT NULL,
     expiry date NOT NULL,
     technical_efficiency_number REAL NOT NULL
-);
\ No newline at end of file
+);
+
+-- composite indexes for keyset pagination on each sortable column
+CREATE INDEX co2emission_reduced_ship_name_imo_idx ON co2emission_reduced (ship_name, imo);
+CREATE INDEX co2emission_reduced_type_imo_idx ON co2emission_reduced (type, imo);
+CREATE INDEX co2emission_reduced_technical_efficiency_number_imo_idx ON co2emission_reduced (technical_efficiency_number, imo);
+CREATE INDEX co2emission_reduced_issue_imo_idx ON co2emission_reduced (issue, imo);
+CREATE INDEX co2emission_reduced_expiry_imo_idx ON co2emission_reduced (expiry, imo);
+
+-- per type min and max lookups for the maintained type_summary table
+CREATE INDEX co2emission_reduced_type_ten_idx ON co2emission_reduced (type, technical_efficiency_number);
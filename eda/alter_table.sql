@@ -1,3 +1,6 @@
+-- Superseded by migration 0008_star_schema (see app/schema.py), which also adds
+-- the keys and indexes. Kept as the record of the original EDA setup.
+
 -- add primary key on imo in ship table
 ALTER TABLE ship_dimension
 ADD PRIMARY KEY (ship_key);
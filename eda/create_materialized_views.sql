@@ -0,0 +1,262 @@
+-- materialized views of the analytics pages, generated from app/analytics.py with:
+-- python manage.py refresh_analytics --sql > eda/create_materialized_views.sql
+-- refresh after loading data with: python manage.py refresh_analytics
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_fuel_performance_eedi AS
+SELECT s.ship_type, s.engine_type,
+    ROUND(AVG(f.eedi)::NUMERIC,2) as metric,
+    ROUND(AVG(f.fuel_consumption)::NUMERIC,2) as fuelconsumption,
+    LN(COUNT(*)) as scaled_count,
+    (CASE
+    WHEN s.ship_type ISNULL AND s.engine_type ISNULL THEN 'Grand Total'
+    WHEN s.engine_type ISNULL THEN 'Subtotal'||' '||s.ship_type
+    ELSE s.ship_type|| ' ' || s.engine_type
+    END) as label,
+    GROUPING(s.ship_type, s.engine_type) as grouping_level
+FROM fact_table f, ship_dimension s
+WHERE f.ship_key = s.ship_key
+GROUP BY ROLLUP(s.ship_type, s.engine_type);
+CREATE UNIQUE INDEX IF NOT EXISTS mv_fuel_performance_eedi_key ON mv_fuel_performance_eedi (grouping_level, ship_type, engine_type);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_fuel_performance_tonnage AS
+SELECT s.ship_type, s.engine_type,
+    ROUND(AVG(s.tonnage)::NUMERIC,2) as metric,
+    ROUND(AVG(f.fuel_consumption)::NUMERIC,2) as fuelconsumption,
+    LN(COUNT(*)) as scaled_count,
+    (CASE
+    WHEN s.ship_type ISNULL AND s.engine_type ISNULL THEN 'Grand Total'
+    WHEN s.engine_type ISNULL THEN 'Subtotal'||' '||s.ship_type
+    ELSE s.ship_type|| ' ' || s.engine_type
+    END) as label,
+    GROUPING(s.ship_type, s.engine_type) as grouping_level
+FROM fact_table f, ship_dimension s
+WHERE f.ship_key = s.ship_key
+GROUP BY ROLLUP(s.ship_type, s.engine_type);
+CREATE UNIQUE INDEX IF NOT EXISTS mv_fuel_performance_tonnage_key ON mv_fuel_performance_tonnage (grouping_level, ship_type, engine_type);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_fuel_performance_width AS
+SELECT s.ship_type, s.engine_type,
+    ROUND(AVG(s.width)::NUMERIC,2) as metric,
+    ROUND(AVG(f.fuel_consumption)::NUMERIC,2) as fuelconsumption,
+    LN(COUNT(*)) as scaled_count,
+    (CASE
+    WHEN s.ship_type ISNULL AND s.engine_type ISNULL THEN 'Grand Total'
+    WHEN s.engine_type ISNULL THEN 'Subtotal'||' '||s.ship_type
+    ELSE s.ship_type|| ' ' || s.engine_type
+    END) as label,
+    GROUPING(s.ship_type, s.engine_type) as grouping_level
+FROM fact_table f, ship_dimension s
+WHERE f.ship_key = s.ship_key
+GROUP BY ROLLUP(s.ship_type, s.engine_type);
+CREATE UNIQUE INDEX IF NOT EXISTS mv_fuel_performance_width_key ON mv_fuel_performance_width (grouping_level, ship_type, engine_type);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_fuel_performance_length AS
+SELECT s.ship_type, s.engine_type,
+    ROUND(AVG(s.length)::NUMERIC,2) as metric,
+    ROUND(AVG(f.fuel_consumption)::NUMERIC,2) as fuelconsumption,
+    LN(COUNT(*)) as scaled_count,
+    (CASE
+    WHEN s.ship_type ISNULL AND s.engine_type ISNULL THEN 'Grand Total'
+    WHEN s.engine_type ISNULL THEN 'Subtotal'||' '||s.ship_type
+    ELSE s.ship_type|| ' ' || s.engine_type
+    END) as label,
+    GROUPING(s.ship_type, s.engine_type) as grouping_level
+FROM fact_table f, ship_dimension s
+WHERE f.ship_key = s.ship_key
+GROUP BY ROLLUP(s.ship_type, s.engine_type);
+CREATE UNIQUE INDEX IF NOT EXISTS mv_fuel_performance_length_key ON mv_fuel_performance_length (grouping_level, ship_type, engine_type);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_fuel_performance_speed AS
+SELECT s.ship_type, s.engine_type,
+    ROUND(AVG(s.speed)::NUMERIC,2) as metric,
+    ROUND(AVG(f.fuel_consumption)::NUMERIC,2) as fuelconsumption,
+    LN(COUNT(*)) as scaled_count,
+    (CASE
+    WHEN s.ship_type ISNULL AND s.engine_type ISNULL THEN 'Grand Total'
+    WHEN s.engine_type ISNULL THEN 'Subtotal'||' '||s.ship_type
+    ELSE s.ship_type|| ' ' || s.engine_type
+    END) as label,
+    GROUPING(s.ship_type, s.engine_type) as grouping_level
+FROM fact_table f, ship_dimension s
+WHERE f.ship_key = s.ship_key
+GROUP BY ROLLUP(s.ship_type, s.engine_type);
+CREATE UNIQUE INDEX IF NOT EXISTS mv_fuel_performance_speed_key ON mv_fuel_performance_speed (grouping_level, ship_type, engine_type);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_fuel_performance_sea_time AS
+SELECT s.ship_type, s.engine_type,
+    ROUND(AVG(f.sea_time)::NUMERIC,2) as metric,
+    ROUND(AVG(f.fuel_consumption)::NUMERIC,2) as fuelconsumption,
+    LN(COUNT(*)) as scaled_count,
+    (CASE
+    WHEN s.ship_type ISNULL AND s.engine_type ISNULL THEN 'Grand Total'
+    WHEN s.engine_type ISNULL THEN 'Subtotal'||' '||s.ship_type
+    ELSE s.ship_type|| ' ' || s.engine_type
+    END) as label,
+    GROUPING(s.ship_type, s.engine_type) as grouping_level
+FROM fact_table f, ship_dimension s
+WHERE f.ship_key = s.ship_key
+GROUP BY ROLLUP(s.ship_type, s.engine_type);
+CREATE UNIQUE INDEX IF NOT EXISTS mv_fuel_performance_sea_time_key ON mv_fuel_performance_sea_time (grouping_level, ship_type, engine_type);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_fuel_performance_co2_distance AS
+SELECT s.ship_type, s.engine_type,
+    ROUND(AVG(f.co2_distance)::NUMERIC,2) as metric,
+    ROUND(AVG(f.fuel_consumption)::NUMERIC,2) as fuelconsumption,
+    LN(COUNT(*)) as scaled_count,
+    (CASE
+    WHEN s.ship_type ISNULL AND s.engine_type ISNULL THEN 'Grand Total'
+    WHEN s.engine_type ISNULL THEN 'Subtotal'||' '||s.ship_type
+    ELSE s.ship_type|| ' ' || s.engine_type
+    END) as label,
+    GROUPING(s.ship_type, s.engine_type) as grouping_level
+FROM fact_table f, ship_dimension s
+WHERE f.ship_key = s.ship_key
+GROUP BY ROLLUP(s.ship_type, s.engine_type);
+CREATE UNIQUE INDEX IF NOT EXISTS mv_fuel_performance_co2_distance_key ON mv_fuel_performance_co2_distance (grouping_level, ship_type, engine_type);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_fuel_performance_co2_transport AS
+SELECT s.ship_type, s.engine_type,
+    ROUND(AVG(f.co2_transport)::NUMERIC,2) as metric,
+    ROUND(AVG(f.fuel_consumption)::NUMERIC,2) as fuelconsumption,
+    LN(COUNT(*)) as scaled_count,
+    (CASE
+    WHEN s.ship_type ISNULL AND s.engine_type ISNULL THEN 'Grand Total'
+    WHEN s.engine_type ISNULL THEN 'Subtotal'||' '||s.ship_type
+    ELSE s.ship_type|| ' ' || s.engine_type
+    END) as label,
+    GROUPING(s.ship_type, s.engine_type) as grouping_level
+FROM fact_table f, ship_dimension s
+WHERE f.ship_key = s.ship_key
+GROUP BY ROLLUP(s.ship_type, s.engine_type);
+CREATE UNIQUE INDEX IF NOT EXISTS mv_fuel_performance_co2_transport_key ON mv_fuel_performance_co2_transport (grouping_level, ship_type, engine_type);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_verifier_ranking AS
+SELECT v.verifier_name, d.month_actual,
+    ROUND(AVG(f.EEDI)::NUMERIC,2) as avg_eedi,
+    RANK() OVER(PARTITION BY d.month_actual ORDER BY ROUND(AVG(f.EEDI)::NUMERIC,2) ASC) rank
+FROM fact_table f, verifiers v, d_date d
+WHERE f.issue_date_key = d.date_dim_id
+    AND f.verifier_key = v.verifier_key
+GROUP BY v.verifier_name, d.month_actual;
+CREATE UNIQUE INDEX IF NOT EXISTS mv_verifier_ranking_key ON mv_verifier_ranking (verifier_name, month_actual);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_percentile_eedi AS
+SELECT s.year_built,
+    ROUND(PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY f.eedi ASC)::NUMERIC,2) AS percentile_25,
+    ROUND(PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY f.eedi ASC)::NUMERIC,2) AS percentile_75
+FROM fact_table f, ship_dimension s
+WHERE f.ship_key = s.ship_key
+GROUP BY s.year_built;
+CREATE UNIQUE INDEX IF NOT EXISTS mv_percentile_eedi_key ON mv_percentile_eedi (year_built);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_percentile_co2_distance AS
+SELECT s.year_built,
+    ROUND(PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY f.co2_distance ASC)::NUMERIC,2) AS percentile_25,
+    ROUND(PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY f.co2_distance ASC)::NUMERIC,2) AS percentile_75
+FROM fact_table f, ship_dimension s
+WHERE f.ship_key = s.ship_key
+GROUP BY s.year_built;
+CREATE UNIQUE INDEX IF NOT EXISTS mv_percentile_co2_distance_key ON mv_percentile_co2_distance (year_built);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_percentile_co2_transport AS
+SELECT s.year_built,
+    ROUND(PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY f.co2_transport ASC)::NUMERIC,2) AS percentile_25,
+    ROUND(PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY f.co2_transport ASC)::NUMERIC,2) AS percentile_75
+FROM fact_table f, ship_dimension s
+WHERE f.ship_key = s.ship_key
+GROUP BY s.year_built;
+CREATE UNIQUE INDEX IF NOT EXISTS mv_percentile_co2_transport_key ON mv_percentile_co2_transport (year_built);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_percentile_fuel_consumption AS
+SELECT s.year_built,
+    ROUND(PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY f.fuel_consumption ASC)::NUMERIC,2) AS percentile_25,
+    ROUND(PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY f.fuel_consumption ASC)::NUMERIC,2) AS percentile_75
+FROM fact_table f, ship_dimension s
+WHERE f.ship_key = s.ship_key
+GROUP BY s.year_built;
+CREATE UNIQUE INDEX IF NOT EXISTS mv_percentile_fuel_consumption_key ON mv_percentile_fuel_consumption (year_built);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_quantile_sketch_eedi AS
+SELECT year_built, ship_type, verifier_name, month_actual,
+    array_agg(bucket ORDER BY bucket) AS buckets,
+    array_agg(n ORDER BY bucket) AS counts
+FROM (
+    SELECT s.year_built, s.ship_type, v.verifier_name, d.month_actual,
+        CASE WHEN ABS(f.eedi) < 1e-09 THEN 0 ELSE SIGN(f.eedi)::INT * (CEIL(LN(ABS(f.eedi)::DOUBLE PRECISION) / 0.020000666706669435) + 1038)::INT END AS bucket,
+        COUNT(*) AS n
+    FROM fact_table f
+    JOIN ship_dimension s ON s.ship_key = f.ship_key
+    LEFT JOIN verifiers v ON v.verifier_key = f.verifier_key
+    LEFT JOIN d_date d ON d.date_dim_id = f.issue_date_key
+    WHERE f.eedi IS NOT NULL
+    GROUP BY 1, 2, 3, 4, 5
+) AS buckets
+GROUP BY year_built, ship_type, verifier_name, month_actual;
+CREATE UNIQUE INDEX IF NOT EXISTS mv_quantile_sketch_eedi_key ON mv_quantile_sketch_eedi (year_built, ship_type, verifier_name, month_actual);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_quantile_sketch_co2_distance AS
+SELECT year_built, ship_type, verifier_name, month_actual,
+    array_agg(bucket ORDER BY bucket) AS buckets,
+    array_agg(n ORDER BY bucket) AS counts
+FROM (
+    SELECT s.year_built, s.ship_type, v.verifier_name, d.month_actual,
+        CASE WHEN ABS(f.co2_distance) < 1e-09 THEN 0 ELSE SIGN(f.co2_distance)::INT * (CEIL(LN(ABS(f.co2_distance)::DOUBLE PRECISION) / 0.020000666706669435) + 1038)::INT END AS bucket,
+        COUNT(*) AS n
+    FROM fact_table f
+    JOIN ship_dimension s ON s.ship_key = f.ship_key
+    LEFT JOIN verifiers v ON v.verifier_key = f.verifier_key
+    LEFT JOIN d_date d ON d.date_dim_id = f.issue_date_key
+    WHERE f.co2_distance IS NOT NULL
+    GROUP BY 1, 2, 3, 4, 5
+) AS buckets
+GROUP BY year_built, ship_type, verifier_name, month_actual;
+CREATE UNIQUE INDEX IF NOT EXISTS mv_quantile_sketch_co2_distance_key ON mv_quantile_sketch_co2_distance (year_built, ship_type, verifier_name, month_actual);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_quantile_sketch_co2_transport AS
+SELECT year_built, ship_type, verifier_name, month_actual,
+    array_agg(bucket ORDER BY bucket) AS buckets,
+    array_agg(n ORDER BY bucket) AS counts
+FROM (
+    SELECT s.year_built, s.ship_type, v.verifier_name, d.month_actual,
+        CASE WHEN ABS(f.co2_transport) < 1e-09 THEN 0 ELSE SIGN(f.co2_transport)::INT * (CEIL(LN(ABS(f.co2_transport)::DOUBLE PRECISION) / 0.020000666706669435) + 1038)::INT END AS bucket,
+        COUNT(*) AS n
+    FROM fact_table f
+    JOIN ship_dimension s ON s.ship_key = f.ship_key
+    LEFT JOIN verifiers v ON v.verifier_key = f.verifier_key
+    LEFT JOIN d_date d ON d.date_dim_id = f.issue_date_key
+    WHERE f.co2_transport IS NOT NULL
+    GROUP BY 1, 2, 3, 4, 5
+) AS buckets
+GROUP BY year_built, ship_type, verifier_name, month_actual;
+CREATE UNIQUE INDEX IF NOT EXISTS mv_quantile_sketch_co2_transport_key ON mv_quantile_sketch_co2_transport (year_built, ship_type, verifier_name, month_actual);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_quantile_sketch_fuel_consumption AS
+SELECT year_built, ship_type, verifier_name, month_actual,
+    array_agg(bucket ORDER BY bucket) AS buckets,
+    array_agg(n ORDER BY bucket) AS counts
+FROM (
+    SELECT s.year_built, s.ship_type, v.verifier_name, d.month_actual,
+        CASE WHEN ABS(f.fuel_consumption) < 1e-09 THEN 0 ELSE SIGN(f.fuel_consumption)::INT * (CEIL(LN(ABS(f.fuel_consumption)::DOUBLE PRECISION) / 0.020000666706669435) + 1038)::INT END AS bucket,
+        COUNT(*) AS n
+    FROM fact_table f
+    JOIN ship_dimension s ON s.ship_key = f.ship_key
+    LEFT JOIN verifiers v ON v.verifier_key = f.verifier_key
+    LEFT JOIN d_date d ON d.date_dim_id = f.issue_date_key
+    WHERE f.fuel_consumption IS NOT NULL
+    GROUP BY 1, 2, 3, 4, 5
+) AS buckets
+GROUP BY year_built, ship_type, verifier_name, month_actual;
+CREATE UNIQUE INDEX IF NOT EXISTS mv_quantile_sketch_fuel_consumption_key ON mv_quantile_sketch_fuel_consumption (year_built, ship_type, verifier_name, month_actual);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_fact_filters AS
+SELECT 'year' AS filter, d.year_actual::TEXT AS value
+FROM (SELECT DISTINCT issue_date_key FROM fact_table) AS f
+JOIN d_date d ON d.date_dim_id = f.issue_date_key
+GROUP BY d.year_actual
+UNION ALL
+SELECT DISTINCT 'ship_type', ship_type FROM ship_dimension WHERE ship_type IS NOT NULL
+UNION ALL
+SELECT DISTINCT 'engine_type', engine_type FROM ship_dimension
+UNION ALL
+SELECT DISTINCT 'verifier', verifier_name FROM verifiers;
+CREATE UNIQUE INDEX IF NOT EXISTS mv_fact_filters_key ON mv_fact_filters (filter, value);
@@ -1,3 +1,6 @@
+-- Superseded by migration 0008_star_schema (see app/schema.py), which also adds
+-- the keys and indexes. Kept as the record of the original EDA setup.
+
 CREATE TABLE IF NOT EXISTS ship_dimension(
 	ship_key BIGINT NOT NULL,
 	ship_name VARCHAR(64),